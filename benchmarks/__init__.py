@@ -0,0 +1 @@
+"""Benchmarks for the paint-by-number algorithms and pipelines. Run with: python -m benchmarks --help"""
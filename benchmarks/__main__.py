@@ -0,0 +1,93 @@
+from typing import List, Optional
+import argparse
+import json
+import pathlib
+import sys
+
+from .images import IMAGE_GENERATORS
+from .suite import BenchmarkResult, compare, run_suite, to_json
+
+
+def print_result(result: BenchmarkResult) -> None:
+    print(
+        f"{result.case:<50} {result.image or '-':<9} {f'{result.size}px' if result.size else '-':>7} "
+        f"{result.seconds * 1000:>10.2f} ms {result.peak_memory_bytes / 1024:>10.1f} KiB",
+        file=sys.stderr,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark every registered algorithm and representative pipelines on synthetic images.",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[32, 64, 128], help="Square image sizes in pixels (default: 32 64 128)"
+    )
+    parser.add_argument(
+        "--images",
+        nargs="+",
+        choices=list(IMAGE_GENERATORS),
+        default=list(IMAGE_GENERATORS),
+        help="Synthetic images to benchmark on (default: all)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case; the best is kept (default: 3)")
+    parser.add_argument("--match", type=str, help="Only run cases whose name contains this text, e.g. segmentation/")
+    parser.add_argument("--no-pipelines", action="store_true", help="Skip the full pipeline benchmarks")
+    parser.add_argument("--no-imports", action="store_true", help="Skip the import time benchmarks")
+    parser.add_argument("--output", "-o", type=pathlib.Path, help="Write the JSON results here instead of stdout")
+    parser.add_argument("--save-baseline", type=pathlib.Path, help="Also store the results as a baseline file")
+    parser.add_argument("--baseline", type=pathlib.Path, help="Compare against this baseline file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown or memory growth that counts as a regression (default: 0.2 = 20%%)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.baseline and not args.baseline.is_file():
+        parser.error(f"Baseline file '{args.baseline}' does not exist.")
+
+    results = run_suite(
+        args.sizes,
+        args.images,
+        repeat=args.repeat,
+        match=args.match,
+        pipelines=not args.no_pipelines,
+        imports=not args.no_imports,
+        progress=print_result,
+    )
+
+    regressions = None
+    if args.baseline:
+        with args.baseline.open() as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    report = to_json(results, regressions)
+    if args.save_baseline:
+        with args.save_baseline.open("w") as f:
+            json.dump(to_json(results), f, indent=2)
+        print(f"Saved baseline to: {args.save_baseline}", file=sys.stderr)
+
+    if args.output:
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to: {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if regressions:
+        for r in regressions:
+            print(
+                f"REGRESSION {r['key']} {r['metric']}: {r['baseline']:.6g} -> {r['current']:.6g} ({r['ratio']:.2f}x)",
+                file=sys.stderr,
+            )
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
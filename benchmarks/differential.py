@@ -0,0 +1,237 @@
+from dataclasses import asdict, dataclass
+from enum import StrEnum
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type
+from PIL import Image
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+from pbn.algorithms import (
+    ALGORITHM_MAP,
+    PreprocessingEnum,
+    SegmentationEnum,
+    PostprocessingEnum,
+    AssignmentEnum,
+    RenderingEnum,
+)
+from pbn.algorithms.preprocessing.floyd_steinberg import KernelEnum
+from pbn.algorithms.registry import ENTRY_POINT_GROUPS
+from pbn.backends import BackendEnum, use_backend
+from pbn.datatypes import BaseSegmentedImage, ColoredSegmentedImage, Palette, SegmentedImage
+from .images import IMAGE_GENERATORS
+from .suite import ALGORITHM_PARAMS, environment, stage_name
+
+
+# The parameter sets every algorithm with a reference backend is checked with; algorithms not listed use
+# ALGORITHM_PARAMS or their defaults.
+PARAM_VARIANTS: Dict[str, List[Dict[str, Any]]] = {
+    PreprocessingEnum.FLOYD_STEINBERG: [{"kernel": kernel} for kernel in KernelEnum],
+    SegmentationEnum.GRID: [{"cell_size": 1}, {"cell_size": 3}],
+}
+
+
+@dataclass
+class DifferentialResult:
+    """Whether the fast and reference backends of one case gave identical outputs on every trial of an image, and
+    their total wall times."""
+
+    case: str
+    image: str
+    size: int
+    trials: int
+    identical: bool
+    reference_seconds: float
+    fast_seconds: float
+
+    @property
+    def speedup(self) -> float:
+        return self.reference_seconds / self.fast_seconds if self.fast_seconds else float("inf")
+
+
+def random_palette(rng: np.random.Generator) -> Palette:
+    """A palette of 1 to 16 random colors, sometimes with a repeated color to exercise ties."""
+    colors = rng.integers(0, 256, (int(rng.integers(1, 17)), 3))
+    if len(colors) > 1 and rng.random() < 0.5:
+        colors[-1] = colors[0]
+    return [(int(r), int(g), int(b)) for r, g, b in colors.tolist()]
+
+
+def fingerprint(output: Any) -> Any:
+    """What must be identical between backends: the pixels of images, and the label map with the ids, colors and
+    pixels of every segment of segmentations."""
+    if isinstance(output, tuple):
+        output = output[0]
+    if isinstance(output, Image.Image):
+        return output.mode, output.size, output.tobytes()
+    if isinstance(output, BaseSegmentedImage):
+        return (
+            output.labels,
+            [(segment.id, getattr(segment, "color", None), segment.pixels) for segment in output.segments],
+        )
+    raise TypeError(f"Cannot compare outputs of type {type(output).__name__}")
+
+
+def backend_cases(
+    image: Image.Image, palette: Palette, rng: np.random.Generator
+) -> Iterator[Tuple[str, Callable[[], Any]]]:
+    """Yield a callable for every registered algorithm with a reference backend and each of its parameter sets,
+    with its stage inputs prepared up front with the fast backend."""
+    segments: SegmentedImage = ALGORITHM_MAP[SegmentationEnum.GRID](cell_size=int(rng.integers(1, 4))).segment(image)
+    colored: ColoredSegmentedImage = ALGORITHM_MAP[AssignmentEnum.AVERAGE_NEAREST]().assign_colors(
+        image, segments, palette
+    )
+
+    for stage in ENTRY_POINT_GROUPS:
+        for algorithm_name in ALGORITHM_MAP.names(stage):
+            algorithm_class = ALGORITHM_MAP.load(stage, algorithm_name)
+            if BackendEnum.REFERENCE not in algorithm_class.backends:
+                continue
+            for params in PARAM_VARIANTS.get(algorithm_name, [ALGORITHM_PARAMS.get(algorithm_name, {})]):
+                algorithm = algorithm_class(**params)
+                suffix = ",".join(f"{key}={value}" for key, value in params.items())
+                name = f"{stage_name(stage)}/{algorithm_name}" + (f",{suffix}" if suffix else "")
+                yield name, stage_call(stage, algorithm, image, palette, segments, colored)
+
+
+def stage_call(
+    stage: Type[StrEnum],
+    algorithm: Any,
+    image: Image.Image,
+    palette: Palette,
+    segments: SegmentedImage,
+    colored: ColoredSegmentedImage,
+) -> Callable[[], Any]:
+    if stage is PreprocessingEnum:
+        return lambda: algorithm.process(image, palette)
+    if stage is SegmentationEnum:
+        return lambda: algorithm.segment(image)
+    if stage is AssignmentEnum:
+        return lambda: algorithm.assign_colors(image, segments, palette)
+    if stage is PostprocessingEnum:
+        return lambda: algorithm.process(colored.copy(), palette)
+    return lambda: algorithm.render(colored)
+
+
+def timed(fn: Callable[[], Any], backend: BackendEnum, repeat: int) -> Tuple[Any, float]:
+    """The output of fn with the backend and its best wall time over the repeats."""
+    best = float("inf")
+    output = None
+    with use_backend(backend):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = fn()
+            best = min(best, time.perf_counter() - start)
+    return output, best
+
+
+def run_differential(
+    sizes: Sequence[int],
+    images: Sequence[str],
+    trials: int = 3,
+    repeat: int = 1,
+    seed: int = 0,
+    match: Optional[str] = None,
+    progress: Optional[Callable[[DifferentialResult], None]] = None,
+) -> List[DifferentialResult]:
+    """Run every algorithm with a reference backend with both backends on trials random images and palettes of
+    every synthetic image kind and size, and compare the outputs."""
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for image_name in images:
+        for size in sizes:
+            totals: Dict[str, DifferentialResult] = {}
+            for _ in range(trials):
+                image = IMAGE_GENERATORS[image_name](size, int(rng.integers(1 << 31)))
+                palette = random_palette(rng)
+                for case, fn in backend_cases(image, palette, rng):
+                    if match and match not in case:
+                        continue
+                    reference, reference_seconds = timed(fn, BackendEnum.REFERENCE, repeat)
+                    fast, fast_seconds = timed(fn, BackendEnum.FAST, repeat)
+                    result = totals.setdefault(case, DifferentialResult(case, image_name, size, 0, True, 0.0, 0.0))
+                    result.trials += 1
+                    result.identical = result.identical and fingerprint(reference) == fingerprint(fast)
+                    result.reference_seconds += reference_seconds
+                    result.fast_seconds += fast_seconds
+
+            for result in totals.values():
+                results.append(result)
+                if progress:
+                    progress(result)
+
+    return results
+
+
+def to_json(results: Sequence[DifferentialResult]) -> Dict[str, Any]:
+    return {
+        "environment": environment(),
+        "results": [{**asdict(r), "speedup": r.speedup} for r in results],
+    }
+
+
+def print_result(result: DifferentialResult) -> None:
+    print(
+        f"{result.case:<50} {result.image:<9} {f'{result.size}px':>7} "
+        f"{'identical' if result.identical else 'MISMATCH':<9} {result.reference_seconds * 1000:>10.2f} ms "
+        f"{result.fast_seconds * 1000:>10.2f} ms {result.speedup:>8.1f}x",
+        file=sys.stderr,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.differential",
+        description=(
+            "Check that the fast backend of every algorithm gives the same output as its reference backend on "
+            "random synthetic images and palettes, and report the speedup."
+        ),
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[16, 48], help="Square image sizes in pixels (default: 16 48)"
+    )
+    parser.add_argument(
+        "--images",
+        nargs="+",
+        choices=list(IMAGE_GENERATORS),
+        default=list(IMAGE_GENERATORS),
+        help="Synthetic images to check on (default: all)",
+    )
+    parser.add_argument("--trials", type=int, default=3, help="Random images and palettes per size (default: 3)")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per backend; the best is kept (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random images and palettes (default: 0)")
+    parser.add_argument("--match", type=str, help="Only run cases whose name contains this text, e.g. rendering/")
+    parser.add_argument("--output", "-o", type=pathlib.Path, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.trials < 1:
+        parser.error("--trials must be at least 1")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    results = run_differential(
+        args.sizes, args.images, args.trials, args.repeat, args.seed, args.match, progress=print_result
+    )
+
+    report = to_json(results)
+    if args.output:
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to: {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    mismatches = [r for r in results if not r.identical]
+    for r in mismatches:
+        print(f"MISMATCH {r.case} on {r.image} {r.size}px", file=sys.stderr)
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from typing import Callable, Dict
+from PIL import Image
+
+import numpy as np
+
+
+def gradient(size: int, seed: int = 0) -> Image.Image:
+    """Smooth horizontal, vertical and diagonal color ramps."""
+    ys, xs = np.mgrid[0:size, 0:size] / max(size - 1, 1)
+    pixels = np.dstack((xs, ys, (xs + ys) / 2)) * 255
+    return Image.fromarray(pixels.astype(np.uint8), mode="RGB")
+
+
+def noise(size: int, seed: int = 0) -> Image.Image:
+    """Uniform random noise, the worst case for segmentation."""
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), mode="RGB")
+
+
+def texture(size: int, seed: int = 0) -> Image.Image:
+    """Photo-like image: smooth blobs of color with hard edges, shading and a little sensor noise."""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:size, 0:size] / max(size - 1, 1)
+    pixels = np.zeros((size, size, 3))
+
+    for _ in range(12):
+        cx, cy, radius = rng.random(), rng.random(), 0.1 + 0.3 * rng.random()
+        color = rng.integers(0, 256, 3)
+        inside = (xs - cx) ** 2 + (ys - cy) ** 2 < radius**2
+        shade = 1 - 0.4 * np.hypot(xs - cx, ys - cy) / radius
+        pixels[inside] = (color * shade[inside, None]).clip(0, 255)
+
+    pixels += rng.normal(0, 6, pixels.shape)
+    return Image.fromarray(pixels.clip(0, 255).astype(np.uint8), mode="RGB")
+
+
+IMAGE_GENERATORS: Dict[str, Callable[[int, int], Image.Image]] = {
+    "gradient": gradient,
+    "noise": noise,
+    "texture": texture,
+}
@@ -0,0 +1,311 @@
+from dataclasses import asdict, dataclass
+from enum import StrEnum
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type
+from PIL import Image
+import json
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from pbn import PaintByNumber, load_palette
+from pbn.algorithms import (
+    ALGORITHM_MAP,
+    PreprocessingEnum,
+    SegmentationEnum,
+    PostprocessingEnum,
+    AssignmentEnum,
+    RenderingEnum,
+)
+from pbn.algorithms.registry import ENTRY_POINT_GROUPS
+from pbn.datatypes import Palette, PipelineRun, SegmentedImage, ColoredSegmentedImage
+from .images import IMAGE_GENERATORS
+
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+PALETTE_DIR = ROOT_DIR / "palettes"
+
+IMPORT_SCRIPT = """
+import json, time, tracemalloc
+{setup}
+if {trace}:
+    tracemalloc.start()
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "peak_memory_bytes": tracemalloc.get_traced_memory()[1]}}))
+"""
+
+# Parameters for algorithms that have required parameters or whose defaults are impractically slow.
+ALGORITHM_PARAMS: Dict[str, Dict[str, Any]] = {
+    SegmentationEnum.KMEANS: {"num_clusters": 8, "seed": 0},
+    SegmentationEnum.VORONOI: {"num_seeds": 64, "seed": 0},
+}
+
+AlgorithmSpec = Tuple[StrEnum, Dict[str, Any]]
+
+# Representative full pipelines: (name, preprocessing, segmentation, postprocessing).
+PIPELINES: List[Tuple[str, List[AlgorithmSpec], AlgorithmSpec, List[AlgorithmSpec]]] = [
+    ("grid-merge", [], (SegmentationEnum.GRID, {"cell_size": 1}), [(PostprocessingEnum.MERGE, {})]),
+    (
+        "watershed-merge-smooth",
+        [],
+        (SegmentationEnum.WATERSHED, {}),
+        [(PostprocessingEnum.MERGE, {}), (PostprocessingEnum.SMOOTH, {})],
+    ),
+    (
+        "lab_watershed-merge",
+        [],
+        (SegmentationEnum.LAB_WATERSHED, {}),
+        [(PostprocessingEnum.MERGE, {})],
+    ),
+    (
+        "floyd-steinberg-kmeans-merge",
+        [(PreprocessingEnum.FLOYD_STEINBERG, {})],
+        (SegmentationEnum.KMEANS, {"num_clusters": 8, "seed": 0}),
+        [(PostprocessingEnum.MERGE, {})],
+    ),
+]
+
+
+def stage_name(stage: Type[StrEnum]) -> str:
+    """E.g. "segmentation" for SegmentationEnum."""
+    return stage.__name__.removesuffix("Enum").lower()
+
+
+@dataclass
+class BenchmarkResult:
+    """Best wall time and peak traced memory of one case on one image. Import cases have no image."""
+
+    case: str
+    image: str
+    size: int
+    seconds: float
+    peak_memory_bytes: int
+
+    @property
+    def key(self) -> str:
+        return f"{self.case}|{self.image}|{self.size}"
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> Tuple[float, int]:
+    """Return the best wall time over the repeats, and the peak traced memory of one extra traced run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+def bundled_palettes() -> Dict[str, Palette]:
+    """Load every palette in palettes/ that the palette loader understands."""
+    palettes = {}
+    for path in sorted(PALETTE_DIR.glob("*.txt")):
+        try:
+            palettes[path.stem] = load_palette(path)
+        except ValueError as e:
+            print(f"Skipping palette {path.name}: {e}", file=sys.stderr)
+    return palettes
+
+
+def algorithm_cases(
+    image: Image.Image, palette: Palette
+) -> Iterator[Tuple[str, Callable[[], Any]]]:
+    """Yield a callable for every registered algorithm, with its stage inputs prepared up front."""
+    segments: SegmentedImage = ALGORITHM_MAP[SegmentationEnum.GRID](cell_size=4).segment(image)
+    colored: ColoredSegmentedImage = ALGORITHM_MAP[AssignmentEnum.AVERAGE_NEAREST]().assign_colors(
+        image, segments, palette
+    )
+
+    for stage in ENTRY_POINT_GROUPS:
+        for algorithm_name in ALGORITHM_MAP.names(stage):
+            name = f"{stage_name(stage)}/{algorithm_name}"
+            try:
+                algorithm = ALGORITHM_MAP.load(stage, algorithm_name)(**ALGORITHM_PARAMS.get(algorithm_name, {}))
+            except TypeError as e:
+                print(f"Skipping {name}: {e}", file=sys.stderr)
+                continue
+
+            if stage is PreprocessingEnum:
+                yield name, partial(algorithm.process, image, palette)
+            elif stage is SegmentationEnum:
+                yield name, partial(algorithm.segment, image)
+            elif stage is AssignmentEnum:
+                yield name, partial(algorithm.assign_colors, image, segments, palette)
+            elif stage is PostprocessingEnum:
+                yield name, partial(algorithm.process, colored, palette)
+            elif stage is RenderingEnum:
+                yield name, partial(algorithm.render, colored)
+
+
+def import_cases() -> Iterator[Tuple[str, str, str]]:
+    """Yield (case, setup, statement) for the package imports and for loading each built-in algorithm class."""
+    yield "import/pbn", "", "import pbn"
+    yield "import/pbn.cli", "", "import pbn.cli"
+    for stage in ENTRY_POINT_GROUPS:
+        for algorithm_name in ALGORITHM_MAP.paths[stage]:
+            yield (
+                f"import/{stage_name(stage)}/{algorithm_name}",
+                f"from pbn.algorithms import ALGORITHM_MAP, {stage.__name__}",
+                f"ALGORITHM_MAP.load({stage.__name__}, {str(algorithm_name)!r})",
+            )
+
+
+def measure_import(setup: str, statement: str, repeat: int) -> Tuple[float, int]:
+    """Time a statement in fresh interpreters, so that nothing is imported yet. Like measure(), the best time is
+    kept and the peak memory is traced in one extra run."""
+
+    def run(trace: bool) -> Dict[str, Any]:
+        script = IMPORT_SCRIPT.format(setup=setup, statement=statement, trace=trace)
+        output = subprocess.run(
+            [sys.executable, "-c", script], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        result: Dict[str, Any] = json.loads(output.splitlines()[-1])
+        return result
+
+    seconds = min(run(trace=False)["seconds"] for _ in range(repeat))
+    return seconds, run(trace=True)["peak_memory_bytes"]
+
+
+def pipeline_cases(
+    image: Image.Image, palettes: Dict[str, Palette]
+) -> Iterator[Tuple[str, Callable[[], Any]]]:
+    """Yield a callable running each representative pipeline with each bundled palette."""
+    for name, preprocessing, segmentation, postprocessing in PIPELINES:
+        for palette_name, palette in palettes.items():
+
+            def run(
+                preprocessing: List[AlgorithmSpec] = preprocessing,
+                segmentation: AlgorithmSpec = segmentation,
+                postprocessing: List[AlgorithmSpec] = postprocessing,
+                palette_name: str = palette_name,
+                palette: Palette = palette,
+            ) -> Any:
+                pipeline_run = PipelineRun(
+                    input_path=pathlib.Path("benchmark.png"),
+                    original_image=image,
+                    palette_path=PALETTE_DIR / f"{palette_name}.txt",
+                    preprocessing=[ALGORITHM_MAP[p[0]](**p[1]) for p in preprocessing],
+                    segmentation=ALGORITHM_MAP[segmentation[0]](**segmentation[1]),
+                    postprocessing=[ALGORITHM_MAP[p[0]](**p[1]) for p in postprocessing],
+                    assignment=ALGORITHM_MAP[AssignmentEnum.AVERAGE_NEAREST](),
+                    rendering=ALGORITHM_MAP[RenderingEnum.COLORED](),
+                )
+                return PaintByNumber(pipeline_run, palette=palette).process()
+
+            yield f"pipeline/{name}/{palette_name}", run
+
+
+def run_suite(
+    sizes: Sequence[int],
+    images: Sequence[str],
+    repeat: int = 1,
+    match: Optional[str] = None,
+    pipelines: bool = True,
+    imports: bool = True,
+    progress: Optional[Callable[[BenchmarkResult], None]] = None,
+) -> List[BenchmarkResult]:
+    """Benchmark the imports, every registered algorithm and the representative pipelines on every synthetic
+    image."""
+    palettes = bundled_palettes()
+    default_palette = palettes.get("palette5") or next(iter(palettes.values()))
+    results = []
+
+    for case, setup, statement in import_cases() if imports else ():
+        if match and match not in case:
+            continue
+        seconds, peak = measure_import(setup, statement, repeat)
+        result = BenchmarkResult(case, "", 0, seconds, peak)
+        results.append(result)
+        if progress:
+            progress(result)
+
+    for image_name in images:
+        for size in sizes:
+            image = IMAGE_GENERATORS[image_name](size, 0)
+            cases = list(algorithm_cases(image, default_palette))
+            if pipelines:
+                cases += list(pipeline_cases(image, palettes))
+
+            for case, fn in cases:
+                if match and match not in case:
+                    continue
+                seconds, peak = measure(fn, repeat)
+                result = BenchmarkResult(case, image_name, size, seconds, peak)
+                results.append(result)
+                if progress:
+                    progress(result)
+
+    return results
+
+
+def environment() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def compare(
+    results: Sequence[BenchmarkResult],
+    baseline: Dict[str, Any],
+    threshold: float,
+    min_seconds: float = 0.005,
+) -> List[Dict[str, Any]]:
+    """Flag results that are slower or use more memory than the baseline by more than the threshold (0.1 = 10%).
+    Time differences below min_seconds are ignored as noise."""
+    baseline_results = {
+        f"{r['case']}|{r['image']}|{r['size']}": r for r in baseline.get("results", [])
+    }
+    regressions = []
+
+    for result in results:
+        base = baseline_results.get(result.key)
+        if base is None:
+            continue
+
+        if result.seconds > base["seconds"] * (1 + threshold) and result.seconds - base["seconds"] > min_seconds:
+            regressions.append(
+                {
+                    "key": result.key,
+                    "metric": "seconds",
+                    "baseline": base["seconds"],
+                    "current": result.seconds,
+                    "ratio": result.seconds / base["seconds"],
+                }
+            )
+        if base["peak_memory_bytes"] and result.peak_memory_bytes > base["peak_memory_bytes"] * (1 + threshold):
+            regressions.append(
+                {
+                    "key": result.key,
+                    "metric": "peak_memory_bytes",
+                    "baseline": base["peak_memory_bytes"],
+                    "current": result.peak_memory_bytes,
+                    "ratio": result.peak_memory_bytes / base["peak_memory_bytes"],
+                }
+            )
+
+    return regressions
+
+
+def to_json(results: Sequence[BenchmarkResult], regressions: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    report: Dict[str, Any] = {"environment": environment(), "results": [asdict(r) for r in results]}
+    if regressions is not None:
+        report["regressions"] = regressions
+    return report
@@ -1,8 +1,8 @@
 from .preprocessing.base import ImageProcessingAlgorithm
 from .segmentation.base import ImageSegmentationAlgorithm
 from .assignment.base import ColorAssignmentAlgorithm
-from .postprocessing import SegmentsProcessingAlgorithm
-from .rendering import SegmentRenderingAlgorithm
+from .postprocessing.base import SegmentsProcessingAlgorithm
+from .rendering.base import SegmentRenderingAlgorithm
 from .enums import PreprocessingEnum, SegmentationEnum, PostprocessingEnum, AssignmentEnum, RenderingEnum
 from .registry import ALGORITHM_MAP
 
@@ -1,7 +1,23 @@
-from .average_nearest import AverageNearestColorAssignment
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .base import ColorAssignmentAlgorithm
 
+if TYPE_CHECKING:
+    from .average_nearest import AverageNearestColorAssignment
+
+# Algorithms are imported on first access, so that importing the package does not import their dependencies.
+_MODULES = {
+    "AverageNearestColorAssignment": "average_nearest",
+}
+
 __all__ = [
     "ColorAssignmentAlgorithm",
     "AverageNearestColorAssignment",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _MODULES:
+        return getattr(import_module(f".{_MODULES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
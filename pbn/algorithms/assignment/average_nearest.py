@@ -1,16 +1,31 @@
-from typing import List, Dict, Any
+from typing import Dict, Any
 from PIL import Image
-import math
 
+import numpy as np
+
+from pbn.backends import BackendEnum, get_backend
 from pbn.datatypes import Palette, Color, SegmentedImage, Segment, ColoredSegmentedImage
+from pbn.histogram import map_colors
+from pbn.memory import IMAGE_BYTES_PER_PIXEL, LABEL_BYTES_PER_PIXEL
+from pbn.parallel import NEAREST_CHUNK_BYTES, label_sums, nearest_palette_indices, nearest_working_bytes
 from .base import ColorAssignmentAlgorithm
 from pbn.algorithms.enums import AssignmentEnum
 
 
+# What assigning a color adds per segment: the float64 and int64 color sums, the count, the id and the average, then
+# the colored segment with its color map entry.
+SEGMENT_BYTES = (3 + 3 + 1 + 1 + 3) * 8 + 136
+
+
 class AverageNearestColorAssignment(ColorAssignmentAlgorithm):
     """Assigns each segment the palette color closest to its average color."""
 
     name = AssignmentEnum.AVERAGE_NEAREST
+    backends = (BackendEnum.FAST, BackendEnum.REFERENCE)
+
+    # The nearest palette colors are looked up with about this many bytes of distances at a time. The result is
+    # the same.
+    chunk_bytes: int = NEAREST_CHUNK_BYTES
 
     @staticmethod
     def average_color(segment: Segment, src_pixels: Any) -> Color:
@@ -26,32 +41,49 @@ class AverageNearestColorAssignment(ColorAssignmentAlgorithm):
 
         return (r // n, g // n, b // n)
 
+    @staticmethod
+    def nearest_color(color: Color, palette: Palette) -> Color:
+        """Return the palette color with minimal Euclidean distance, the first one on ties."""
+        return min(palette, key=lambda p: sum((c - pc) ** 2 for c, pc in zip(color, p)))
+
     def assign_colors(
         self,
         image: Image.Image,
         segments: SegmentedImage,
         palette: Palette,
     ) -> ColoredSegmentedImage:
-        """Compute average segment colors and assign nearest palette color."""
-        image = image.convert("RGB")
-        src_pixels = image.load()
-        if src_pixels is None:
-            raise ValueError("Failed to load image pixels.")
+        """Compute average segment colors and assign nearest palette color.
 
-        color_map: Dict[int, Color] = {}
+        The averages are summed per row band from the label map and the nearest colors are found per batch of
+        distinct averages, both on the shared thread pool. Ties go to the first palette color. The reference backend
+        averages and looks up every segment on its own."""
+        if get_backend() == BackendEnum.REFERENCE:
+            src_pixels = image.convert("RGB").load()
+            reference_map: Dict[int, Color] = {
+                segment.id: self.nearest_color(self.average_color(segment, src_pixels), palette)
+                for segment in segments.segments
+            }
+            return ColoredSegmentedImage.from_segments(segments, image.width, image.height, reference_map)
 
-        for segment in segments.segments:
-            avg_color = self.average_color(segment, src_pixels)
-            assigned = self._nearest_color(avg_color, palette)
+        pixels = np.asarray(image.convert("RGB"))
+        labels = np.array(segments.labels, dtype=np.int64).reshape(segments.height, segments.width)
+        sums, counts, offset = label_sums(pixels, labels)
 
-            color_map[segment.id] = assigned
+        ids = np.array([segment.id for segment in segments.segments], dtype=np.int64)
+        averages = sums[ids - offset] // counts[ids - offset, None]
+        # Many segments share an average, e.g. the single-pixel cells of a fine grid, so each distinct average is
+        # looked up once.
+        nearest = map_colors(lambda colors: nearest_palette_indices(colors, palette, self.chunk_bytes), averages)
 
+        color_map: Dict[int, Color] = {
+            segment.id: palette[index] for segment, index in zip(segments.segments, nearest.tolist())
+        }
         return ColoredSegmentedImage.from_segments(segments, image.width, image.height, color_map)
 
-    def _nearest_color(self, color: Color, palette: List[Color]) -> Color:
-        """Return palette color with minimal Euclidean distance."""
-        return min(palette, key=lambda p: self._distance(color, p))
-
-    def _distance(self, a: Color, b: Color) -> float:
-        """Compute Euclidean distance between two RGB colors."""
-        return math.sqrt(sum((ac - bc) ** 2 for ac, bc in zip(a, b)))
+    def estimate_memory(self, width: int, height: int, palette_size: int = 0) -> int:
+        """The base estimate plus the label map with its band index and float channel, and, for up to one segment
+        per pixel as with the default grid, the per-segment arrays and the nearest color lookup: the averages, their
+        indices and the distances of the chunks in flight."""
+        pixels = width * height
+        per_pixel = IMAGE_BYTES_PER_PIXEL + LABEL_BYTES_PER_PIXEL + 3 * 8 + SEGMENT_BYTES
+        return pixels * per_pixel + nearest_working_bytes(pixels, palette_size, self.chunk_bytes)
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
 from PIL import Image
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
 from pbn.datatypes import Palette, SegmentedImage, ColoredSegmentedImage
+from pbn.backends import BackendEnum
+from pbn.memory import IMAGE_BYTES_PER_PIXEL, LABEL_BYTES_PER_PIXEL
 
 
 class ColorAssignmentAlgorithm(ABC):
@@ -10,8 +12,16 @@ class ColorAssignmentAlgorithm(ABC):
 
     name: str
     params: Dict[str, Any] = {}
+    # The implementations the algorithm can run with, selected per run (see pbn.backends).
+    backends: Tuple[BackendEnum, ...] = (BackendEnum.FAST,)
 
     @abstractmethod
     def assign_colors(self, image: Image.Image, segments: SegmentedImage, palette: Palette) -> ColoredSegmentedImage:
         """Assign a color from the palette to each segment and render."""
         pass
+
+    def estimate_memory(self, width: int, height: int, palette_size: int = 0) -> int:
+        """Estimate the peak bytes that assigning colors from a palette of palette_size colors to segments of this
+        size allocates. The default assumes a converted copy of the image and colored segments that share the
+        segment pixels."""
+        return width * height * (IMAGE_BYTES_PER_PIXEL + LABEL_BYTES_PER_PIXEL)
@@ -6,6 +6,9 @@ class PreprocessingEnum(StrEnum):
 
     NONE = "nop"
     FLOYD_STEINBERG = "floyd-steinberg"
+    MEDIAN = "median"
+    BILATERAL = "bilateral"
+    MEAN_SHIFT = "mean-shift"
 
 
 class SegmentationEnum(StrEnum):
@@ -24,6 +27,7 @@ class PostprocessingEnum(StrEnum):
     NONE = "nop"
     MERGE = "merge"
     SMOOTH = "smooth"
+    HIERARCHICAL_MERGE = "hierarchical-merge"
 
 
 class AssignmentEnum(StrEnum):
@@ -1,11 +1,34 @@
-from .no_postprocessing import NoPostprocessing
-from .smooth_boundaries import SmoothBoundaries
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .base import SegmentsProcessingAlgorithm
-from .merge_segments import MergeSegments
+
+if TYPE_CHECKING:
+    from .no_postprocessing import NoPostprocessing
+    from .merge_segments import MergeSegments
+    from .smooth_boundaries import SmoothBoundaries
+    from .hierarchical_merge import HierarchicalMerge, MergeTree
+
+# Algorithms are imported on first access, so that importing the package does not import their dependencies.
+_MODULES = {
+    "NoPostprocessing": "no_postprocessing",
+    "MergeSegments": "merge_segments",
+    "SmoothBoundaries": "smooth_boundaries",
+    "HierarchicalMerge": "hierarchical_merge",
+    "MergeTree": "hierarchical_merge",
+}
 
 __all__ = [
     "SegmentsProcessingAlgorithm",
     "NoPostprocessing",
     "MergeSegments",
     "SmoothBoundaries",
+    "HierarchicalMerge",
+    "MergeTree",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _MODULES:
+        return getattr(import_module(f".{_MODULES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,9 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 
 from pbn.datatypes import Palette, ColoredSegmentedImage
+from pbn.backends import BackendEnum
+from pbn.memory import grouped_segments_bytes, label_list_bytes
 
 
 class SegmentsProcessingAlgorithm(ABC):
@@ -9,8 +11,16 @@ class SegmentsProcessingAlgorithm(ABC):
 
     name: str
     params: Dict[str, Any] = {}
+    # The implementations the algorithm can run with, selected per run (see pbn.backends).
+    backends: Tuple[BackendEnum, ...] = (BackendEnum.FAST,)
 
     @abstractmethod
     def process(self, segments: ColoredSegmentedImage, palette: Optional[Palette] = None) -> ColoredSegmentedImage:
         """Transform colored segments. E.g. smooth boundaries, merge. Palette is required only for palette-dependent algorithms."""
         pass
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """Estimate the peak bytes that processing segments of this size allocates, including the new segments.
+        The default assumes a few per-pixel arrays and the label list of the input next to the new segments, which
+        are built with group_pixels."""
+        return width * height * 4 * 8 + label_list_bytes(width, height) + grouped_segments_bytes(width, height)
@@ -0,0 +1,252 @@
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import heapq
+import itertools
+import math
+
+import numpy as np
+
+from pbn.algorithms.enums import PostprocessingEnum
+from pbn.datatypes import Color, ColoredSegment, ColoredSegmentedImage, Palette
+from pbn.memory import segments_bytes
+from pbn.profiling import record
+from .base import SegmentsProcessingAlgorithm
+
+
+# The merge trees of the last few inputs are kept, so cutting the same segments at another level skips building.
+TREE_CACHE_SIZE = 4
+
+
+@dataclass
+class MergeTree:
+    """A hierarchy of region merges over the segments of a colored segmentation, recorded as a dendrogram.
+
+    The leaves 0..n-1 are the initial segments. Merge i joins the nodes children[i] into node n + i at heights[i],
+    which never decrease, so the merges below any height and the first merges down to any number of regions are a
+    prefix of the list. Finding the regions of a cut only walks the n + m nodes, but the cut segmentation gets the
+    pixels of its initial segments and a new label map, so a cut takes time proportional to the number of pixels."""
+
+    width: int
+    height: int
+    leaf_pixels: List[List[Tuple[int, int]]]
+    leaf_colors: np.ndarray
+    leaf_areas: np.ndarray
+    children: np.ndarray
+    heights: np.ndarray
+
+    @property
+    def num_leaves(self) -> int:
+        return len(self.leaf_pixels)
+
+    @property
+    def min_regions(self) -> int:
+        """The regions left after all merges: more than one when some segments do not touch any other."""
+        return self.num_leaves - len(self.heights)
+
+    @classmethod
+    def build(cls, segments: ColoredSegmentedImage, border_weight: float = 1.0) -> MergeTree:
+        """Merge adjacent regions agglomeratively, always the pair with the lowest cost next.
+
+        The cost of a pair is the distance between the area-weighted average colors of the regions, raised by up to
+        border_weight times itself when their border is short: distance * (1 + border_weight * (1 - border /
+        shorter perimeter)). A region that is (almost) enclosed by another one thus merges at its plain color
+        distance. Regions touch when they are 4-neighbors; perimeters only count borders with other regions."""
+        leaves = list(segments.segments)
+        n = len(leaves)
+        leaf_colors = np.array([segment.color for segment in leaves], dtype=np.float64).reshape(n, 3)
+        leaf_areas = np.array([len(segment.pixels) for segment in leaves], dtype=np.int64)
+
+        # Number the segments 0..n-1 in their order; unlabeled pixels become n.
+        ids = np.array([segment.id for segment in leaves], dtype=np.int64)
+        order = np.argsort(ids)
+        labels = np.array(segments.labels, dtype=np.int64).reshape(segments.height, segments.width)
+        index = np.minimum(np.searchsorted(ids[order], labels), max(n - 1, 0))
+        leaf_map = np.where(ids[order][index] == labels, order[index], n) if n else np.zeros_like(labels)
+
+        # Every pair of 4-neighbors in different segments adds one to the border between them.
+        first_pixels = np.concatenate([leaf_map[:, :-1].ravel(), leaf_map[:-1, :].ravel()])
+        second_pixels = np.concatenate([leaf_map[:, 1:].ravel(), leaf_map[1:, :].ravel()])
+        different = (first_pixels != second_pixels) & (first_pixels < n) & (second_pixels < n)
+        a = np.minimum(first_pixels[different], second_pixels[different])
+        b = np.maximum(first_pixels[different], second_pixels[different])
+        keys, lengths = np.unique(a * n + b, return_counts=True)
+
+        borders: Dict[int, Dict[int, int]] = {node: {} for node in range(n)}
+        for key, length in zip(keys.tolist(), lengths.tolist()):
+            borders[key // n][key % n] = length
+            borders[key % n][key // n] = length
+        perimeters = [sum(neighbors.values()) for neighbors in borders.values()]
+        colors: List[Tuple[float, ...]] = [tuple(color) for color in leaf_colors.tolist()]
+        areas = leaf_areas.tolist()
+        node_heights = [0.0] * n
+
+        def cost(x: int, y: int) -> float:
+            distance = math.dist(colors[x], colors[y])
+            shared = borders[x][y] / min(perimeters[x], perimeters[y])
+            return max(distance * (1 + border_weight * (1 - shared)), node_heights[x], node_heights[y])
+
+        heap = [(cost(x, y), x, y) for x in range(n) for y in borders[x] if x < y]
+        heapq.heapify(heap)
+        alive = [True] * n
+        children: List[Tuple[int, int]] = []
+        heights: List[float] = []
+        while heap:
+            height, x, y = heapq.heappop(heap)
+            # Pairs with a merged region are stale; the merged region has its own pairs.
+            if not (alive[x] and alive[y]):
+                continue
+            node = n + len(children)
+            children.append((x, y))
+            heights.append(height)
+            alive[x] = alive[y] = False
+            alive.append(True)
+
+            area = areas[x] + areas[y]
+            colors.append(tuple((cx * areas[x] + cy * areas[y]) / area for cx, cy in zip(colors[x], colors[y])))
+            areas.append(area)
+            perimeters.append(perimeters[x] + perimeters[y] - 2 * borders[x][y])
+            node_heights.append(height)
+
+            # The larger neighbor table is reused for the merged region.
+            larger, smaller = (x, y) if len(borders[x]) >= len(borders[y]) else (y, x)
+            neighbors = borders.pop(larger)
+            del neighbors[smaller]
+            for neighbor, length in borders.pop(smaller).items():
+                if neighbor != larger:
+                    neighbors[neighbor] = neighbors.get(neighbor, 0) + length
+            borders[node] = neighbors
+            for neighbor, length in neighbors.items():
+                neighbor_borders = borders[neighbor]
+                neighbor_borders.pop(x, None)
+                neighbor_borders.pop(y, None)
+                neighbor_borders[node] = length
+                heapq.heappush(heap, (cost(node, neighbor), neighbor, node))
+
+        return cls(
+            segments.width,
+            segments.height,
+            [segment.pixels for segment in leaves],
+            leaf_colors.astype(np.uint8),
+            leaf_areas,
+            np.array(children, dtype=np.int64).reshape(-1, 2),
+            np.array(heights, dtype=np.float64),
+        )
+
+    def merges_for(self, regions: Optional[int] = None, threshold: Optional[float] = None) -> int:
+        """The number of merges that cutting at a number of regions or at a height threshold applies."""
+        if (regions is None) == (threshold is None):
+            raise ValueError("Cut the merge tree at either a number of regions or a threshold")
+        if threshold is not None:
+            return int(np.searchsorted(self.heights, threshold, side="right"))
+        if regions is None or regions < 1:
+            raise ValueError("regions must be at least 1")
+        return max(0, min(len(self.heights), self.num_leaves - regions))
+
+    def cut(self, regions: Optional[int] = None, threshold: Optional[float] = None) -> ColoredSegmentedImage:
+        """The segmentation with the given number of regions, or with the merges up to the threshold height.
+
+        With a number of regions, the merges stop there or when no adjacent regions are left (see min_regions).
+        Every region gets the color covering most of its area among its initial segments, ties going to the
+        lowest RGB value. Regions are numbered in order of their first initial segment."""
+        n = self.num_leaves
+        merges = self.merges_for(regions, threshold)
+        if n == 0:
+            return ColoredSegmentedImage.from_segments([], width=self.width, height=self.height)
+
+        # Point every node at its parent within the applied merges and jump pointers to the roots.
+        roots = np.arange(n + merges)
+        roots[self.children[:merges].ravel()] = np.repeat(np.arange(n, n + merges), 2)
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                break
+            roots = jumped
+        _, first_leaf, region_of_leaf = np.unique(roots[:n], return_index=True, return_inverse=True)
+        rank = np.empty(len(first_leaf), dtype=np.int64)
+        rank[np.argsort(first_leaf)] = np.arange(len(first_leaf))
+        region_of_leaf = rank[region_of_leaf.ravel()]
+        num_regions = len(first_leaf)
+
+        # The color with the largest area in every region.
+        distinct_colors, color_of_leaf = np.unique(self.leaf_colors, axis=0, return_inverse=True)
+        color_of_leaf = color_of_leaf.ravel()
+        color_areas = np.zeros((num_regions, len(distinct_colors)), dtype=np.int64)
+        np.add.at(color_areas, (region_of_leaf, color_of_leaf), self.leaf_areas)
+        dominant = np.argmax(color_areas, axis=1)
+        region_colors: List[Color] = [(int(r), int(g), int(b)) for r, g, b in distinct_colors[dominant].tolist()]
+
+        members: List[List[int]] = [[] for _ in range(num_regions)]
+        for leaf, region in enumerate(region_of_leaf.tolist()):
+            members[region].append(leaf)
+        regions_out = [
+            ColoredSegment(
+                id=region,
+                pixels=list(itertools.chain.from_iterable(self.leaf_pixels[leaf] for leaf in leaves)),
+                color=region_colors[region],
+            )
+            for region, leaves in enumerate(members)
+        ]
+        return ColoredSegmentedImage.from_segments(regions_out, width=self.width, height=self.height)
+
+
+_trees: OrderedDict[str, MergeTree] = OrderedDict()
+
+
+def merge_tree(segments: ColoredSegmentedImage, border_weight: float = 1.0) -> MergeTree:
+    """The merge tree of colored segments, built on first use and kept for the last TREE_CACHE_SIZE inputs.
+    The inputs are told apart by a hash of their label map and segment colors, which reads every pixel."""
+    digest = hashlib.sha256(f"{segments.width}x{segments.height}:{border_weight}:".encode())
+    digest.update(np.array(segments.labels, dtype=np.int64).tobytes())
+    digest.update(repr([(segment.id, segment.color) for segment in segments.segments]).encode())
+    key = digest.hexdigest()
+    if key in _trees:
+        _trees.move_to_end(key)
+        record("tree_cached", True)
+        return _trees[key]
+
+    tree = MergeTree.build(segments, border_weight)
+    record("tree_cached", False)
+    _trees[key] = tree
+    while len(_trees) > TREE_CACHE_SIZE:
+        _trees.popitem(last=False)
+    return tree
+
+
+class HierarchicalMerge(SegmentsProcessingAlgorithm):
+    """Merges adjacent segments of similar colors, down to a number of regions or up to a color distance.
+
+    The merges come from a merge tree over the input segments (see MergeTree) that is built once and kept, so
+    running again with another number of regions or threshold on the same segments, like moving a detail slider in
+    an editing session, only cuts the tree. That skips the merging, though it still takes time proportional to the
+    number of pixels. Without regions or threshold, the threshold is 0: adjacent segments of
+    the same color are merged."""
+
+    name = PostprocessingEnum.HIERARCHICAL_MERGE
+
+    def __init__(self, regions: Optional[int] = None, threshold: Optional[float] = None, border_weight: float = 1.0):
+        if regions is not None and threshold is not None:
+            raise ValueError("Give either regions or threshold, not both")
+        if regions is not None and regions < 1:
+            raise ValueError("regions must be at least 1")
+        if border_weight < 0:
+            raise ValueError("border_weight must be non-negative")
+        self.params = {"regions": regions, "threshold": threshold, "border_weight": border_weight}
+
+    def process(self, segments: ColoredSegmentedImage, palette: Optional[Palette] = None) -> ColoredSegmentedImage:
+        """Cut the merge tree of the segments at the configured level."""
+        tree = merge_tree(segments, self.params["border_weight"])
+        regions, threshold = self.params["regions"], self.params["threshold"]
+        if regions is None and threshold is None:
+            threshold = 0.0
+        merged = tree.cut(regions, threshold)
+        record("tree_leaves", tree.num_leaves)
+        record("regions", len(merged.segments))
+        return merged
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The label list, and the label, leaf map and neighbor pair arrays of building the tree, next to the new
+        segments. The tree itself is proportional to the number of segments."""
+        return width * height * 14 * 8 + segments_bytes(width, height)
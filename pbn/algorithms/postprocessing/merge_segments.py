@@ -1,9 +1,11 @@
 from scipy.ndimage import label
+from skimage import measure
 from typing import Optional
 import numpy as np
 
 from pbn.algorithms.enums import PostprocessingEnum
 from .base import SegmentsProcessingAlgorithm
+from pbn.backends import BackendEnum, get_backend, group_pixels
 from pbn.datatypes import Palette, ColoredSegment, ColoredSegmentedImage
 
 
@@ -11,9 +13,48 @@ class MergeSegments(SegmentsProcessingAlgorithm):
     """Segments with neighbors of the same color are merged into one larger segment."""
 
     name = PostprocessingEnum.MERGE
+    backends = (BackendEnum.FAST, BackendEnum.REFERENCE)
 
     def process(self, segments: ColoredSegmentedImage, palette: Optional[Palette] = None) -> ColoredSegmentedImage:
-        """Merge adjacent segments of the same color."""
+        """Merge adjacent segments of the same color, where pixels touching at a corner are adjacent.
+
+        The merged segments are numbered color by color and, within a color, in raster order of their first pixel.
+        The fast backend labels the connected regions of all colors in one pass over a map of color numbers; the
+        reference backend labels a mask of every color on its own."""
+        if get_backend() == BackendEnum.REFERENCE:
+            return self._process_reference(segments)
+
+        # Number the colors in the order the reference backend visits them; unlabeled pixels get -1.
+        colors = list({seg.color for seg in segments.segments})
+        color_numbers = {color: number for number, color in enumerate(colors)}
+        ids = [seg.id for seg in segments.segments]
+        offset = min([-1, *ids])
+        lookup = np.full(max([-1, *ids]) - offset + 1, -1, dtype=np.int64)
+        for seg in segments.segments:
+            lookup[seg.id - offset] = color_numbers[seg.color]
+        color_map = lookup[np.array(segments.labels, dtype=np.int64).reshape(segments.height, segments.width) - offset]
+
+        components: np.ndarray = measure.label(color_map, background=-1, connectivity=2)
+        count = int(components.max())
+        flat = components.ravel()
+        # The first pixel of every component 1..count, which orders the components within their color. Unlabeled
+        # pixels (0) may be missing.
+        _, first_pixels = np.unique(flat, return_index=True)
+        first_pixels = first_pixels[len(first_pixels) - count :]
+        component_colors = color_map.ravel()[first_pixels]
+        order = np.lexsort((first_pixels, component_colors))
+        numbers = np.empty(count + 1, dtype=np.int64)
+        numbers[0] = -1
+        numbers[1 + order] = np.arange(count)
+        merged_colors = component_colors[order].tolist()
+
+        merged_segments = [
+            ColoredSegment(id=seg_id, pixels=pixels, color=colors[merged_colors[seg_id]])
+            for seg_id, pixels in enumerate(group_pixels(numbers[components], count))
+        ]
+        return ColoredSegmentedImage.from_segments(merged_segments, width=segments.width, height=segments.height)
+
+    def _process_reference(self, segments: ColoredSegmentedImage) -> ColoredSegmentedImage:
         labels = np.array(segments.labels)
         merged_segments: list[ColoredSegment] = []
         seg_id = 0
@@ -13,3 +13,6 @@ class NoPostprocessing(SegmentsProcessingAlgorithm):
     def process(self, segments: ColoredSegmentedImage, palette: Optional[Palette] = None) -> ColoredSegmentedImage:
         """Do nothing."""
         return segments
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        return 0
@@ -5,6 +5,7 @@ from scipy.ndimage import label, grey_closing, grey_opening
 from pbn.algorithms.enums import PostprocessingEnum
 from .base import SegmentsProcessingAlgorithm
 from pbn.datatypes import Palette, ColoredSegment, ColoredSegmentedImage
+from pbn.memory import segments_bytes
 
 
 class SmoothBoundaries(SegmentsProcessingAlgorithm):
@@ -63,3 +64,7 @@ class SmoothBoundaries(SegmentsProcessingAlgorithm):
                 seg_id += 1
         
         return ColoredSegmentedImage.from_segments(merged_segments, width=width, height=height)
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """Label, color and float smoothing maps of 8 bytes per pixel, next to the new segments."""
+        return width * height * 6 * 8 + segments_bytes(width, height)
@@ -1,9 +1,35 @@
-from .floyd_steinberg import FloydSteinbergDithering
-from .no_preprocessing import NoPreprocessing
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .base import ImageProcessingAlgorithm
 
+if TYPE_CHECKING:
+    from .no_preprocessing import NoPreprocessing
+    from .floyd_steinberg import FloydSteinbergDithering
+    from .median import MedianSmoothing
+    from .bilateral import BilateralSmoothing
+    from .mean_shift import MeanShiftSmoothing
+
+# Algorithms are imported on first access, so that importing the package does not import their dependencies.
+_MODULES = {
+    "NoPreprocessing": "no_preprocessing",
+    "FloydSteinbergDithering": "floyd_steinberg",
+    "MedianSmoothing": "median",
+    "BilateralSmoothing": "bilateral",
+    "MeanShiftSmoothing": "mean_shift",
+}
+
 __all__ = [
     "ImageProcessingAlgorithm",
     "NoPreprocessing",
     "FloydSteinbergDithering",
+    "MedianSmoothing",
+    "BilateralSmoothing",
+    "MeanShiftSmoothing",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _MODULES:
+        return getattr(import_module(f".{_MODULES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 from PIL import Image
 
 from pbn.datatypes import Palette
+from pbn.backends import BackendEnum
+from pbn.memory import IMAGE_BYTES_PER_PIXEL
 
 
 class ImageProcessingAlgorithm(ABC):
@@ -10,8 +12,15 @@ class ImageProcessingAlgorithm(ABC):
 
     name: str
     params: Dict[str, Any] = {}
+    # The implementations the algorithm can run with, selected per run (see pbn.backends).
+    backends: Tuple[BackendEnum, ...] = (BackendEnum.FAST,)
 
     @abstractmethod
     def process(self, image: Image.Image, palette: Optional[Palette] = None) -> Image.Image:
         """Transform the image. E.g. blur, dither. Palette is required only for palette-dependent algorithms like dithering."""
         pass
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """Estimate the peak bytes that processing an image of this size allocates, including the output.
+        The default assumes a converted copy and the output image."""
+        return 2 * width * height * IMAGE_BYTES_PER_PIXEL
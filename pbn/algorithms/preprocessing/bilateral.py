@@ -0,0 +1,74 @@
+from typing import Optional
+from PIL import Image
+import numpy as np
+from scipy.ndimage import gaussian_filter, map_coordinates
+
+from pbn.algorithms.enums import PreprocessingEnum
+from pbn.datatypes import Palette
+from pbn.memory import IMAGE_BYTES_PER_PIXEL
+from .base import ImageProcessingAlgorithm
+
+# Grid cells around the values, so that the blur and the interpolation never reach past the edge of the grid.
+GRID_PADDING = 2
+# The float coordinates and values of every pixel while one channel is filtered.
+BILATERAL_BYTES_PER_PIXEL = 6 * 8
+
+
+def bilateral_grid(channel: np.ndarray, sigma_spatial: float, sigma_range: float) -> np.ndarray:
+    """Bilateral filter of a (height, width) channel, with the channel itself as the range, on a bilateral grid.
+
+    Every pixel is added to the cell of a grid downsampled by sigma_spatial in x and y and by sigma_range in value,
+    the grid is blurred with a Gaussian of one cell, and every pixel reads the blurred average back at its own
+    position with trilinear interpolation. Pixels only average with pixels of similar values, so edges stay sharp,
+    and the cost is linear in the number of pixels whatever the size of the kernel."""
+    height, width = channel.shape
+    ys = np.arange(height, dtype=np.float64)[:, None] / sigma_spatial + GRID_PADDING
+    xs = np.arange(width, dtype=np.float64)[None, :] / sigma_spatial + GRID_PADDING
+    values = channel.astype(np.float64)
+    zs = values / sigma_range + GRID_PADDING
+
+    shape = (
+        int(ys[-1, 0]) + GRID_PADDING + 2,
+        int(xs[0, -1]) + GRID_PADDING + 2,
+        int(255 / sigma_range) + 2 * GRID_PADDING + 2,
+    )
+    cells = (np.rint(ys).astype(np.int64) * shape[1] + np.rint(xs).astype(np.int64)) * shape[2]
+    cells = (cells + np.rint(zs).astype(np.int64)).ravel()
+    size = shape[0] * shape[1] * shape[2]
+    sums = np.bincount(cells, weights=values.ravel(), minlength=size).reshape(shape)
+    counts = np.bincount(cells, minlength=size).astype(np.float64).reshape(shape)
+    sums = gaussian_filter(sums, 1.0, mode="constant")
+    counts = gaussian_filter(counts, 1.0, mode="constant")
+
+    coordinates = np.stack(np.broadcast_arrays(ys, xs, zs))
+    total = map_coordinates(sums, coordinates, order=1)
+    weight = map_coordinates(counts, coordinates, order=1)
+    # Every pixel is in the grid itself, so its weight is positive.
+    filtered: np.ndarray = total / np.maximum(weight, 1e-12)
+    return filtered
+
+
+class BilateralSmoothing(ImageProcessingAlgorithm):
+    """Edge-preserving smoothing that averages every pixel with the nearby pixels of similar color: a Gaussian of
+    sigma_spatial pixels in space and of sigma_range values in every channel. The channels are filtered one by one
+    on a downsampled bilateral grid (see bilateral_grid), so large kernels cost no more than small ones."""
+
+    name = PreprocessingEnum.BILATERAL
+
+    def __init__(self, sigma_spatial: float = 8.0, sigma_range: float = 20.0):
+        if sigma_spatial <= 0 or sigma_range <= 0:
+            raise ValueError("sigma_spatial and sigma_range must be positive")
+        self.params = {"sigma_spatial": sigma_spatial, "sigma_range": sigma_range}
+
+    def process(self, image: Image.Image, palette: Optional[Palette] = None) -> Image.Image:
+        pixels = np.asarray(image.convert("RGB"))
+        output = np.empty_like(pixels)
+        for c in range(3):
+            filtered = bilateral_grid(pixels[:, :, c], self.params["sigma_spatial"], self.params["sigma_range"])
+            output[:, :, c] = np.clip(np.rint(filtered), 0, 255)
+        return Image.fromarray(output)
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The coordinates and values of one channel next to a converted copy and the output. The grid is
+        sigma_spatial squared times smaller than the image."""
+        return width * height * (BILATERAL_BYTES_PER_PIXEL + 2 * IMAGE_BYTES_PER_PIXEL)
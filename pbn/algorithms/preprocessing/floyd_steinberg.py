@@ -1,22 +1,162 @@
-from typing import List, Optional, cast, Tuple
+from dataclasses import dataclass
+from enum import StrEnum
+from typing import Dict, List, Optional, cast, Tuple
 from PIL import Image
 import math
 
+import numpy as np
+
 from pbn.algorithms.enums import PreprocessingEnum
+from pbn.backends import BackendEnum, get_backend
 from .base import ImageProcessingAlgorithm
 from pbn.datatypes import Palette, Color
+from pbn.memory import IMAGE_BYTES_PER_PIXEL
+from pbn.parallel import nearest_palette_indices
+
+# A list of three float objects, its slot in the row list and the temporary lists, as measured with tracemalloc.
+FLOAT_BUFFER_BYTES_PER_PIXEL = 200
+# The float64 error buffer and the palette index of every pixel.
+WAVEFRONT_BYTES_PER_PIXEL = 3 * 8 + 8
+
+
+class KernelEnum(StrEnum):
+    FLOYD_STEINBERG = "floyd-steinberg"
+    JARVIS_JUDICE_NINKE = "jarvis-judice-ninke"
+    STUCKI = "stucki"
+
+
+@dataclass(frozen=True)
+class DiffusionKernel:
+    """The share of the quantization error of a pixel that every later pixel (x + dx, y + dy) receives:
+    weight / divisor."""
+
+    weights: Tuple[Tuple[int, int, int], ...]
+    divisor: int
+
+    @property
+    def lag(self) -> int:
+        """The smallest number of columns a row can run behind the row above it in a wavefront.
+
+        Pixel (x, y) is processed at step x + lag * y. Every pixel must be processed after the pixels that pass it
+        error, and the errors it receives must be added in the order of the sequential algorithm, row by row. A
+        pixel that receives error from two rows in the same step gets the error of the upper row first."""
+        lag = 1
+        while not self._fits(lag):
+            lag += 1
+        return lag
+
+    def _fits(self, lag: int) -> bool:
+        for dx, dy, _ in self.weights:
+            if dy > 0 and -dx - lag * dy >= 0:
+                return False
+            for other_dx, other_dy, _ in self.weights:
+                if other_dy > dy and dx - other_dx > lag * (other_dy - dy):
+                    return False
+        return True
+
+
+KERNELS: Dict[KernelEnum, DiffusionKernel] = {
+    KernelEnum.FLOYD_STEINBERG: DiffusionKernel(((1, 0, 7), (-1, 1, 3), (0, 1, 5), (1, 1, 1)), 16),
+    KernelEnum.JARVIS_JUDICE_NINKE: DiffusionKernel(
+        (
+            (1, 0, 7), (2, 0, 5),
+            (-2, 1, 3), (-1, 1, 5), (0, 1, 7), (1, 1, 5), (2, 1, 3),
+            (-2, 2, 1), (-1, 2, 3), (0, 2, 5), (1, 2, 3), (2, 2, 1),
+        ),
+        48,
+    ),
+    KernelEnum.STUCKI: DiffusionKernel(
+        (
+            (1, 0, 8), (2, 0, 4),
+            (-2, 1, 2), (-1, 1, 4), (0, 1, 8), (1, 1, 4), (2, 1, 2),
+            (-2, 2, 1), (-1, 2, 2), (0, 2, 4), (1, 2, 2), (2, 2, 1),
+        ),
+        42,
+    ),
+}
+
+
+def diffuse_wavefront(pixels: np.ndarray, palette: Palette, kernel: DiffusionKernel) -> np.ndarray:
+    """Error diffusion of an (height, width, 3) uint8 array, returning the palette index of every pixel.
+
+    Rows are processed together in a wavefront: each step handles one pixel of every row in flight, kernel.lag
+    columns behind the row above, as NumPy vectors. Those pixels lie lag - width pixels apart in the flattened
+    image, so every step reads and updates strided views. The pixels get the same colors as with the sequential
+    algorithm, as every value goes through the same float operations in the same order."""
+    height, width = pixels.shape[:2]
+    lag = kernel.lag
+    palette_array = np.array(palette, dtype=np.int64).reshape(-1, 3)
+    buffer = pixels.reshape(-1, 3).astype(np.float64)
+    indices = np.empty(height * width, dtype=np.int64)
+    stride = width - lag
+    # Within a step, errors from upper rows are added first (see DiffusionKernel.lag).
+    weights = sorted(kernel.weights, key=lambda weight: -weight[1])
+
+    def rows(start: int, count: int) -> slice | np.ndarray:
+        """The flat indices of count pixels of consecutive rows in a step, from the pixel at start."""
+        if stride > 0:
+            return slice(start, start + (count - 1) * stride + 1, stride)
+        flat_indices: np.ndarray = start + stride * np.arange(count)
+        return flat_indices
+
+    for step in range(width + lag * (height - 1)):
+        # The rows whose column step - lag * y is in the image.
+        y0 = max(0, -(-(step - width + 1) // lag))
+        y1 = min(height - 1, step // lag)
+        if y0 > y1:
+            continue
+        start = step + y0 * stride
+        active = rows(start, y1 - y0 + 1)
+
+        old = buffer[active]
+        nearest = nearest_palette_indices(np.trunc(old), palette_array)
+        indices[active] = nearest
+        error = old - palette_array[nearest]
+
+        for dx, dy, weight in weights:
+            # The rows whose pixel (x + dx, y + dy) is in the image.
+            low = max(y0, -(-(step + dx - width + 1) // lag))
+            high = min(y1, (step + dx) // lag, height - 1 - dy)
+            if low > high:
+                continue
+            target = rows(start + (low - y0) * stride + dy * width + dx, high - low + 1)
+            buffer[target] += error[low - y0 : high - y0 + 1] * weight / kernel.divisor
+
+    return indices.reshape(height, width)
 
 
 class FloydSteinbergDithering(ImageProcessingAlgorithm):
-    """Color quantization using Floyd-Steinberg error diffusion dithering."""
+    """Color quantization using error diffusion dithering: Floyd-Steinberg or, with kernel, the wider
+    Jarvis-Judice-Ninke and Stucki kernels.
+
+    The fast backend processes rows together in a wavefront (see diffuse_wavefront). The reference backend runs
+    the sequential pixel-by-pixel algorithm, which gives the same image."""
 
     name = PreprocessingEnum.FLOYD_STEINBERG
+    backends = (BackendEnum.FAST, BackendEnum.REFERENCE)
+
+    def __init__(self, kernel: str = KernelEnum.FLOYD_STEINBERG):
+        try:
+            kernel = KernelEnum(kernel)
+        except ValueError:
+            raise ValueError(f"Unknown kernel '{kernel}'. Choose from: {', '.join(KernelEnum)}")
+        self.kernel = KERNELS[kernel]
+        self.params = {}
+        # The default kernel is left out, so that output and cache names stay as they were before kernels.
+        if kernel != KernelEnum.FLOYD_STEINBERG:
+            self.params["kernel"] = kernel
 
     def process(self, image: Image.Image, palette: Optional[Palette] = None) -> Image.Image:
         """Transform the image. E.g. blur, dither. Palette is required only for palette-dependent algorithms like dithering."""
         if not palette:
             raise ValueError("Palette required for dithering.")
 
+        if get_backend() == BackendEnum.REFERENCE:
+            return self._process_reference(image, palette)
+        indices = diffuse_wavefront(np.asarray(image.convert("RGB")), palette, self.kernel)
+        return Image.fromarray(np.array(palette, dtype=np.uint8).reshape(-1, 3)[indices])
+
+    def _process_reference(self, image: Image.Image, palette: Palette) -> Image.Image:
         image = image.convert("RGB")
         pixels = image.load()
         if pixels is None:
@@ -36,17 +176,20 @@ class FloydSteinbergDithering(ImageProcessingAlgorithm):
                 pixels[x, y] = new_pixel
                 error = [old_pixel[i] - new_pixel[i] for i in range(3)]
 
-                if x + 1 < width:
-                    buffer[y][x + 1] = [buffer[y][x + 1][i] + error[i] * 7 / 16 for i in range(3)]
-                if x - 1 >= 0 and y + 1 < height:
-                    buffer[y + 1][x - 1] = [buffer[y + 1][x - 1][i] + error[i] * 3 / 16 for i in range(3)]
-                if y + 1 < height:
-                    buffer[y + 1][x] = [buffer[y + 1][x][i] + error[i] * 5 / 16 for i in range(3)]
-                if x + 1 < width and y + 1 < height:
-                    buffer[y + 1][x + 1] = [buffer[y + 1][x + 1][i] + error[i] * 1 / 16 for i in range(3)]
+                for dx, dy, weight in self.kernel.weights:
+                    if 0 <= x + dx < width and y + dy < height:
+                        target = buffer[y + dy][x + dx]
+                        buffer[y + dy][x + dx] = [target[i] + error[i] * weight / self.kernel.divisor for i in range(3)]
 
         return image
 
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The error buffer holds three floats per pixel: as a NumPy array in a wavefront, as lists in the
+        reference backend."""
+        if get_backend() == BackendEnum.REFERENCE:
+            return width * height * (FLOAT_BUFFER_BYTES_PER_PIXEL + IMAGE_BYTES_PER_PIXEL)
+        return width * height * (WAVEFRONT_BYTES_PER_PIXEL + 2 * IMAGE_BYTES_PER_PIXEL)
+
     def _nearest_color(self, color: Color, palette: List[Color]) -> Color:
         """Return the palette color with minimal Euclidean distance."""
         return min(palette, key=lambda p: self._distance(color, p))
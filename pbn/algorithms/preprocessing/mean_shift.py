@@ -0,0 +1,77 @@
+from typing import Optional
+from PIL import Image
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from pbn.algorithms.enums import PreprocessingEnum
+from pbn.datatypes import Palette
+from pbn.memory import IMAGE_BYTES_PER_PIXEL
+from pbn.profiling import record
+from .base import ImageProcessingAlgorithm
+
+# Modes closer than this to their previous position, in color values, have converged.
+CONVERGENCE = 0.5
+# The bin index of every pixel and its color while mapping the pixels to their modes.
+MEAN_SHIFT_BYTES_PER_PIXEL = 8 + 3 * 8
+
+
+class MeanShiftSmoothing(ImageProcessingAlgorithm):
+    """Edge-preserving smoothing that moves every color to the mode of the color distribution it belongs to, so
+    that the noisy shades of a surface become one color while distinct surfaces keep theirs.
+
+    Mean shift is approximated on a histogram of RGB bins of bin_size values: the Gaussian-weighted mean color
+    around every bin, with a standard deviation of bandwidth values, is computed for all bins at once by blurring
+    the histogram. Every occupied bin then climbs from its average color to a mode by repeatedly moving to the
+    mean of the bin it is in, and the pixels take the mode of their bin. The cost is linear in the number of
+    pixels plus a fixed cost for the histogram."""
+
+    name = PreprocessingEnum.MEAN_SHIFT
+
+    def __init__(self, bandwidth: float = 16.0, bin_size: int = 8, max_iterations: int = 30):
+        if bandwidth <= 0:
+            raise ValueError("bandwidth must be positive")
+        if not 1 <= bin_size <= 128:
+            raise ValueError("bin_size must be in 1..128")
+        if max_iterations < 1:
+            raise ValueError("max_iterations must be at least 1")
+        self.params = {"bandwidth": bandwidth, "bin_size": bin_size, "max_iterations": max_iterations}
+
+    def process(self, image: Image.Image, palette: Optional[Palette] = None) -> Image.Image:
+        bin_size: int = self.params["bin_size"]
+        bins = -(-256 // bin_size)
+        pixels = np.asarray(image.convert("RGB"))
+        cells = pixels.reshape(-1, 3).astype(np.int64) // bin_size
+        pixel_bins = (cells[:, 0] * bins + cells[:, 1]) * bins + cells[:, 2]
+
+        shape = (bins, bins, bins)
+        counts = np.bincount(pixel_bins, minlength=bins**3).astype(np.float64)
+        sums = np.stack(
+            [np.bincount(pixel_bins, weights=pixels[:, :, c].ravel(), minlength=bins**3) for c in range(3)], axis=1
+        )
+        sigma = self.params["bandwidth"] / bin_size
+        density = gaussian_filter(counts.reshape(shape), sigma, mode="constant").ravel()
+        means = np.stack(
+            [gaussian_filter(sums[:, c].reshape(shape), sigma, mode="constant").ravel() for c in range(3)], axis=1
+        ) / np.maximum(density, 1e-12)[:, None]
+
+        occupied = np.flatnonzero(counts)
+        modes = sums[occupied] / counts[occupied, None]
+        iterations = 0
+        for iterations in range(1, self.params["max_iterations"] + 1):
+            mode_cells = np.clip(modes.astype(np.int64) // bin_size, 0, bins - 1)
+            shifted = means[(mode_cells[:, 0] * bins + mode_cells[:, 1]) * bins + mode_cells[:, 2]]
+            converged = np.abs(shifted - modes).max(initial=0) < CONVERGENCE
+            modes = shifted
+            if converged:
+                break
+
+        lookup = np.zeros((bins**3, 3), dtype=np.uint8)
+        lookup[occupied] = np.clip(np.rint(modes), 0, 255)
+        record("occupied_bins", len(occupied))
+        record("modes", len(np.unique(lookup[occupied], axis=0)))
+        record("iterations", iterations)
+        return Image.fromarray(lookup[pixel_bins].reshape(pixels.shape))
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The bin of every pixel next to a converted copy and the output; the histogram has a fixed size."""
+        return width * height * (MEAN_SHIFT_BYTES_PER_PIXEL + 2 * IMAGE_BYTES_PER_PIXEL)
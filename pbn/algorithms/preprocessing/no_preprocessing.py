@@ -14,3 +14,6 @@ class NoPreprocessing(ImageProcessingAlgorithm):
     def process(self, image: Image.Image, palette: Optional[Palette] = None) -> Image.Image:
         """Do nothing."""
         return image
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        return 0
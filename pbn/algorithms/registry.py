@@ -1,22 +1,129 @@
-from .preprocessing import FloydSteinbergDithering, NoPreprocessing
-from .segmentation import GridImageSegmentation, VoronoiImageSegmentation, KMeansImageSegmentation, WatershedImageSegmentation, LABWatershedSegmentation
-from .postprocessing import MergeSegments, SmoothBoundaries, NoPostprocessing
-from .assignment import AverageNearestColorAssignment
-from .rendering import ColoredRendering
+from collections.abc import Mapping
+from enum import StrEnum
+from importlib import import_module
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
 from .enums import PreprocessingEnum, SegmentationEnum, PostprocessingEnum, AssignmentEnum, RenderingEnum
 
 
-ALGORITHM_MAP = {
-    PreprocessingEnum.NONE: NoPreprocessing,
-    PreprocessingEnum.FLOYD_STEINBERG: FloydSteinbergDithering,
-    SegmentationEnum.GRID: GridImageSegmentation,
-    SegmentationEnum.VORONOI: VoronoiImageSegmentation,
-    SegmentationEnum.KMEANS: KMeansImageSegmentation,
-    SegmentationEnum.WATERSHED: WatershedImageSegmentation,
-    SegmentationEnum.LAB_WATERSHED: LABWatershedSegmentation,
-    PostprocessingEnum.NONE: NoPostprocessing,
-    PostprocessingEnum.MERGE: MergeSegments,
-    PostprocessingEnum.SMOOTH: SmoothBoundaries,
-    AssignmentEnum.AVERAGE_NEAREST: AverageNearestColorAssignment,
-    RenderingEnum.COLORED: ColoredRendering,
+# Built-in algorithms of each stage as "module:Class" import paths, so that an algorithm and its dependencies
+# (scikit-learn, scikit-image, scipy) are only imported when it is used. The stages are kept apart because enum
+# values of different stages compare equal when they share a name, like "nop".
+ALGORITHM_PATHS: Dict[Type[StrEnum], Dict[str, str]] = {
+    PreprocessingEnum: {
+        PreprocessingEnum.NONE: "pbn.algorithms.preprocessing.no_preprocessing:NoPreprocessing",
+        PreprocessingEnum.FLOYD_STEINBERG: "pbn.algorithms.preprocessing.floyd_steinberg:FloydSteinbergDithering",
+        PreprocessingEnum.MEDIAN: "pbn.algorithms.preprocessing.median:MedianSmoothing",
+        PreprocessingEnum.BILATERAL: "pbn.algorithms.preprocessing.bilateral:BilateralSmoothing",
+        PreprocessingEnum.MEAN_SHIFT: "pbn.algorithms.preprocessing.mean_shift:MeanShiftSmoothing",
+    },
+    SegmentationEnum: {
+        SegmentationEnum.GRID: "pbn.algorithms.segmentation.grid_segmentation:GridImageSegmentation",
+        SegmentationEnum.VORONOI: "pbn.algorithms.segmentation.voronoi:VoronoiImageSegmentation",
+        SegmentationEnum.KMEANS: "pbn.algorithms.segmentation.kmeans:KMeansImageSegmentation",
+        SegmentationEnum.WATERSHED: "pbn.algorithms.segmentation.watershed:WatershedImageSegmentation",
+        SegmentationEnum.LAB_WATERSHED: "pbn.algorithms.segmentation.lab_watershed:LABWatershedSegmentation",
+    },
+    PostprocessingEnum: {
+        PostprocessingEnum.NONE: "pbn.algorithms.postprocessing.no_postprocessing:NoPostprocessing",
+        PostprocessingEnum.MERGE: "pbn.algorithms.postprocessing.merge_segments:MergeSegments",
+        PostprocessingEnum.SMOOTH: "pbn.algorithms.postprocessing.smooth_boundaries:SmoothBoundaries",
+        PostprocessingEnum.HIERARCHICAL_MERGE: "pbn.algorithms.postprocessing.hierarchical_merge:HierarchicalMerge",
+    },
+    AssignmentEnum: {
+        AssignmentEnum.AVERAGE_NEAREST: "pbn.algorithms.assignment.average_nearest:AverageNearestColorAssignment",
+    },
+    RenderingEnum: {
+        RenderingEnum.COLORED: "pbn.algorithms.rendering.colored:ColoredRendering",
+    },
+}
+
+# Entry point groups in which other packages can register algorithms for each stage, e.g. in pyproject.toml:
+#   [project.entry-points."pbn.segmentation"]
+#   slic = "my_package.slic:SLICSegmentation"
+ENTRY_POINT_GROUPS: Dict[Type[StrEnum], str] = {
+    PreprocessingEnum: "pbn.preprocessing",
+    SegmentationEnum: "pbn.segmentation",
+    PostprocessingEnum: "pbn.postprocessing",
+    AssignmentEnum: "pbn.assignment",
+    RenderingEnum: "pbn.rendering",
 }
+
+
+def import_path(path: str) -> Any:
+    """Import the object named by a "module:attribute" path."""
+    module_name, _, attribute = path.partition(":")
+    return getattr(import_module(module_name), attribute)
+
+
+class AlgorithmRegistry(Mapping[str, Type[Any]]):
+    """Maps algorithm names to algorithm classes, importing each class on first use.
+
+    Names are looked up per stage: an enum value only matches algorithms of its own stage, so
+    PreprocessingEnum.NONE and PostprocessingEnum.NONE map to different classes. A plain string is
+    looked up in every stage. Besides the built-in algorithms, the registry holds the plugins that other packages
+    register through entry points. Plugins are only searched for when a name is not built in or when the
+    registry is listed."""
+
+    def __init__(self, paths: Dict[Type[StrEnum], Dict[str, str]]):
+        self.paths = {stage: dict(paths.get(stage, {})) for stage in ENTRY_POINT_GROUPS}
+        self.classes: Dict[Tuple[Type[StrEnum], str], Type[Any]] = {}
+        self.plugins: Optional[Dict[Type[StrEnum], Dict[str, str]]] = None
+
+    def load(self, stage: Type[StrEnum], name: str) -> Type[Any]:
+        """Return the class of the named algorithm of a stage, importing it if needed."""
+        key = (stage, str(name))
+        if key not in self.classes:
+            path = self.paths[stage].get(name) or self._discover()[stage].get(name)
+            if path is None:
+                raise KeyError(name)
+            self.classes[key] = import_path(path)
+        return self.classes[key]
+
+    def stage_of(self, name: str) -> Type[StrEnum]:
+        """Return the stage enum of an algorithm name; the first stage that has it for plain strings."""
+        if type(name) in ENTRY_POINT_GROUPS:
+            return type(name)  # type: ignore[return-value]
+        for stage in ENTRY_POINT_GROUPS:
+            if name in self.paths[stage]:
+                return stage
+        for stage, plugins in self._discover().items():
+            if name in plugins:
+                return stage
+        raise KeyError(name)
+
+    def names(self, stage: Type[StrEnum]) -> List[str]:
+        """The names of the built-in and plugin algorithms of a stage."""
+        return [*self.paths[stage], *(name for name in self._discover()[stage] if name not in self.paths[stage])]
+
+    def __getitem__(self, name: str) -> Type[Any]:
+        return self.load(self.stage_of(name), name)
+
+    def __iter__(self) -> Iterator[str]:
+        for stage in ENTRY_POINT_GROUPS:
+            yield from self.names(stage)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __contains__(self, name: object) -> bool:
+        if not isinstance(name, str):
+            return False
+        try:
+            self.stage_of(name)
+        except KeyError:
+            return False
+        return True
+
+    def _discover(self) -> Dict[Type[StrEnum], Dict[str, str]]:
+        if self.plugins is None:
+            from importlib.metadata import entry_points
+
+            self.plugins = {
+                stage: {ep.name: ep.value for ep in entry_points(group=group)}
+                for stage, group in ENTRY_POINT_GROUPS.items()
+            }
+        return self.plugins
+
+
+ALGORITHM_MAP = AlgorithmRegistry(ALGORITHM_PATHS)
@@ -1,7 +1,23 @@
-from .colored import ColoredRendering
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .base import SegmentRenderingAlgorithm
 
+if TYPE_CHECKING:
+    from .colored import ColoredRendering
+
+# Algorithms are imported on first access, so that importing the package does not import their dependencies.
+_MODULES = {
+    "ColoredRendering": "colored",
+}
+
 __all__ = [
-    "ColoredRendering",
     "SegmentRenderingAlgorithm",
+    "ColoredRendering",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _MODULES:
+        return getattr(import_module(f".{_MODULES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
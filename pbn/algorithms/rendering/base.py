@@ -1,8 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Tuple, Iterator, Optional
 from PIL import Image
+import numpy as np
 
-from pbn.datatypes import Color, ColoredSegmentedImage
+from pbn.datatypes import Color, ColoredSegmentedImage, Palette
+from pbn.backends import BackendEnum
+from pbn.memory import IMAGE_BYTES_PER_PIXEL
 
 
 class SegmentRenderingAlgorithm(ABC):
@@ -10,9 +13,40 @@ class SegmentRenderingAlgorithm(ABC):
 
     name: str
     params: Dict[str, Any] = {}
+    # The implementations the algorithm can run with, selected per run (see pbn.backends).
+    backends: Tuple[BackendEnum, ...] = (BackendEnum.FAST,)
 
     @abstractmethod
     def render(self, colored_segments: ColoredSegmentedImage) -> Image.Image | Tuple[Image.Image, Dict[int, Color]]:
         """Render the colored segments. E.g. add color numbers for each segment or render colored image.
         Returns image and optionally a color map."""
         pass
+
+    def render_bands(self, colored_segments: ColoredSegmentedImage, band_height: int) -> Iterator[np.ndarray]:
+        """Render the colored segments as consecutive RGB row bands of at most band_height rows.
+        The default renders the full image and slices it. Override to bound memory by the band height."""
+        if band_height < 1:
+            raise ValueError("band_height must be >= 1")
+        result = self.render(colored_segments)
+        image = result if isinstance(result, Image.Image) else result[0]
+        pixels = np.asarray(image.convert("RGB"))
+        for y0 in range(0, pixels.shape[0], band_height):
+            yield pixels[y0 : y0 + band_height]
+
+    def render_indexed(self, colored_segments: ColoredSegmentedImage, palette: Palette) -> Optional[Image.Image]:
+        """Render the colored segments as a palette-indexed (mode "P") image whose palette starts with the given
+        palette, so that np.asarray() of it gives every pixel's palette index. Returns None when this algorithm
+        cannot render indices or more than 256 colors are needed, in which case render() is used."""
+        return None
+
+    def render_indexed_bands(
+        self, colored_segments: ColoredSegmentedImage, palette: Palette, band_height: int
+    ) -> Optional[Tuple[Palette, Iterator[np.ndarray]]]:
+        """Like render_indexed(), as the colors of the indices and consecutive (rows, width) uint8 index bands of
+        at most band_height rows."""
+        return None
+
+    def estimate_memory(self, width: int, height: int, band_height: Optional[int] = None) -> int:
+        """Estimate the peak bytes that rendering segments of this size allocates, in bands when band_height is
+        given. The default renders the full image, also when rendering in bands."""
+        return 2 * width * height * IMAGE_BYTES_PER_PIXEL
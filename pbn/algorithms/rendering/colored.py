@@ -1,6 +1,12 @@
+from typing import Dict, Iterator, Optional, Tuple
 from PIL import Image
+import numpy as np
 
-from pbn.datatypes import ColoredSegmentedImage
+from pbn.backends import BackendEnum, get_backend
+from pbn.datatypes import Color, ColoredSegmentedImage, Palette
+from pbn.memory import IMAGE_BYTES_PER_PIXEL
+from pbn.parallel import concatenate_rows
+from pbn.writer import MAX_INDEXED_COLORS, indexed_image
 from pbn.algorithms.enums import RenderingEnum
 from .base import SegmentRenderingAlgorithm
 
@@ -9,16 +15,117 @@ class ColoredRendering(SegmentRenderingAlgorithm):
     """Abstract base class for segment rendering algorithms."""
 
     name = RenderingEnum.COLORED
+    backends = (BackendEnum.FAST, BackendEnum.REFERENCE)
 
     def render(self, colored_segments: ColoredSegmentedImage) -> Image.Image:
-        """Render the colored segments by coloring in the segments."""
-        output = Image.new("RGB", (colored_segments.width, colored_segments.height))
-        out_pixels = output.load()
-        if out_pixels is None:
-            raise ValueError("Failed to load image pixels.")
+        """Render the colored segments by coloring in the segments, in row bands on the shared thread pool. The
+        reference backend colors in the pixels of every segment one by one."""
+        if get_backend() == BackendEnum.REFERENCE:
+            image = Image.new("RGB", (colored_segments.width, colored_segments.height))
+            canvas = image.load()
+            if canvas is None:
+                raise ValueError("Failed to load image pixels.")
+            for segment in colored_segments.segments:
+                for x, y in segment.pixels:
+                    canvas[x, y] = segment.color
+            return image
 
+        lookup, offset = self._color_lookup(colored_segments)
+        labels = colored_segments.labels
+
+        def band(y0: int, y1: int) -> np.ndarray:
+            rows = np.array(labels[y0:y1], dtype=np.int64).reshape(y1 - y0, colored_segments.width)
+            return lookup[rows - offset]
+
+        pixels = concatenate_rows(band, colored_segments.height, colored_segments.width)
+        return Image.fromarray(pixels.reshape(colored_segments.height, colored_segments.width, 3), "RGB")
+
+    def render_bands(self, colored_segments: ColoredSegmentedImage, band_height: int) -> Iterator[np.ndarray]:
+        """Render the colored segments band by band from the label map, so only one band of RGB is held at a time."""
+        if band_height < 1:
+            raise ValueError("band_height must be >= 1")
+        lookup, offset = self._color_lookup(colored_segments)
+
+        for y0 in range(0, colored_segments.height, band_height):
+            rows = np.array(colored_segments.labels[y0 : y0 + band_height], dtype=np.int64)
+            yield lookup[rows - offset]
+
+    def render_indexed(self, colored_segments: ColoredSegmentedImage, palette: Palette) -> Optional[Image.Image]:
+        """Map every label to the palette index of its segment's color, in row bands on the shared thread pool."""
+        index_lookup = self._index_lookup(colored_segments, palette)
+        if index_lookup is None:
+            return None
+        lookup, offset, colors = index_lookup
+        labels = colored_segments.labels
+
+        def band(y0: int, y1: int) -> np.ndarray:
+            rows = np.array(labels[y0:y1], dtype=np.int64).reshape(y1 - y0, colored_segments.width)
+            return lookup[rows - offset]
+
+        return indexed_image(concatenate_rows(band, colored_segments.height, colored_segments.width), colors)
+
+    def render_indexed_bands(
+        self, colored_segments: ColoredSegmentedImage, palette: Palette, band_height: int
+    ) -> Optional[Tuple[Palette, Iterator[np.ndarray]]]:
+        if band_height < 1:
+            raise ValueError("band_height must be >= 1")
+        index_lookup = self._index_lookup(colored_segments, palette)
+        if index_lookup is None:
+            return None
+        lookup, offset, colors = index_lookup
+
+        def bands() -> Iterator[np.ndarray]:
+            for y0 in range(0, colored_segments.height, band_height):
+                rows = np.array(colored_segments.labels[y0 : y0 + band_height], dtype=np.int64)
+                yield lookup[rows - offset]
+
+        return colors, bands()
+
+    def estimate_memory(self, width: int, height: int, band_height: Optional[int] = None) -> int:
+        """The full output image, or one band of labels and RGB when rendering in bands."""
+        if band_height:
+            return min(band_height, height) * width * (8 + 3)
+        return width * height * IMAGE_BYTES_PER_PIXEL
+
+    @staticmethod
+    def _color_lookup(colored_segments: ColoredSegmentedImage) -> Tuple[np.ndarray, int]:
+        """Build a table mapping (label - offset) to the segment color. Unlabeled pixels (-1) stay black."""
+        ids = [segment.id for segment in colored_segments.segments]
+        offset = min([-1, *ids])
+        lookup = np.zeros((max([-1, *ids]) - offset + 1, 3), dtype=np.uint8)
+        for segment in colored_segments.segments:
+            lookup[segment.id - offset] = segment.color
+        return lookup, offset
+
+    @staticmethod
+    def _index_lookup(
+        colored_segments: ColoredSegmentedImage, palette: Palette
+    ) -> Optional[Tuple[np.ndarray, int, Palette]]:
+        """Build a table mapping (label - offset) to the palette index of the segment color, and the colors of the
+        indices: the palette followed by the segment colors that are not in it and black for unlabeled pixels
+        (-1) when needed. None when that is more than MAX_INDEXED_COLORS colors."""
+        colors = list(palette)
+        indices: Dict[Color, int] = {}
+        for index, color in enumerate(colors):
+            indices.setdefault(color, index)
+
+        def index_of(color: Color) -> int:
+            if color not in indices:
+                indices[color] = len(colors)
+                colors.append(color)
+            return indices[color]
+
+        ids = [segment.id for segment in colored_segments.segments]
+        offset = min([-1, *ids])
+        lookup = np.zeros(max([-1, *ids]) - offset + 1, dtype=np.int64)
         for segment in colored_segments.segments:
-            for x, y in segment.pixels:
-                out_pixels[x, y] = segment.color
+            lookup[segment.id - offset] = index_of(segment.color)
+        # Labels without a segment, such as unlabeled pixels, are black like in render().
+        covered = np.zeros(len(lookup), dtype=bool)
+        covered[[segment_id - offset for segment_id in ids]] = True
+        if not covered.all():
+            lookup[~covered] = index_of((0, 0, 0))
 
-        return output
\ No newline at end of file
+        if len(colors) > MAX_INDEXED_COLORS:
+            return None
+        return lookup.astype(np.uint8), offset, colors
@@ -1,9 +1,29 @@
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .base import ImageSegmentationAlgorithm
-from .grid_segmentation import GridImageSegmentation
-from .voronoi import VoronoiImageSegmentation
-from .kmeans import KMeansImageSegmentation
-from .watershed import WatershedImageSegmentation
-from .lab_watershed import LABWatershedSegmentation
+
+if TYPE_CHECKING:
+    from .grid_segmentation import GridImageSegmentation
+    from .voronoi import VoronoiImageSegmentation
+    from .kmeans import KMeansImageSegmentation
+    from .watershed import WatershedImageSegmentation
+    from .lab_watershed import LABWatershedSegmentation
+    from .downscaled import DownscaledSegmentation
+    from .warm_start import WarmStartSegmentation
+    from .connectivity import ConnectedSegmentation
+
+# Algorithms are imported on first access, so that importing the package does not import their dependencies.
+_MODULES = {
+    "GridImageSegmentation": "grid_segmentation",
+    "VoronoiImageSegmentation": "voronoi",
+    "KMeansImageSegmentation": "kmeans",
+    "WatershedImageSegmentation": "watershed",
+    "LABWatershedSegmentation": "lab_watershed",
+    "DownscaledSegmentation": "downscaled",
+    "WarmStartSegmentation": "warm_start",
+    "ConnectedSegmentation": "connectivity",
+}
 
 __all__ = [
     "ImageSegmentationAlgorithm",
@@ -12,4 +32,13 @@ __all__ = [
     "KMeansImageSegmentation",
     "WatershedImageSegmentation",
     "LABWatershedSegmentation",
+    "DownscaledSegmentation",
+    "WarmStartSegmentation",
+    "ConnectedSegmentation",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _MODULES:
+        return getattr(import_module(f".{_MODULES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,26 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
 from PIL import Image
+import numpy as np
 
 from pbn.datatypes import SegmentedImage
+from pbn.backends import BackendEnum
+from pbn.memory import segments_bytes
+
+
+@dataclass(frozen=True)
+class TunableParameter:
+    """A parameter that the number of segments changes monotonically with, which auto-tuning can search.
+    Without a high bound, the search is bounded by the image: its longer side for spatial parameters and its
+    number of pixels otherwise. Spatial parameters are in pixels and are scaled along with the image."""
+
+    name: str
+    low: float
+    high: Optional[float] = None
+    integer: bool = True
+    more_segments: bool = True
+    spatial: bool = False
 
 
 class ImageSegmentationAlgorithm(ABC):
@@ -10,8 +28,52 @@ class ImageSegmentationAlgorithm(ABC):
 
     name: str
     params: Dict[str, Any] = {}
+    # The implementations the algorithm can run with, selected per run (see pbn.backends).
+    backends: Tuple[BackendEnum, ...] = (BackendEnum.FAST,)
+    # The parameters auto-tuning can search, the default one first.
+    tunable: Tuple[TunableParameter, ...] = ()
 
     @abstractmethod
     def segment(self, image: Image.Image) -> SegmentedImage:
         """Segment an image into regions (return labels, masks, polygons, etc.)."""
         pass
+
+    def prepare(self, image: Image.Image) -> Any:
+        """Compute what segmentation derives from the image regardless of the tunable parameters, e.g. a gradient
+        or the pixel features. Auto-tuning prepares a probe image once and segments it with many parameter values
+        using segment_prepared(). Algorithms without such a step prepare nothing."""
+        return None
+
+    def segment_prepared(self, image: Image.Image, prepared: Any) -> SegmentedImage:
+        """Segment an image with the result of prepare() on it, by an instance with the same non-tunable
+        parameters."""
+        return self.segment(image)
+
+    def with_params(self, **changes: Any) -> "ImageSegmentationAlgorithm":
+        """A new instance of the algorithm with some parameters changed."""
+        return type(self)(**{**self.params, **changes})
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        """Segment a full-resolution image, warm-started from the segmentation of a downscaled preview of it.
+        Algorithms that cannot reuse the preview segment the image from scratch."""
+        return self.segment(image)
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """Estimate the peak bytes that segmenting an image of this size allocates, including the segments.
+        The default assumes a few per-pixel arrays next to the segment representation."""
+        return width * height * 4 * 8 + segments_bytes(width, height)
+
+
+def upscale_labels(labels: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Scale a label map up to width x height, giving every pixel the label of the pixel it maps to."""
+    small_height, small_width = labels.shape
+    ys = np.arange(height) * small_height // height
+    xs = np.arange(width) * small_width // width
+    return labels[np.ix_(ys, xs)]
+
+
+def label_means(features: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """The mean feature vector of every label, ordered by label."""
+    _, inverse, counts = np.unique(labels.reshape(-1), return_inverse=True, return_counts=True)
+    sums = np.stack([np.bincount(inverse, weights=column) for column in features.T], axis=1)
+    return sums / counts[:, None]
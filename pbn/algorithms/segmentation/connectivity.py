@@ -0,0 +1,124 @@
+from typing import Any, Tuple
+from PIL import Image
+import numpy as np
+
+from pbn.datatypes import SegmentedImage
+from pbn.profiling import record
+from .base import ImageSegmentationAlgorithm
+
+
+def enforce_connectivity(labels: np.ndarray, min_size: int = 0, connectivity: int = 1) -> Tuple[np.ndarray, int]:
+    """Split every label of a label map into its connected components and absorb the components smaller than
+    min_size pixels into the neighbor they share the longest border with. Returns the new label map, numbered
+    0..n-1 in raster order of the components, and the number of absorbed components. Unlabeled pixels (-1) stay -1.
+
+    All labels are split in one labeling pass over the whole map, which labels the connected regions of equal
+    values. Small components are absorbed in rounds: every round, each one joins its neighbor with the longest
+    border, chains and groups of joining components are resolved at once as the connected components of the
+    join graph, and the rounds end when no small component has a neighbor left."""
+    # Imported here because the CLI imports this module, and scipy and skimage would slow down every start of it.
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from skimage.measure import label
+
+    if connectivity not in (1, 2):
+        raise ValueError("connectivity must be 1 or 2")
+    components: np.ndarray = label(labels, background=-1, connectivity=connectivity)
+    count = int(components.max())
+    absorbed = 0
+
+    while min_size > 1 and count > 1:
+        sizes = np.bincount(components.ravel(), minlength=count + 1)
+        small = sizes < min_size
+        small[0] = False
+        if not small.any():
+            break
+
+        # Every pair of 4-neighbors in different components adds one to the border between them. The pairs are
+        # packed into one integer each, small component first, to count them.
+        first_pixels = np.concatenate([components[:, :-1].ravel(), components[:-1, :].ravel()])
+        second_pixels = np.concatenate([components[:, 1:].ravel(), components[1:, :].ravel()])
+        different = (first_pixels != second_pixels) & (first_pixels > 0) & (second_pixels > 0)
+        a, b = first_pixels[different], second_pixels[different]
+        sources, targets = np.concatenate([a, b]), np.concatenate([b, a])
+        from_small = small[sources]
+        keys = sources[from_small] * (count + 1) + targets[from_small]
+        if len(keys) == 0:
+            break
+        keys, lengths = np.unique(keys, return_counts=True)
+
+        # The longest border of every small component, the first neighbor on ties.
+        sources, targets = keys // (count + 1), keys % (count + 1)
+        order = np.lexsort((-lengths, sources))
+        sources, targets = sources[order], targets[order]
+        first = np.concatenate([[True], sources[1:] != sources[:-1]])
+        sources, targets = sources[first], targets[first]
+
+        graph = coo_matrix((np.ones(len(sources)), (sources, targets)), shape=(count + 1, count + 1))
+        _, groups = connected_components(graph, directed=False)
+        # Renumber the groups 1..n in order of their first component, with 0 staying unlabeled.
+        _, first_component, inverse = np.unique(groups[1:], return_index=True, return_inverse=True)
+        rank = np.empty(len(first_component), dtype=np.int64)
+        rank[np.argsort(first_component)] = np.arange(1, len(first_component) + 1)
+        mapping = np.concatenate([[0], rank[inverse.ravel()]])
+
+        components = mapping[components]
+        absorbed += count - len(first_component)
+        count = len(first_component)
+
+    return components.astype(np.int64) - 1, absorbed
+
+
+class ConnectedSegmentation(ImageSegmentationAlgorithm):
+    """Runs another segmentation algorithm and splits its segments into their connected parts.
+
+    Segmentations that cluster pixels by color and position, such as kmeans and voronoi, give segments of many
+    scattered islands. With min_size, islands smaller than that many pixels are absorbed into the neighbor they
+    share the longest border with instead of becoming segments of their own."""
+
+    def __init__(self, algorithm: ImageSegmentationAlgorithm, min_size: int = 0, connectivity: int = 1):
+        if min_size < 0:
+            raise ValueError("min_size must be non-negative")
+        if connectivity not in (1, 2):
+            raise ValueError("connectivity must be 1 or 2")
+        self.algorithm = algorithm
+        self.min_size = min_size
+        self.connectivity = connectivity
+        self.name = algorithm.name
+        self.params = {**algorithm.params, "enforce_connectivity": connectivity}
+        if min_size:
+            self.params["min_island_size"] = min_size
+        self.tunable = algorithm.tunable
+        self.backends = algorithm.backends
+
+    def segment(self, image: Image.Image) -> SegmentedImage:
+        return self._split(self.algorithm.segment(image))
+
+    def prepare(self, image: Image.Image) -> Any:
+        return self.algorithm.prepare(image)
+
+    def segment_prepared(self, image: Image.Image, prepared: Any) -> SegmentedImage:
+        return self._split(self.algorithm.segment_prepared(image, prepared))
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        return self._split(self.algorithm.refine(image, preview_image, preview))
+
+    def with_params(self, **changes: Any) -> ImageSegmentationAlgorithm:
+        return ConnectedSegmentation(self.algorithm.with_params(**changes), self.min_size, self.connectivity)
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The wrapped algorithm, or the component map and the neighbor pairs of the absorbing rounds, whichever
+        is larger."""
+        return max(self.algorithm.estimate_memory(width, height), width * height * 8 * 10)
+
+    def _split(self, segmented: SegmentedImage) -> SegmentedImage:
+        labels = np.array(segmented.labels, dtype=np.int64).reshape(segmented.height, segmented.width)
+        connected, absorbed = enforce_connectivity(labels, self.min_size, self.connectivity)
+        record("components", int(connected.max()) + 1 + absorbed)
+        record("islands_absorbed", absorbed)
+
+        result = SegmentedImage.from_labels(connected.tolist())
+        result.metadata.update(segmented.metadata)
+        result.metadata.update(self.params)
+        result.metadata["num_segments"] = int(connected.max()) + 1
+        return result
@@ -0,0 +1,60 @@
+from typing import Any, Tuple
+import numpy as np
+from PIL import Image
+
+from pbn.datatypes import SegmentedImage
+from pbn.memory import IMAGE_BYTES_PER_PIXEL, segments_bytes
+from .base import ImageSegmentationAlgorithm, upscale_labels
+
+
+class DownscaledSegmentation(ImageSegmentationAlgorithm):
+    """Runs another segmentation algorithm on a downscaled copy of the image and scales the labels back up.
+
+    Used to fit a segmentation into a memory budget: the wrapped algorithm only works on the smaller image.
+    Segment boundaries become blockier by 1 / scale pixels."""
+
+    def __init__(self, algorithm: ImageSegmentationAlgorithm, scale: float):
+        if not 0 < scale < 1:
+            raise ValueError("scale must be in (0, 1)")
+        self.algorithm = algorithm
+        self.name = algorithm.name
+        self.params = {**algorithm.params, "downscale": scale}
+        self.backends = algorithm.backends
+
+    def segment(self, image: Image.Image) -> SegmentedImage:
+        """Segment the downscaled image and map every full-size pixel to the label of its downscaled pixel."""
+        return self._upscale(self.algorithm.segment(self._downscale(image)), *image.size)
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        """Refine the downscaled image from the preview with the wrapped algorithm and scale the labels up."""
+        return self._upscale(self.algorithm.refine(self._downscale(image), preview_image, preview), *image.size)
+
+    def with_params(self, **changes: Any) -> ImageSegmentationAlgorithm:
+        return DownscaledSegmentation(self.algorithm.with_params(**changes), self.params["downscale"])
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The wrapped algorithm on the small image, plus the full-size label map and segments."""
+        small_width, small_height = self._small_size(width, height)
+        return (
+            self.algorithm.estimate_memory(small_width, small_height)
+            + small_width * small_height * IMAGE_BYTES_PER_PIXEL
+            + width * height * 8
+            + segments_bytes(width, height)
+        )
+
+    def _downscale(self, image: Image.Image) -> Image.Image:
+        return image.resize(self._small_size(*image.size), Image.Resampling.BOX)
+
+    def _upscale(self, small_segments: SegmentedImage, width: int, height: int) -> SegmentedImage:
+        """Map every full-size pixel to the label of its downscaled pixel."""
+        labels_array = upscale_labels(np.array(small_segments.labels, dtype=np.int64), width, height)
+
+        segmented = SegmentedImage.from_labels(labels_array.tolist())
+        segmented.metadata.update(small_segments.metadata)
+        segmented.metadata["downscale"] = self.params["downscale"]
+
+        return segmented
+
+    def _small_size(self, width: int, height: int) -> Tuple[int, int]:
+        scale = self.params["downscale"]
+        return max(1, round(width * scale)), max(1, round(height * scale))
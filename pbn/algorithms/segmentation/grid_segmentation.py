@@ -1,15 +1,23 @@
 from typing import List, Tuple
 from PIL import Image
+import numpy as np
 
+from pbn.backends import BackendEnum, get_backend, group_pixels
 from pbn.datatypes import SegmentedImage, Segment
-from .base import ImageSegmentationAlgorithm
+from pbn.memory import grouped_segments_bytes
+from .base import ImageSegmentationAlgorithm, TunableParameter
 from pbn.algorithms.enums import SegmentationEnum
 
+# A Segment with its pixel list, and its entry in the segment lists and dictionaries.
+SEGMENT_OBJECT_BYTES = 220
+
 
 class GridImageSegmentation(ImageSegmentationAlgorithm):
     """Segments an image into a regular grid of square pixel blocks."""
 
     name = SegmentationEnum.GRID
+    backends = (BackendEnum.FAST, BackendEnum.REFERENCE)
+    tunable = (TunableParameter("cell_size", 1, more_segments=False, spatial=True),)
 
     def __init__(self, cell_size: int = 1):
         """Initialize grid segmentation with a given square cell size."""
@@ -18,7 +26,26 @@ class GridImageSegmentation(ImageSegmentationAlgorithm):
         self.params = {"cell_size": cell_size}
 
     def segment(self, image: Image.Image) -> SegmentedImage:
-        """Segment the image into grid-aligned square regions."""
+        """Segment the image into grid-aligned square regions, numbered row by row. The fast backend computes the
+        label of every pixel from its cell at once; the reference backend visits the cells one by one."""
+        if get_backend() == BackendEnum.REFERENCE:
+            return self._segment_reference(image)
+
+        width, height = image.size
+        cell_size: int = self.params["cell_size"]
+        columns = -(-width // cell_size)
+        rows = -(-height // cell_size)
+        labels = (np.arange(height)[:, None] // cell_size) * columns + np.arange(width)[None, :] // cell_size
+        cells = group_pixels(labels, rows * columns)
+
+        segmented = SegmentedImage.from_segments(
+            [Segment(id=segment_id, pixels=pixels) for segment_id, pixels in enumerate(cells)], width, height
+        )
+        segmented.metadata["algorithm"] = "grid"
+        segmented.metadata.update(self.params)
+        return segmented
+
+    def _segment_reference(self, image: Image.Image) -> SegmentedImage:
         width, height = image.size
 
         labels: List[List[int]] = [[-1 for _ in range(width)] for _ in range(height)]
@@ -42,3 +69,9 @@ class GridImageSegmentation(ImageSegmentationAlgorithm):
         segmented.metadata.update(self.params)
 
         return segmented
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """Every cell becomes a Segment object, which dominates for small cells."""
+        cell_size: int = self.params["cell_size"]
+        num_cells = -(-width // cell_size) * -(-height // cell_size)
+        return grouped_segments_bytes(width, height) + 2 * num_cells * SEGMENT_OBJECT_BYTES
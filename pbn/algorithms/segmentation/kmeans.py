@@ -1,22 +1,34 @@
 import numpy as np
 from PIL import Image
 from sklearn.cluster import KMeans
-from typing import Optional
+from typing import Optional, Union
 
 from pbn.datatypes import SegmentedImage
-from .base import ImageSegmentationAlgorithm
+from pbn.histogram import ColorHistogram
+from pbn.memory import FEATURE_BUILD_BYTES_PER_PIXEL, FEATURE_BYTES_PER_PIXEL, segments_bytes
+from .base import ImageSegmentationAlgorithm, TunableParameter, label_means
 from pbn.algorithms.enums import SegmentationEnum
 
 
+# Peak bytes per fitted pixel of scikit-learn's k-means fit, and per pixel of its prediction, as measured with
+# tracemalloc: the fit copies and centers the features and keeps their squared norms, weights and labels.
+FIT_BYTES_PER_PIXEL = 130
+PREDICT_BYTES_PER_PIXEL = 12
+
+
 class KMeansImageSegmentation(ImageSegmentationAlgorithm):
     """Image segmentation using k-means clustering on color and position.
     
     The points used are pixel coordinates and RGB-colors, creating a 5D space.
     A downside of the 5D approach is that segments are not necessarily contiguous
     in just its pixel coordinates. This results in seemingly more segments.
+    With fit_samples, the clusters are fitted on a random sample of that many pixels
+    and every pixel is then assigned to its nearest cluster, which bounds memory use.
+    With spatial_weight=0, the clusters are fitted on the distinct colors weighted by their counts.
     """
 
     name = SegmentationEnum.KMEANS
+    tunable = (TunableParameter("num_clusters", 1, 256),)
 
     def __init__(
         self,
@@ -24,19 +36,71 @@ class KMeansImageSegmentation(ImageSegmentationAlgorithm):
         spatial_weight: float = 1.0,
         color_weight: float = 1.0,
         seed: Optional[int] = None,
+        fit_samples: Optional[int] = None,
     ):
+        if fit_samples is not None and fit_samples < num_clusters:
+            raise ValueError("fit_samples must be at least num_clusters")
+
         self.params = {
             "num_clusters": num_clusters,
             "spatial_weight": spatial_weight,
             "color_weight": color_weight,
             "seed": seed,
         }
+        # Only part of the parameters when used, so that the output names of full fits stay the same.
+        if fit_samples is not None:
+            self.params["fit_samples"] = fit_samples
 
     def segment(self, image: Image.Image) -> SegmentedImage:
         """Segment an image into regions (return labels, masks, polygons, etc.)."""
         if image.mode != "RGB":
             raise ValueError("Image must be RGB")
 
+        # Fit k-means using library
+        kmeans = KMeans(
+            n_clusters=self.params["num_clusters"],
+            random_state=self.params["seed"],
+            n_init=10,
+        )
+        return self._cluster(kmeans, image)
+
+    def prepare(self, image: Image.Image) -> Union[ColorHistogram, np.ndarray]:
+        """The distinct colors with spatial_weight=0, the pixel features otherwise. Neither depends on the number
+        of clusters."""
+        if self.params["spatial_weight"] == 0:
+            return ColorHistogram.from_image(image)
+        return self._features(image)
+
+    def segment_prepared(self, image: Image.Image, prepared: Union[ColorHistogram, np.ndarray]) -> SegmentedImage:
+        kmeans = KMeans(
+            n_clusters=self.params["num_clusters"],
+            random_state=self.params["seed"],
+            n_init=10,
+        )
+        return self._cluster(kmeans, image, prepared)
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        """Start k-means from the cluster centers of the preview. The features are relative to the image size,
+        so the centers carry over, and a single run from them replaces the ten random initializations."""
+        if image.mode != "RGB":
+            raise ValueError("Image must be RGB")
+
+        centers = label_means(self._features(preview_image), np.array(preview.labels))
+        if len(centers) != self.params["num_clusters"]:
+            return self.segment(image)
+
+        kmeans = KMeans(
+            n_clusters=self.params["num_clusters"],
+            random_state=self.params["seed"],
+            init=centers,
+            n_init=1,
+        )
+        segmented = self._cluster(kmeans, image)
+        segmented.metadata["warm_start"] = True
+        return segmented
+
+    def _features(self, image: Image.Image) -> np.ndarray:
+        """The weighted [x, y, r, g, b] features of every pixel, with coordinates relative to the image size."""
         pixels = np.array(image, dtype=float)
         height, width, _ = pixels.shape
 
@@ -50,17 +114,53 @@ class KMeansImageSegmentation(ImageSegmentationAlgorithm):
 
         # Stack features: [x, y, r, g, b]
         features = np.dstack((xs, ys, colors))
-        flat_features = features.reshape(-1, 5)
+        return features.reshape(-1, 5)
 
-        # Fit k-means using library
-        kmeans = KMeans(
-            n_clusters=self.params["num_clusters"],
-            random_state=self.params["seed"],
-            n_init=10,
-        )
-        kmeans.fit(flat_features)
-        labels_array = kmeans.labels_.reshape(height, width)
+    def _cluster(
+        self, kmeans: KMeans, image: Image.Image, prepared: Optional[Union[ColorHistogram, np.ndarray]] = None
+    ) -> SegmentedImage:
+        height, width = image.height, image.width
+        if prepared is None:
+            prepared = self.prepare(image)
+        if isinstance(prepared, ColorHistogram):
+            prepared.record()
+            # k-means needs at least as many distinct points as clusters.
+            if len(prepared.colors) >= self.params["num_clusters"]:
+                return self._finish(self._cluster_colors(kmeans, prepared).reshape(height, width))
+            prepared = self._features(image)
+
+        flat_features = prepared
+        fit_samples = self.params.get("fit_samples")
+        if fit_samples is not None and fit_samples < len(flat_features):
+            rng = np.random.default_rng(self.params["seed"])
+            sample = flat_features[rng.choice(len(flat_features), fit_samples, replace=False)]
+            kmeans.fit(sample)
+            labels_array = kmeans.predict(flat_features).reshape(height, width)
+        else:
+            kmeans.fit(flat_features)
+            labels_array = kmeans.labels_.reshape(height, width)
+        return self._finish(labels_array)
 
+    def _cluster_colors(self, kmeans: KMeans, histogram: ColorHistogram) -> np.ndarray:
+        """Without spatial features, pixels of the same color have the same features. The clusters are fitted on the
+        distinct colors weighted by their pixel counts, which minimizes the same objective, and the cluster of every
+        color is scattered back to its pixels."""
+        features = np.zeros((len(histogram.colors), 5))
+        features[:, 2:] = histogram.colors / 255 * self.params["color_weight"]
+        weights = histogram.counts
+
+        fit_samples = self.params.get("fit_samples")
+        if fit_samples is not None and fit_samples < len(features):
+            rng = np.random.default_rng(self.params["seed"])
+            sample = rng.choice(len(features), fit_samples, replace=False)
+            kmeans.fit(features[sample], sample_weight=weights[sample])
+            labels: np.ndarray = histogram.scatter(kmeans.predict(features))
+        else:
+            kmeans.fit(features, sample_weight=weights)
+            labels = histogram.scatter(kmeans.labels_)
+        return labels
+
+    def _finish(self, labels_array: np.ndarray) -> SegmentedImage:
         # Convert to list for type safety
         labels_list = labels_array.tolist()
         segmented = SegmentedImage.from_labels(labels_list)
@@ -68,3 +168,21 @@ class KMeansImageSegmentation(ImageSegmentationAlgorithm):
         segmented.metadata["algorithm"] = "kmeans"
 
         return segmented
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The largest of building the pixel features, fitting next to them (on a copied sample with fit_samples,
+        predicting every pixel afterwards), and building the segments while the features, the sample and the
+        labels are held."""
+        pixels = width * height
+        fit_pixels = min(self.params.get("fit_samples") or pixels, pixels)
+        held = pixels * FEATURE_BYTES_PER_PIXEL
+        if fit_pixels < pixels:
+            held += fit_pixels * FEATURE_BYTES_PER_PIXEL
+            fitting = max(fit_pixels * FIT_BYTES_PER_PIXEL, pixels * PREDICT_BYTES_PER_PIXEL)
+        else:
+            fitting = pixels * FIT_BYTES_PER_PIXEL
+        return max(
+            pixels * FEATURE_BUILD_BYTES_PER_PIXEL,
+            held + fitting,
+            held + pixels * 4 + segments_bytes(width, height, self.params["num_clusters"]),
+        )
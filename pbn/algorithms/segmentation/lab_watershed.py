@@ -7,7 +7,10 @@ from skimage.morphology import h_minima
 from skimage.feature import peak_local_max
 
 from pbn.datatypes import SegmentedImage
-from .base import ImageSegmentationAlgorithm
+from pbn.histogram import map_colors
+from pbn.memory import segments_bytes
+from .base import ImageSegmentationAlgorithm, TunableParameter
+from .watershed import preview_markers
 from pbn.algorithms.enums import SegmentationEnum
 
 
@@ -15,6 +18,10 @@ class LABWatershedSegmentation(ImageSegmentationAlgorithm):
     """Segment an image using watershed in perceptually uniform LAB color space."""
 
     name = SegmentationEnum.LAB_WATERSHED
+    tunable = (
+        TunableParameter("min_distance", 1, more_segments=False, spatial=True),
+        TunableParameter("h_minima_threshold", 0.0, 1.0, integer=False, more_segments=False),
+    )
 
     def __init__(
         self, connectivity: int = 1, compactness: float = 0.0, min_distance: int = 10, h_minima_threshold: float = 0.1
@@ -40,14 +47,35 @@ class LABWatershedSegmentation(ImageSegmentationAlgorithm):
         if image.mode != "RGB":
             raise ValueError("Image must be RGB")
 
-        img = np.asarray(image)
-        lab = rgb2lab(img)
+        return self.segment_prepared(image, self.prepare(image))
 
-        gradients = np.stack([sobel(lab[:, :, i]) for i in range(3)], axis=-1)
-        gradient = np.linalg.norm(gradients, axis=-1)
+    def prepare(self, image: Image.Image) -> np.ndarray:
+        """The gradient, which does not depend on the parameters."""
+        return self._gradient(image)
+
+    def segment_prepared(self, image: Image.Image, prepared: np.ndarray) -> SegmentedImage:
+        return self._watershed(prepared, self._generate_markers(prepared))
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        """Place a marker in every preview segment instead of searching the gradient for them."""
+        if image.mode != "RGB":
+            raise ValueError("Image must be RGB")
 
-        markers = self._generate_markers(gradient)
+        gradient = self._gradient(image)
+        markers = preview_markers(np.array(preview.labels), gradient)
+        segmented = self._watershed(gradient, markers)
+        segmented.metadata["warm_start"] = True
+        return segmented
+
+    def _gradient(self, image: Image.Image) -> np.ndarray:
+        # The conversion is pointwise, so it is done once per distinct color.
+        lab = map_colors(lambda colors: rgb2lab(colors[None])[0], np.asarray(image))
 
+        gradients = np.stack([sobel(lab[:, :, i]) for i in range(3)], axis=-1)
+        gradient: np.ndarray = np.linalg.norm(gradients, axis=-1)
+        return gradient
+
+    def _watershed(self, gradient: np.ndarray, markers: np.ndarray) -> SegmentedImage:
         labels_array = watershed(
             gradient, markers=markers, connectivity=self.params["connectivity"], compactness=self.params["compactness"]
         )
@@ -60,6 +88,10 @@ class LABWatershedSegmentation(ImageSegmentationAlgorithm):
 
         return segmented
 
+    def estimate_memory(self, width: int, height: int) -> int:
+        """LAB, per-channel gradients, gradient, h-minima, markers and label arrays of 8 bytes per pixel."""
+        return width * height * 13 * 8 + segments_bytes(width, height)
+
     def _generate_markers(self, gradient: np.ndarray) -> np.ndarray:
         """Generate markers from local minima in gradient with h-minima suppression."""
         h = self.params["h_minima_threshold"] * (gradient.max() - gradient.min())
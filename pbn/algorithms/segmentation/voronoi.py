@@ -4,7 +4,8 @@ from scipy.spatial import distance
 from typing import Optional
 
 from pbn.datatypes import SegmentedImage
-from .base import ImageSegmentationAlgorithm
+from pbn.memory import FEATURE_BUILD_BYTES_PER_PIXEL, FEATURE_BYTES_PER_PIXEL, segments_bytes
+from .base import ImageSegmentationAlgorithm, TunableParameter, label_means
 from pbn.algorithms.enums import SegmentationEnum
 
 
@@ -19,6 +20,10 @@ class VoronoiImageSegmentation(ImageSegmentationAlgorithm):
     """
 
     name = SegmentationEnum.VORONOI
+    tunable = (TunableParameter("num_seeds", 1),)
+
+    # When set, the distances to the seeds are computed for this many pixels at a time. The result is the same.
+    chunk_pixels: Optional[int] = None
 
     def __init__(
         self,
@@ -38,7 +43,35 @@ class VoronoiImageSegmentation(ImageSegmentationAlgorithm):
         if image.mode != "RGB":
             raise ValueError("Image must be RGB")
 
+        return self.segment_prepared(image, self.prepare(image))
+
+    def prepare(self, image: Image.Image) -> np.ndarray:
+        """The pixel features, which do not depend on the number of seeds."""
+        return self._features(image)
+
+    def segment_prepared(self, image: Image.Image, prepared: np.ndarray) -> SegmentedImage:
         rng = np.random.default_rng(self.params["seed"])
+        pixel_features = prepared
+
+        # Randomly pick seed points from all pixels
+        seed_indices = rng.choice(len(pixel_features), self.params["num_seeds"], replace=False)
+        seeds = pixel_features[seed_indices]
+
+        return self._assign(image, pixel_features, seeds)
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        """Use the mean features of the preview's cells as seeds, so that the cells keep their place and colors.
+        The features are relative to the image size, so they carry over to the full resolution."""
+        if image.mode != "RGB":
+            raise ValueError("Image must be RGB")
+
+        seeds = label_means(self._features(preview_image), np.array(preview.labels))
+        segmented = self._assign(image, self._features(image), seeds)
+        segmented.metadata["warm_start"] = True
+        return segmented
+
+    def _features(self, image: Image.Image) -> np.ndarray:
+        """The weighted [x, y, r, g, b] features of every pixel, with coordinates relative to the image size."""
         pixels = np.array(image, dtype=float)
         height, width, _ = pixels.shape
 
@@ -47,15 +80,16 @@ class VoronoiImageSegmentation(ImageSegmentationAlgorithm):
         xs = xs / width * self.params["spatial_weight"]
         ys = ys / height * self.params["spatial_weight"]
         colors = pixels / 255 * self.params["color_weight"]
-        pixel_features = np.dstack((xs, ys, colors)).reshape(-1, 5)
+        return np.dstack((xs, ys, colors)).reshape(-1, 5)
 
-        # Randomly pick seed points from all pixels
-        seed_indices = rng.choice(len(pixel_features), self.params["num_seeds"], replace=False)
-        seeds = pixel_features[seed_indices]
-
-        # Compute nearest seed for each pixel (vectorized)
-        dists = distance.cdist(pixel_features, seeds, metric="euclidean")
-        labels_array = np.argmin(dists, axis=1).reshape(height, width)
+    def _assign(self, image: Image.Image, pixel_features: np.ndarray, seeds: np.ndarray) -> SegmentedImage:
+        # Compute nearest seed for each pixel (vectorized, in chunks to bound the distance matrix)
+        chunk_pixels = self.chunk_pixels or len(pixel_features)
+        nearest_seeds = np.empty(len(pixel_features), dtype=np.int64)
+        for start in range(0, len(pixel_features), chunk_pixels):
+            dists = distance.cdist(pixel_features[start : start + chunk_pixels], seeds, metric="euclidean")
+            nearest_seeds[start : start + chunk_pixels] = np.argmin(dists, axis=1)
+        labels_array = nearest_seeds.reshape(image.height, image.width)
 
         # Convert to list for type safety
         labels_list = labels_array.tolist()
@@ -64,3 +98,19 @@ class VoronoiImageSegmentation(ImageSegmentationAlgorithm):
         segmented.metadata["algorithm"] = "voronoi"
 
         return segmented
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        """The largest of building the pixel features, computing the distances to the seeds next to them, and
+        building the segments while the features and the distances of the last chunk are still held. While a
+        chunk's distances are computed, those of the previous chunk are still held as well."""
+        pixels = width * height
+        chunk_pixels = min(self.chunk_pixels or pixels, pixels)
+        num_seeds: int = self.params["num_seeds"]
+        distances = chunk_pixels * num_seeds * 8
+        # The features and the nearest seed of every pixel.
+        held = pixels * (FEATURE_BYTES_PER_PIXEL + 8)
+        return max(
+            pixels * FEATURE_BUILD_BYTES_PER_PIXEL,
+            held + (2 if chunk_pixels < pixels else 1) * distances + chunk_pixels * 8,
+            held + distances + segments_bytes(width, height, num_seeds),
+        )
@@ -0,0 +1,38 @@
+from typing import Any, Optional, Tuple
+from PIL import Image
+
+from pbn.datatypes import SegmentedImage
+from .base import ImageSegmentationAlgorithm
+
+
+class WarmStartSegmentation(ImageSegmentationAlgorithm):
+    """Runs another segmentation algorithm on a preview first and warm-starts later segmentations from it.
+
+    The first image segmented is the preview: it is segmented from scratch and kept. Every later (full-resolution)
+    image is segmented with the wrapped algorithm's refine method from that preview."""
+
+    def __init__(self, algorithm: ImageSegmentationAlgorithm):
+        self.algorithm = algorithm
+        self.name = algorithm.name
+        self.params = {**algorithm.params, "warm_start": True}
+        self.backends = algorithm.backends
+        self.preview: Optional[Tuple[Image.Image, SegmentedImage]] = None
+
+    def segment(self, image: Image.Image) -> SegmentedImage:
+        if self.preview is None:
+            segmented = self.algorithm.segment(image)
+            self.preview = (image, segmented)
+            return segmented
+
+        preview_image, preview = self.preview
+        return self.algorithm.refine(image, preview_image, preview)
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        return self.algorithm.refine(image, preview_image, preview)
+
+    def with_params(self, **changes: Any) -> ImageSegmentationAlgorithm:
+        """The wrapped algorithm with the changed parameters, warm-started from a new preview."""
+        return WarmStartSegmentation(self.algorithm.with_params(**changes))
+
+    def estimate_memory(self, width: int, height: int) -> int:
+        return self.algorithm.estimate_memory(width, height)
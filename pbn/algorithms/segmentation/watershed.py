@@ -5,9 +5,12 @@ from skimage.filters import sobel
 from skimage.segmentation import watershed
 from skimage.morphology import h_minima
 from skimage.feature import peak_local_max
+from scipy import ndimage
+import math
 
 from pbn.datatypes import SegmentedImage
-from .base import ImageSegmentationAlgorithm
+from pbn.memory import segments_bytes
+from .base import ImageSegmentationAlgorithm, TunableParameter, upscale_labels
 from pbn.algorithms.enums import SegmentationEnum
 
 
@@ -15,6 +18,10 @@ class WatershedImageSegmentation(ImageSegmentationAlgorithm):
     """Segment an image using marker-based watershed segmentation."""
 
     name = SegmentationEnum.WATERSHED
+    tunable = (
+        TunableParameter("min_distance", 1, more_segments=False, spatial=True),
+        TunableParameter("h_minima_threshold", 0.0, 1.0, integer=False, more_segments=False),
+    )
 
     def __init__(
         self, connectivity: int = 1, compactness: float = 0.0, min_distance: int = 10, h_minima_threshold: float = 0.1
@@ -40,11 +47,34 @@ class WatershedImageSegmentation(ImageSegmentationAlgorithm):
         if image.mode != "RGB":
             raise ValueError("Image must be RGB")
 
+        return self.segment_prepared(image, self.prepare(image))
+
+    def prepare(self, image: Image.Image) -> np.ndarray:
+        """The gradient, which does not depend on the parameters."""
+        return self._gradient(image)
+
+    def segment_prepared(self, image: Image.Image, prepared: np.ndarray) -> SegmentedImage:
+        return self._watershed(prepared, self._generate_markers(prepared))
+
+    def refine(self, image: Image.Image, preview_image: Image.Image, preview: SegmentedImage) -> SegmentedImage:
+        """Place a marker in every preview segment instead of searching the gradient for them, which keeps the
+        segments of the preview and skips the h-minima transform."""
+        if image.mode != "RGB":
+            raise ValueError("Image must be RGB")
+
+        gradient = self._gradient(image)
+        markers = preview_markers(np.array(preview.labels), gradient)
+        segmented = self._watershed(gradient, markers)
+        segmented.metadata["warm_start"] = True
+        return segmented
+
+    def _gradient(self, image: Image.Image) -> np.ndarray:
         img = np.asarray(image)
         gray = rgb2gray(img)
-        gradient = sobel(gray)
-        markers = self._generate_markers(gradient)
+        gradient: np.ndarray = sobel(gray)
+        return gradient
 
+    def _watershed(self, gradient: np.ndarray, markers: np.ndarray) -> SegmentedImage:
         labels_array = watershed(
             gradient, markers=markers, connectivity=self.params["connectivity"], compactness=self.params["compactness"]
         )
@@ -57,6 +87,10 @@ class WatershedImageSegmentation(ImageSegmentationAlgorithm):
 
         return segmented
 
+    def estimate_memory(self, width: int, height: int) -> int:
+        """Gray, gradient, h-minima, markers and label arrays of 8 bytes per pixel."""
+        return width * height * 6 * 8 + segments_bytes(width, height)
+
     def _generate_markers(self, gradient: np.ndarray) -> np.ndarray:
         """Generate markers from local minima in gradient with h-minima suppression."""
         h = self.params["h_minima_threshold"] * (gradient.max() - gradient.min())
@@ -76,3 +110,22 @@ class WatershedImageSegmentation(ImageSegmentationAlgorithm):
         markers[tuple(local_max_coords.T)] = np.arange(1, len(local_max_coords) + 1)
 
         return markers
+
+
+def preview_markers(preview_labels: np.ndarray, gradient: np.ndarray) -> np.ndarray:
+    """Watershed markers from a preview segmentation: one per preview segment, at the lowest gradient of its
+    upscaled interior. Pixels within one preview pixel of a segment boundary are not considered, so the markers
+    lie inside the segments and the full-resolution gradient decides where the boundaries go."""
+    height, width = gradient.shape
+    labels = upscale_labels(preview_labels - preview_labels.min() + 1, width, height)
+    preview_height, preview_width = preview_labels.shape
+    size = 2 * math.ceil(max(width / preview_width, height / preview_height)) + 1
+    interior = np.where(ndimage.minimum_filter(labels, size) == ndimage.maximum_filter(labels, size), labels, 0)
+
+    ids = np.unique(interior)
+    ids = ids[ids > 0]
+    markers = np.zeros_like(labels)
+    if len(ids):
+        positions = np.array(ndimage.minimum_position(gradient, labels=interior, index=ids))
+        markers[tuple(positions.T)] = ids
+    return markers
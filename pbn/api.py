@@ -0,0 +1,153 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from enum import StrEnum
+from typing import Any, List, Optional, Sequence, Tuple, Type, Union
+from PIL import Image
+import argparse
+import io
+
+import numpy as np
+
+from pbn.algorithms import (
+    ALGORITHM_MAP,
+    PreprocessingEnum,
+    SegmentationEnum,
+    PostprocessingEnum,
+    AssignmentEnum,
+    RenderingEnum,
+)
+from pbn.backends import BackendEnum
+from pbn.core import PaintByNumber
+from pbn.datatypes import Color, ColoredSegmentedImage, OutputFormatEnum, Palette, PipelineRun
+from pbn.ingest import image_from_array
+from pbn.params import parse_enum_with_params
+from pbn.palette import parse_palette
+from pbn.profiling import PipelineProfiler
+from pbn.writer import save_image
+
+
+# An input image: a uint8 array of shape (height, width) or (height, width, 3 or 4), the bytes of an encoded image
+# such as a PNG or JPEG upload, or a PIL image.
+ImageInput = Union[np.ndarray, bytes, Image.Image]
+# A palette: RGB colors, an (n, 3) uint8 array, or the text of a palette file.
+PaletteInput = Union[Sequence[Sequence[int]], np.ndarray, str]
+# An algorithm: an instance, or a name with parameters in the CLI syntax, e.g. "voronoi,num_seeds=50".
+AlgorithmInput = Union[str, Any]
+
+
+def decode_image(image: ImageInput) -> Image.Image:
+    """An RGB image of an array, encoded image bytes or PIL image. Arrays are not copied when they can be used as
+    they are (see pbn.ingest.image_from_array)."""
+    if isinstance(image, np.ndarray):
+        return image_from_array(image).convert("RGB")
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        with Image.open(io.BytesIO(image)) as decoded:
+            return decoded.convert("RGB")
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def to_palette(palette: PaletteInput) -> Palette:
+    """The colors of a palette given as colors, an array or palette file text."""
+    if isinstance(palette, str):
+        return parse_palette(palette)
+    colors = np.asarray(palette)
+    if colors.ndim != 2 or colors.shape[1] != 3:
+        raise ValueError(f"Expected a palette of RGB colors, got shape {colors.shape}")
+    if colors.size and (colors.min() < 0 or colors.max() > 255):
+        raise ValueError("Palette colors must be in 0..255")
+    result: Palette = [(int(r), int(g), int(b)) for r, g, b in colors.tolist()]
+    return result
+
+
+def make_algorithm(stage: Type[StrEnum], algorithm: AlgorithmInput) -> Any:
+    """The algorithm of a stage: the given instance, or a new one from a name with parameters."""
+    if not isinstance(algorithm, str):
+        return algorithm
+    try:
+        name, params = parse_enum_with_params(stage)(algorithm)
+    except argparse.ArgumentTypeError as e:
+        raise ValueError(str(e))
+    return ALGORITHM_MAP.load(stage, name)(**params)
+
+
+@dataclass
+class RenderResult:
+    """The final colored segments of a run, rendered on demand to arrays, images or encoded bytes."""
+
+    segments: ColoredSegmentedImage
+    palette: Palette
+    pipeline: PaintByNumber
+
+    def to_image(self, output_format: Optional[OutputFormatEnum] = None) -> Image.Image:
+        """The image to save in output_format: palette-indexed for PNG and TIFF unless indexing is off, RGB for
+        other formats and without one."""
+        return self.pipeline.output_image(self.segments, output_format)
+
+    def to_array(self) -> np.ndarray:
+        """The rendered image as a (height, width, 3) uint8 array."""
+        return np.asarray(self.to_image().convert("RGB"))
+
+    def to_indices(self) -> Optional[Tuple[np.ndarray, List[Color]]]:
+        """The (height, width) uint8 palette indices of the rendered image and the colors they index: the palette
+        first, then any other colors used. None when the rendering algorithm cannot render palette indices."""
+        indexed = self.pipeline.rendering.render_indexed(self.segments, self.palette)
+        if indexed is None:
+            return None
+        values = indexed.getpalette() or []
+        colors: List[Color] = [(values[i], values[i + 1], values[i + 2]) for i in range(0, len(values), 3)]
+        return np.asarray(indexed), colors
+
+    def to_bytes(self, output_format: OutputFormatEnum = OutputFormatEnum.PNG) -> bytes:
+        """The rendered image encoded in output_format."""
+        output = io.BytesIO()
+        save_image(output, self.to_image(output_format), output_format)
+        return output.getvalue()
+
+
+def render(
+    image: ImageInput,
+    palette: PaletteInput,
+    preprocessing: Sequence[AlgorithmInput] = (PreprocessingEnum.NONE,),
+    segmentation: AlgorithmInput = "grid,cell_size=1",
+    postprocessing: Sequence[AlgorithmInput] = (PostprocessingEnum.MERGE,),
+    assignment: AlgorithmInput = AssignmentEnum.AVERAGE_NEAREST,
+    rendering: AlgorithmInput = RenderingEnum.COLORED,
+    palette_size: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    indexed: bool = True,
+    backend: BackendEnum = BackendEnum.FAST,
+    profiler: Optional[PipelineProfiler] = None,
+) -> RenderResult:
+    """Run the pipeline on an image and palette in memory, with the same defaults as the CLI.
+
+    Nothing is read from or written to files: the image and palette are used as given and the result is rendered
+    when it is asked for. For other settings, build a PipelineRun with input_path and palette_path set to None and
+    pass the palette to PaintByNumber."""
+    pipeline_run = PipelineRun(
+        input_path=None,
+        original_image=decode_image(image),
+        palette_path=None,
+        preprocessing=[make_algorithm(PreprocessingEnum, p) for p in preprocessing],
+        segmentation=make_algorithm(SegmentationEnum, segmentation),
+        postprocessing=[make_algorithm(PostprocessingEnum, p) for p in postprocessing],
+        assignment=make_algorithm(AssignmentEnum, assignment),
+        rendering=make_algorithm(RenderingEnum, rendering),
+        max_memory=max_memory,
+        palette_size=palette_size,
+        indexed=indexed,
+        backend=backend,
+    )
+    pipeline = PaintByNumber(pipeline_run, palette=to_palette(palette), profiler=profiler)
+    return RenderResult(pipeline.process_segments(), pipeline.palette, pipeline)
+
+
+def render_array(image: ImageInput, palette: PaletteInput, **options: Any) -> np.ndarray:
+    """Run the pipeline (see render) and return the rendered image as a (height, width, 3) uint8 array."""
+    return render(image, palette, **options).to_array()
+
+
+def render_bytes(
+    image: ImageInput, palette: PaletteInput, output_format: OutputFormatEnum = OutputFormatEnum.PNG, **options: Any
+) -> bytes:
+    """Run the pipeline (see render) and return the rendered image encoded in output_format."""
+    return render(image, palette, **options).to_bytes(output_format)
@@ -0,0 +1,234 @@
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+from PIL import Image
+import math
+import time
+
+import numpy as np
+
+from pbn.algorithms import ImageSegmentationAlgorithm, PreprocessingEnum
+from pbn.algorithms.segmentation.base import TunableParameter
+from pbn.core import load_preview
+from pbn.datatypes import Palette, PipelineRun
+from pbn.palette_selection import select_palette
+
+
+# Probes run on a copy of the image scaled down to at most about this many pixels.
+PROBE_PIXELS = 1 << 18
+MAX_PROBES = 12
+
+
+@dataclass
+class RegionTarget:
+    """The regions the output should have: a range for their number and a minimum size in pixels."""
+
+    min_regions: int = 0
+    max_regions: Optional[int] = None
+    min_region_size: int = 0
+
+    def __post_init__(self) -> None:
+        if self.min_regions < 0 or self.min_region_size < 0:
+            raise ValueError("min_regions and min_region_size must be non-negative")
+        if self.max_regions is not None and self.max_regions < max(self.min_regions, 1):
+            raise ValueError("max_regions must be at least 1 and at least min_regions")
+
+    def miss(self, regions: int, smallest_region: float) -> float:
+        """How far a result is off target, relative to the target: negative with too few regions, positive with
+        too many or too small ones and 0 on target. Too few regions take precedence, as they need more segments
+        while too small ones need fewer."""
+        if regions < self.min_regions:
+            return -(self.min_regions - regions) / self.min_regions
+        excess = 0.0
+        if self.max_regions is not None and regions > self.max_regions:
+            excess += (regions - self.max_regions) / self.max_regions
+        if smallest_region < self.min_region_size:
+            excess += (self.min_region_size - smallest_region) / self.min_region_size
+        return excess
+
+
+@dataclass
+class Probe:
+    """One parameter value tried on the probe image. regions and smallest_region are estimates for the full
+    resolution: the region count of the probe image and the size of its smallest region scaled up."""
+
+    value: Any
+    regions: int
+    smallest_region: float
+    miss: float
+    seconds: float
+
+
+@dataclass
+class AutotuneResult:
+    """The tuned segmentation algorithm and the probes that led to it."""
+
+    algorithm: ImageSegmentationAlgorithm
+    parameter: str
+    value: Any
+    scale: float
+    prepare_seconds: float
+    probes: List[Probe] = field(default_factory=list)
+
+    @property
+    def on_target(self) -> bool:
+        return any(probe.miss == 0 for probe in self.probes)
+
+    @property
+    def seconds(self) -> float:
+        return self.prepare_seconds + sum(probe.seconds for probe in self.probes)
+
+
+def count_regions(labels: np.ndarray) -> Tuple[int, int]:
+    """The number of 4-connected regions of equal labels and the pixel count of the smallest one."""
+    # Imported here because the CLI imports this module, and skimage would slow down every start of it.
+    from skimage.measure import label
+
+    components, count = label(labels, background=int(labels.min()) - 1, connectivity=1, return_num=True)
+    if count == 0:
+        return 0, 0
+    sizes = np.bincount(components.ravel())[1:]
+    return int(count), int(sizes.min())
+
+
+def autotune(
+    pipeline_run: PipelineRun,
+    palette: Palette,
+    target: RegionTarget,
+    parameter: Optional[str] = None,
+    scale: Optional[float] = None,
+    max_probes: int = MAX_PROBES,
+) -> AutotuneResult:
+    """Search a parameter of the run's segmentation for a value whose output regions meet the target.
+
+    The probes run the pipeline up to postprocessing on a downscaled copy of the image, so their regions are the
+    regions of the output. The segmentation is prepared once (e.g. its gradient or pixel features) and reused by
+    every probe. The search starts at the current value and bisects, assuming that the number of regions changes
+    monotonically with the parameter; spatial parameters are searched in probe pixels and scaled back. It stops
+    at the first value on target or when the range is exhausted, and returns the algorithm with the best value
+    found, which still has to be run at full resolution. Values that give a single region are never returned;
+    a ValueError is raised when every probe gave one."""
+    segmentation = pipeline_run.segmentation
+    tunable = {p.name: p for p in segmentation.tunable}
+    if not tunable:
+        raise ValueError(f"Segmentation '{segmentation.name}' has no tunable parameters")
+    if parameter is not None and parameter not in tunable:
+        raise ValueError(f"Unknown tunable parameter '{parameter}'. Choose from: {', '.join(tunable)}")
+    tuned = tunable[parameter] if parameter is not None else segmentation.tunable[0]
+    if max_probes < 1:
+        raise ValueError("max_probes must be at least 1")
+
+    original = pipeline_run.original_image
+    if scale is None:
+        scale = min(1.0, math.sqrt(PROBE_PIXELS / max(original.width * original.height, 1)))
+    if not 0 < scale <= 1:
+        raise ValueError("scale must be in (0, 1]")
+
+    start = time.perf_counter()
+    image, palette = _probe_image(pipeline_run, palette, scale)
+    prepared = segmentation.prepare(image)
+    prepare_seconds = time.perf_counter() - start
+
+    low, high = _bounds(tuned, image)
+    value = min(max(_to_probe(tuned, segmentation.params[tuned.name], scale), low), high)
+    probes: List[Probe] = []
+    while len(probes) < max_probes:
+        probe = _probe(pipeline_run, segmentation, tuned, value, image, prepared, palette, target, scale)
+        probes.append(probe)
+        if probe.miss == 0:
+            break
+
+        # More segments are needed with too few regions, fewer otherwise.
+        if (probe.miss < 0) == tuned.more_segments:
+            low = value + 1 if tuned.integer else value
+        else:
+            high = value - 1 if tuned.integer else value
+        if low > high or (not tuned.integer and high - low <= 1e-3 * (tuned.high or 1)):
+            break
+        value = _midpoint(tuned, low, high)
+
+    candidates = [probe for probe in probes if probe.regions > 1]
+    if not candidates:
+        raise ValueError(f"Every value of {tuned.name} tried gave a single region; the target cannot be met")
+    best = min(candidates, key=lambda probe: abs(probe.miss))
+    algorithm = segmentation.with_params(**{tuned.name: best.value})
+    return AutotuneResult(algorithm, tuned.name, best.value, scale, prepare_seconds, probes)
+
+
+def _probe_image(pipeline_run: PipelineRun, palette: Palette, scale: float) -> Tuple[Image.Image, Palette]:
+    """The downscaled and preprocessed image the probes segment, and the palette they use."""
+    image = pipeline_run.original_image if scale == 1 else load_preview(pipeline_run, scale)
+    if pipeline_run.palette_size is not None:
+        palette = [palette[i] for i in select_palette(image, palette, pipeline_run.palette_size)]
+    for preprocessing_algo in pipeline_run.preprocessing:
+        if preprocessing_algo.name != PreprocessingEnum.NONE:
+            image = preprocessing_algo.process(image, palette)
+    return image, palette
+
+
+def _probe(
+    pipeline_run: PipelineRun,
+    segmentation: ImageSegmentationAlgorithm,
+    tuned: TunableParameter,
+    value: Any,
+    image: Image.Image,
+    prepared: Any,
+    palette: Palette,
+    target: RegionTarget,
+    scale: float,
+) -> Probe:
+    """Run the probe pipeline with the parameter at value (in probe pixels for spatial parameters)."""
+    start = time.perf_counter()
+    algorithm = segmentation.with_params(**{tuned.name: value})
+
+    segments = algorithm.segment_prepared(image, prepared)
+    colored = pipeline_run.assignment.assign_colors(image, segments, palette)
+    for postprocessing_algo in pipeline_run.postprocessing:
+        colored = postprocessing_algo.process(colored, palette)
+
+    regions, smallest = count_regions(np.array(colored.labels))
+    smallest_region = smallest / scale**2
+    # A single region is degenerate whatever the target, so it counts as the largest miss of too few regions.
+    miss = -1.0 if regions <= 1 else target.miss(regions, smallest_region)
+    return Probe(_from_probe(tuned, value, scale), regions, smallest_region, miss, time.perf_counter() - start)
+
+
+def _bounds(tuned: TunableParameter, image: Image.Image) -> Tuple[Any, Any]:
+    """The search range in probe units."""
+    if tuned.high is not None:
+        high = tuned.high
+    elif tuned.spatial:
+        high = max(image.width, image.height)
+    else:
+        high = image.width * image.height
+    if tuned.spatial:
+        low = max(tuned.low, 1)
+    elif tuned.integer and tuned.more_segments:
+        # Counts of segments such as num_clusters give a single region at 1.
+        low = max(tuned.low, 2)
+    else:
+        low = tuned.low
+    if tuned.integer:
+        return int(math.ceil(low)), int(high)
+    return float(low), float(high)
+
+
+def _midpoint(tuned: TunableParameter, low: Any, high: Any) -> Any:
+    """The next value to probe. Integer ranges of positive values are split geometrically, as the number of
+    regions tends to change with the ratio of such parameters rather than their difference."""
+    if not tuned.integer:
+        return (low + high) / 2
+    if low >= 1:
+        return min(max(round(math.sqrt(low * high)), low), high)
+    return (low + high) // 2
+
+
+def _to_probe(tuned: TunableParameter, value: Any, scale: float) -> Any:
+    if not tuned.spatial:
+        return value
+    return max(1, round(value * scale)) if tuned.integer else value * scale
+
+
+def _from_probe(tuned: TunableParameter, value: Any, scale: float) -> Any:
+    if not tuned.spatial:
+        return value
+    return max(1, round(value / scale)) if tuned.integer else value / scale
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import StrEnum
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+
+class BackendEnum(StrEnum):
+    # Optimized implementations, the default.
+    FAST = "fast"
+    # The plain, readable implementations that the fast ones must match exactly.
+    REFERENCE = "reference"
+
+
+# The backend of the running pipeline. Algorithms read it when a stage starts, in the calling thread.
+_backend: ContextVar[BackendEnum] = ContextVar("backend", default=BackendEnum.FAST)
+
+
+def get_backend() -> BackendEnum:
+    return _backend.get()
+
+
+@contextmanager
+def use_backend(backend: BackendEnum) -> Iterator[None]:
+    """Run the algorithms that have several implementations with the given one inside the block."""
+    token = _backend.set(BackendEnum(backend))
+    try:
+        yield
+    finally:
+        _backend.reset(token)
+
+
+def group_pixels(labels: np.ndarray, count: int) -> List[List[Tuple[int, int]]]:
+    """The (x, y) pixels of every label 0..count-1 of a (height, width) label map, in raster order. Pixels with
+    other labels, such as unlabeled pixels (-1), are left out."""
+    flat = labels.ravel()
+    inside = np.flatnonzero((flat >= 0) & (flat < count))
+    order = inside[np.argsort(flat[inside], kind="stable")]
+    ends = np.cumsum(np.bincount(flat[inside], minlength=count)).tolist()
+    xs = (order % labels.shape[1]).tolist()
+    ys = (order // labels.shape[1]).tolist()
+
+    groups: List[List[Tuple[int, int]]] = []
+    start = 0
+    for end in ends:
+        groups.append(list(zip(xs[start:end], ys[start:end])))
+        start = end
+    return groups
@@ -0,0 +1,176 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+from PIL import Image
+import glob
+import os
+import pathlib
+import time
+
+from pbn import parallel
+from pbn.core import PaintByNumber
+from pbn.datatypes import Palette, PipelineRun
+from pbn.ingest import open_image
+from pbn.output import resolve_output_path
+from pbn.palette import load_run_palette
+
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".ppm", ".pgm", ".pnm", ".bmp", ".gif", ".tif", ".tiff", ".webp", ".npy"}
+
+
+@dataclass
+class BatchResult:
+    """Outcome of one image of a batch. Failed images carry the error instead of an output path."""
+
+    input_path: pathlib.Path
+    output_path: Optional[pathlib.Path]
+    seconds: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def collect_inputs(source: str | pathlib.Path) -> List[pathlib.Path]:
+    """Resolve a directory, a manifest file (one image path per line) or a glob pattern into image paths."""
+    path = pathlib.Path(source)
+
+    if path.is_dir():
+        return sorted(p.resolve() for p in path.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+
+    if path.is_file() and path.suffix.lower() not in IMAGE_SUFFIXES:
+        inputs: List[pathlib.Path] = []
+        with path.open() as f:
+            for raw_line in f:
+                line = raw_line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                entry = pathlib.Path(line)
+                inputs.append((entry if entry.is_absolute() else path.parent / entry).resolve())
+        return inputs
+
+    matches = (pathlib.Path(p) for p in glob.glob(str(source), recursive=True))
+    return sorted(p.resolve() for p in matches if p.is_file())
+
+
+def load_image(input_path: pathlib.Path) -> Image.Image:
+    """Decode an image fully, so it no longer depends on the open file. Memory-mapped inputs stay mapped."""
+    image = open_image(input_path)
+    image.load()
+    return image
+
+
+_worker_template: Optional[PipelineRun] = None
+_worker_palette: Optional[Palette] = None
+_worker_output_dir: Optional[pathlib.Path] = None
+
+
+def _init_worker(template: PipelineRun, palette: Palette, output_dir: pathlib.Path, threads: int = 1) -> None:
+    """Keep the pipeline template and palette in the worker, so they are sent and built only once."""
+    global _worker_template, _worker_palette, _worker_output_dir
+    parallel.configure(threads)
+    _worker_template = template
+    _worker_palette = palette
+    _worker_output_dir = output_dir
+
+
+def _process_image(input_path: pathlib.Path, image: Image.Image) -> Tuple[pathlib.Path, float]:
+    """Run the worker's pipeline template on one decoded image and save the result."""
+    if _worker_template is None or _worker_palette is None or _worker_output_dir is None:
+        raise RuntimeError("Batch worker is not initialized.")
+
+    start = time.perf_counter()
+    pipeline_run = replace(_worker_template, input_path=input_path, original_image=image)
+    output_path = resolve_output_path(pipeline_run, _worker_output_dir)
+    PaintByNumber(pipeline_run, palette=_worker_palette).save(output_path)
+    return output_path, time.perf_counter() - start
+
+
+def _run_inline(input_path: pathlib.Path, image: Image.Image) -> Future[Tuple[pathlib.Path, float]]:
+    """Process an image in the calling process, wrapping the outcome like a pool would."""
+    future: Future[Tuple[pathlib.Path, float]] = Future()
+    try:
+        future.set_result(_process_image(input_path, image))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def run_batch(
+    template: PipelineRun,
+    inputs: Iterable[pathlib.Path],
+    output_dir: pathlib.Path,
+    workers: Optional[int] = None,
+    prefetch: int = 2,
+    palette: Optional[Palette] = None,
+    threads: int = 1,
+) -> Iterator[BatchResult]:
+    """Run one pipeline template over many images and yield a result per image.
+
+    The input_path and original_image of the template are replaced for every image. Images are decoded
+    by a thread pool ahead of the process pool, so the next images are ready while the current ones run.
+    A failing image is reported in its result and does not abort the batch. With workers <= 1 all images
+    are processed in the calling process. Every worker splits its pointwise work over threads threads."""
+    workers = workers if workers is not None else os.cpu_count() or 1
+    if prefetch < 0:
+        raise ValueError("prefetch must be non-negative")
+    palette = palette if palette is not None else load_run_palette(template)
+
+    executor: Optional[ProcessPoolExecutor] = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(template, palette, output_dir, threads)
+        )
+    else:
+        workers = 1
+        _init_worker(template, palette, output_dir, threads)
+
+    def submit(input_path: pathlib.Path, image: Image.Image) -> Future[Tuple[pathlib.Path, float]]:
+        if executor is None:
+            return _run_inline(input_path, image)
+        return executor.submit(_process_image, input_path, image)
+
+    window = workers + prefetch
+    input_iter = iter(inputs)
+    decoding: Deque[Tuple[pathlib.Path, float, Future[Image.Image]]] = deque()
+    pending: Deque[Tuple[pathlib.Path, float, Future[Tuple[pathlib.Path, float]]]] = deque()
+
+    with ExitStack() as stack:
+        if executor is not None:
+            stack.enter_context(executor)
+        decoder = stack.enter_context(ThreadPoolExecutor(max(prefetch, 1), thread_name_prefix="pbn-decode"))
+
+        def fill() -> None:
+            while len(decoding) + len(pending) < window:
+                input_path = next(input_iter, None)
+                if input_path is None:
+                    return
+                decoding.append((input_path, time.perf_counter(), decoder.submit(load_image, input_path)))
+
+        fill()
+        while decoding or pending:
+            # Hand decoded images to the workers until the window is full of running work.
+            while decoding and len(pending) < workers:
+                input_path, start, decoded = decoding.popleft()
+                try:
+                    image = decoded.result()
+                except Exception as e:
+                    yield BatchResult(input_path, None, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+                    fill()
+                    continue
+                pending.append((input_path, start, submit(input_path, image)))
+                fill()
+
+            if not pending:
+                continue
+
+            input_path, start, future = pending.popleft()
+            try:
+                output_path, seconds = future.result()
+                yield BatchResult(input_path, output_path, seconds)
+            except Exception as e:
+                yield BatchResult(input_path, None, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+            fill()
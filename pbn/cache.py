@@ -0,0 +1,198 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+from PIL import Image
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+
+from pbn.datatypes import Palette, SegmentedImage, ColoredSegmentedImage
+from pbn.output import serialize_params
+
+
+CACHE_VERSION = "pbn-cache-v1"
+
+# Modes that survive a round trip through a plain array.
+ARRAY_MODES = {"RGB", "RGBA", "L"}
+
+
+def hash_image(image: Image.Image) -> str:
+    """Hash the pixel data, size and mode of an image."""
+    digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def hash_palette(palette: Palette) -> str:
+    """Hash the colors of a palette, in order."""
+    return hashlib.sha256(repr([tuple(color) for color in palette]).encode()).hexdigest()
+
+
+def describe_algorithm(algorithm: Any) -> str:
+    """Describe an algorithm and its parameters the same way they appear in output filenames."""
+    return f"{algorithm.name}:{serialize_params(algorithm.params)}"
+
+
+def make_key(*parts: str) -> str:
+    """Combine key parts (hashes and algorithm descriptions) into a cache key."""
+    return hashlib.sha256("\n".join((CACHE_VERSION, *parts)).encode()).hexdigest()
+
+
+class StageCache:
+    """Content-addressed on-disk cache of pipeline stage outputs.
+
+    Every entry is a compressed .npz file named after its key. Reading an entry marks it as recently used and
+    the least recently used entries are evicted whenever the cache grows beyond max_bytes."""
+
+    directory: pathlib.Path
+    max_bytes: Optional[int]
+
+    def __init__(self, directory: pathlib.Path, max_bytes: Optional[int] = None):
+        if max_bytes is not None and max_bytes < 0:
+            raise ValueError("max_bytes must be non-negative")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def contains(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def load_image(self, key: str) -> Optional[Image.Image]:
+        arrays = self._load(key)
+        if arrays is None:
+            return None
+        return Image.fromarray(arrays["image"])
+
+    def store_image(self, key: str, image: Image.Image) -> None:
+        """Store an image. Images in modes that cannot be stored losslessly as an array are skipped."""
+        if image.mode not in ARRAY_MODES:
+            return
+        self._store(key, image=np.asarray(image))
+
+    def load_segments(self, key: str) -> Optional[SegmentedImage]:
+        arrays = self._load(key)
+        if arrays is None:
+            return None
+        segments = SegmentedImage.from_labels(arrays["labels"].tolist())
+        segments.metadata.update(json.loads(str(arrays["metadata"])))
+        return segments
+
+    def store_segments(self, key: str, segments: SegmentedImage) -> None:
+        self._store(key, labels=self._label_array(segments), metadata=self._metadata(segments.metadata))
+
+    def load_colored_segments(self, key: str) -> Optional[ColoredSegmentedImage]:
+        arrays = self._load(key)
+        if arrays is None:
+            return None
+        labels = arrays["labels"]
+        height, width = labels.shape
+        color_map = {int(i): (int(r), int(g), int(b)) for i, (r, g, b) in zip(arrays["ids"], arrays["colors"])}
+        colored_segments = ColoredSegmentedImage.from_segments(
+            SegmentedImage.from_labels(labels.tolist()), width, height, color_map
+        )
+        colored_segments.metadata.update(json.loads(str(arrays["metadata"])))
+        return colored_segments
+
+    def store_colored_segments(self, key: str, segments: ColoredSegmentedImage) -> None:
+        self._store(
+            key,
+            labels=self._label_array(segments),
+            ids=np.array([seg.id for seg in segments.segments], dtype=np.int64),
+            colors=np.array([seg.color for seg in segments.segments], dtype=np.uint8).reshape(-1, 3),
+            metadata=self._metadata(segments.metadata),
+        )
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.npz"
+
+    def _load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            # A damaged entry is treated as a miss and overwritten later.
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def _store(self, key: str, **arrays: np.ndarray) -> None:
+        # Write to a temporary file first, so concurrent readers never see a partial entry.
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **arrays)  # type: ignore[arg-type]
+            os.replace(tmp_name, self._path(key))
+        except BaseException:
+            pathlib.Path(tmp_name).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    @staticmethod
+    def _label_array(segments: SegmentedImage | ColoredSegmentedImage) -> np.ndarray:
+        return np.array(segments.labels, dtype=np.int32).reshape(segments.height, segments.width)
+
+    @staticmethod
+    def _metadata(metadata: Dict[str, Any]) -> np.ndarray:
+        return np.array(json.dumps(metadata, default=str))
+
+
+@dataclass
+class StageKeys:
+    """Cache keys of the stage outputs of one pipeline run. Every key covers the full chain leading up to it."""
+
+    preprocessing: List[str]
+    segmentation: str
+    assignment: str
+
+
+def stage_keys(
+    image: Image.Image,
+    palette: Palette,
+    preprocessing: Sequence[Any],
+    segmentation: Any,
+    assignment: Any,
+) -> StageKeys:
+    """Derive the keys from the input image, the palette and the algorithm chain with its parameters."""
+    parts = [hash_image(image), hash_palette(palette)]
+
+    preprocessing_keys = []
+    for algorithm in preprocessing:
+        parts.append(describe_algorithm(algorithm))
+        preprocessing_keys.append(make_key(*parts))
+
+    parts.append(describe_algorithm(segmentation))
+    segmentation_key = make_key(*parts)
+    parts.append(describe_algorithm(assignment))
+    assignment_key = make_key(*parts)
+
+    return StageKeys(preprocessing_keys, segmentation_key, assignment_key)
@@ -1,8 +1,11 @@
-from typing import Optional, Type, Tuple, Dict, Any, Callable
-from enum import StrEnum
+from dataclasses import replace
+from typing import Optional, Tuple, Sequence
 from PIL import Image
 import argparse
+import os
 import pathlib
+import sys
+import time
 
 from pbn.algorithms import (
     PreprocessingEnum,
@@ -13,61 +16,51 @@ from pbn.algorithms import (
     ALGORITHM_MAP,
 )
 from pbn.output import resolve_output_path
-from pbn.datatypes import PipelineRun
-from pbn import PaintByNumber
+from pbn.autotune import RegionTarget, autotune
+from pbn.backends import BackendEnum
+from pbn.palette import load_palette, load_palette_entries
+from pbn.pbnseg import CompressionEnum
+from pbn.batch import collect_inputs, run_batch
+from pbn.ingest import open_image
+from pbn.memory import MemoryBudgetError
+from pbn.profiling import PipelineProfiler
+from pbn.smoothing import smoothing_impact
+from pbn.datatypes import PipelineRun, OutputFormatEnum
+from pbn.writer import BAND_WRITERS, format_from_path
+from pbn.params import parse_enum_with_params
+from pbn import PaintByNumber, parallel
 
 
-def parse_enum_with_params(enum_cls: Type[StrEnum]) -> Callable[[str], Tuple[StrEnum, Dict[str, Any]]]:
-    """The type that parses the algorithm with parameters provided over the CLI"""
+def parse_size(value: str) -> int:
+    """The type that parses a size in bytes with an optional K, M or G suffix"""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    number = value.strip().upper().removesuffix("B")
+    multiplier = 1
+    if number and number[-1] in units:
+        multiplier = units[number[-1]]
+        number = number[:-1]
+    try:
+        size = float(number)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size '{value}'. Expected e.g. 1024, 500M or 2G.")
+    if size < 0:
+        raise argparse.ArgumentTypeError("Size must be non-negative.")
+    return int(size * multiplier)
 
-    def parser(value: str) -> Tuple[StrEnum, Dict[str, Any]]:
-        parts = value.split(",")
-        name = parts[0]
 
-        try:
-            enum_value = enum_cls(name)
-        except ValueError:
-            valid = ", ".join(e for e in enum_cls)
-            raise argparse.ArgumentTypeError(f"Invalid value '{name}'. Choose from: {valid}")
-
-        params: Dict[str, Any] = {}
-        for part in parts[1:]:
-            if "=" not in part:
-                raise argparse.ArgumentTypeError(f"Invalid parameter '{part}'. Expected key=value.")
-            val: str | int | float | bool | None
-            key, val = part.split("=", 1)
-
-            if val == "None":
-                val = None
-            elif val.lower() == "true":
-                val = True
-            elif val.lower() == "false":
-                val = False
-            elif val.isdigit():
-                val = int(val)
-            else:
-                try:
-                    val = float(val)
-                except ValueError:
-                    pass
-
-            params[key] = val
-
-        return enum_value, params
+def parse_region_range(value: str) -> Tuple[int, Optional[int]]:
+    """The type that parses a number of regions or a range of them, e.g. 400, 300:500, 300: or :500"""
+    low, sep, high = value.partition(":")
+    try:
+        min_regions = int(low) if low else 0
+        max_regions = (int(high) if high else None) if sep else min_regions
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid region range '{value}'. Expected e.g. 400, 300:500 or :500.")
+    return min_regions, max_regions
 
-    return parser
-
-
-def main() -> None:
-    """Load an image and palette, run the paint-by-number pipeline, and save the result."""
-    parser = argparse.ArgumentParser(
-        prog="pbn",
-        description="Paint by Number: Convert images to a palette-based representation. The resulting image is in PPM format.",
-        epilog="Author: Kasper van Maasdam. Date: December 2025. License: GPL v3.0",
-    )
 
-    parser.add_argument("input_image", type=pathlib.Path, help="path to the input image")
-    parser.add_argument("palette", type=pathlib.Path, help="path to palette file (R,G,B per line)")
+def add_pipeline_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the algorithm and pipeline options shared by the single-image and batch commands."""
     parser.add_argument(
         "-p",
         "--preprocessing",
@@ -90,6 +83,18 @@ def main() -> None:
             "Default: grid,cell_size=1"
         ),
     )
+    parser.add_argument(
+        "--enforce-connectivity",
+        type=int,
+        nargs="?",
+        const=0,
+        metavar="MIN_SIZE",
+        help=(
+            "split every segment into its connected parts, e.g. the scattered islands of kmeans and voronoi segments. "
+            "With MIN_SIZE, parts smaller than that many pixels are absorbed into the neighbor they share the longest "
+            "border with"
+        ),
+    )
     parser.add_argument(
         "-a",
         "--assignment",
@@ -123,6 +128,204 @@ def main() -> None:
             "Default: color"
         ),
     )
+    parser.add_argument(
+        "--format",
+        "-f",
+        dest="output_format",
+        type=OutputFormatEnum,
+        choices=list(OutputFormatEnum),
+        help=(
+            "file format of the output image. "
+            f"Options: {{{', '.join(e for e in OutputFormatEnum)}}}. "
+            "Default: the extension of --output, or ppm"
+        ),
+    )
+    parser.add_argument(
+        "--indexed",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help=(
+            "save png and tiff output and intermediate images with a palette, one byte per pixel, when they use at "
+            "most 256 colors. Default: on"
+        ),
+    )
+    parser.add_argument(
+        "--intermediate-images",
+        "-i",
+        type=pathlib.Path,
+        help="enables storing intermediate images by providing directory where to store them",
+    )
+    parser.add_argument(
+        "--intermediate-format",
+        type=OutputFormatEnum,
+        choices=list(OutputFormatEnum),
+        default=OutputFormatEnum.PPM,
+        help=(
+            "file format of the intermediate images. "
+            f"Options: {{{', '.join(e for e in OutputFormatEnum)}}}. "
+            "Default: ppm"
+        ),
+    )
+    parser.add_argument(
+        "--intermediate-scale",
+        type=float,
+        default=1.0,
+        help="scale factor in (0, 1] to downscale the intermediate images with. Default: 1",
+    )
+    parser.add_argument(
+        "--band-height",
+        "-b",
+        type=int,
+        help=(
+            "render and write the output in bands of this many rows instead of building the full image in memory. "
+            "Supported for the ppm, png and npy (memory-mapped array) formats; other formats are rejected before "
+            "the run starts"
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        help=(
+            "directory to cache stage outputs (preprocessed image, segmentation, color assignment) in. "
+            "Runs with the same input, palette and leading algorithms resume from the deepest cached stage"
+        ),
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        help="maximum size of the cache directory, e.g. 500M or 2G. Least recently used entries are evicted",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        help=(
+            "memory budget of the pipeline data per image, e.g. 2G. Stages that would exceed it switch to cheaper "
+            "strategies (chunked distances, sampled fits, downscaled segmentation, banded output). "
+            "The run fails before starting when nothing fits"
+        ),
+    )
+    parser.add_argument(
+        "--palette-size",
+        "-k",
+        type=int,
+        help=(
+            "select this many colors from the palette, e.g. a paint library, that fit the input image best and "
+            "use only those"
+        ),
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help=(
+            "number of threads that color assignment, rendering and intermediate images are split over in row bands "
+            "and segment batches. The output does not depend on it. Default: 1"
+        ),
+    )
+    parser.add_argument(
+        "--backend",
+        type=BackendEnum,
+        choices=list(BackendEnum),
+        default=BackendEnum.FAST,
+        help=(
+            "implementation of the algorithms that have several: fast, or the plain reference code that the fast "
+            "one is checked against (see benchmarks/differential.py). The output does not depend on it. Default: fast"
+        ),
+    )
+
+
+def build_pipeline_run(
+    args: argparse.Namespace, input_path: pathlib.Path, image: Image.Image, palette_path: pathlib.Path
+) -> PipelineRun:
+    """Instantiate the algorithms selected in the parsed arguments into a PipelineRun."""
+    intermediate_dir: Optional[pathlib.Path] = args.intermediate_images.resolve() if args.intermediate_images else None
+    preprocessing_list = args.preprocessing if args.preprocessing else [(PreprocessingEnum.NONE, {})]
+    postprocessing_list = args.postprocessing if args.postprocessing else [(PostprocessingEnum.MERGE, {})]
+
+    if intermediate_dir and not intermediate_dir.is_dir():
+        raise NotADirectoryError(f"{intermediate_dir} does not exist or is not a directory")
+    if not 0 < args.intermediate_scale <= 1:
+        raise ValueError("--intermediate-scale must be in (0, 1]")
+    if args.band_height is not None and args.band_height < 1:
+        raise ValueError("--band-height must be at least 1")
+    if args.band_height is not None:
+        # Checked before anything runs, as the output is only written once the whole pipeline is done.
+        output_format = args.output_format or (format_from_path(args.output) if args.output else OutputFormatEnum.PPM)
+        if output_format not in BAND_WRITERS:
+            raise ValueError(
+                f"--band-height is not supported for the {output_format} format. "
+                f"Use one of: {', '.join(BAND_WRITERS)}"
+            )
+    if args.palette_size is not None and args.palette_size < 1:
+        raise ValueError("--palette-size must be at least 1")
+    if args.threads < 1:
+        raise ValueError("--threads must be at least 1")
+    if args.enforce_connectivity is not None and args.enforce_connectivity < 0:
+        raise ValueError("--enforce-connectivity must be non-negative")
+
+    segmentation = ALGORITHM_MAP.load(SegmentationEnum, args.segmentation[0])(**args.segmentation[1])
+    if args.enforce_connectivity is not None:
+        # Imported here because most runs do not split segments.
+        from pbn.algorithms.segmentation import ConnectedSegmentation
+
+        segmentation = ConnectedSegmentation(segmentation, args.enforce_connectivity)
+
+    return PipelineRun(
+        input_path=input_path,
+        original_image=image,
+        palette_path=palette_path,
+        preprocessing=[ALGORITHM_MAP.load(PreprocessingEnum, p[0])(**p[1]) for p in preprocessing_list],
+        segmentation=segmentation,
+        postprocessing=[ALGORITHM_MAP.load(PostprocessingEnum, p[0])(**p[1]) for p in postprocessing_list],
+        assignment=ALGORITHM_MAP.load(AssignmentEnum, args.assignment[0])(**args.assignment[1]),
+        rendering=ALGORITHM_MAP.load(RenderingEnum, args.rendering[0])(**args.rendering[1]),
+        intermediate_dir=intermediate_dir,
+        intermediate_format=args.intermediate_format,
+        intermediate_scale=args.intermediate_scale,
+        band_height=args.band_height,
+        cache_dir=args.cache_dir.resolve() if args.cache_dir else None,
+        cache_max_bytes=args.cache_size,
+        max_memory=args.max_memory,
+        palette_size=args.palette_size,
+        output_format=args.output_format,
+        indexed=args.indexed,
+        backend=args.backend,
+    )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Load an image and palette, run the paint-by-number pipeline, and save the result."""
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ["batch"]:
+        batch_main(argv[1:])
+        return
+    if argv[:1] == ["serve"]:
+        serve_main(argv[1:])
+        return
+    if argv[:1] == ["variants"]:
+        variants_main(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        prog="pbn",
+        description=(
+            "Paint by Number: Convert images to a palette-based representation. The resulting image is in PPM "
+            "format unless another format is chosen with --format or the --output extension."
+        ),
+        epilog="Run 'pbn batch --help' to process many images at once, 'pbn variants --help' to run many pipelines "
+        "on shared stages and 'pbn serve --help' to run a local service. "
+        "Author: Kasper van Maasdam. Date: December 2025. License: GPL v3.0",
+    )
+
+    parser.add_argument(
+        "input_image",
+        type=pathlib.Path,
+        help="path to the input image. .npy arrays and binary PGM/PPM files are memory-mapped",
+    )
+    parser.add_argument(
+        "palette", type=pathlib.Path, help="path to palette file (R,G,B or hex per line, or a numbered paint library)"
+    )
+    add_pipeline_arguments(parser)
     parser.add_argument(
         "--dir",
         "-d",
@@ -134,55 +337,387 @@ def main() -> None:
         "--output", "-o", type=pathlib.Path, help="exact output file path and overrides --dir if provided"
     )
     parser.add_argument(
-        "--intermediate-images",
-        "-i",
+        "--save-segments",
+        action="store_true",
+        help="also save the final segments (label map, segment table and run metadata) next to the output image "
+        "as a .pbnseg file",
+    )
+    parser.add_argument(
+        "--segments-compression",
+        type=CompressionEnum,
+        choices=list(CompressionEnum),
+        default=CompressionEnum.ZLIB,
+        help=(
+            "compression of the label map in the .pbnseg file. Uncompressed label maps can be memory-mapped. "
+            f"Options: {{{', '.join(e for e in CompressionEnum)}}}. Default: zlib"
+        ),
+    )
+    parser.add_argument(
+        "--target-regions",
+        type=parse_region_range,
+        help=(
+            "auto-tune a parameter of the segmentation until the output has this many regions, e.g. 300:500. "
+            "Values are probed on a downscaled copy of the image and only the final one runs at full resolution"
+        ),
+    )
+    parser.add_argument(
+        "--min-region-size",
+        type=int,
+        help="auto-tune a parameter of the segmentation until no output region has fewer pixels than this",
+    )
+    parser.add_argument(
+        "--tune-parameter",
+        help=(
+            "segmentation parameter to auto-tune, e.g. h_minima_threshold. Default: the first tunable parameter "
+            "of the segmentation (min_distance, num_seeds, num_clusters or cell_size)"
+        ),
+    )
+    parser.add_argument(
+        "--tune-scale",
+        type=float,
+        help=(
+            "scale factor in (0, 1] of the image the auto-tuning probes run on. Larger scales estimate the regions "
+            "of the output more closely but probe slower. Default: about 512x512 pixels"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
         type=pathlib.Path,
-        help="enables storing intermediate images by providing directory where to store them",
+        help="write a JSON report with the time, memory and segment counts of every stage to this path",
+    )
+    parser.add_argument(
+        "--profile-stage",
+        help=(
+            "also capture a cProfile of one stage (e.g. segmentation) or algorithm (e.g. merge). "
+            "It is saved next to the --profile report as a .prof file"
+        ),
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="trace peak and retained memory per stage with tracemalloc when profiling. This slows the run down. "
+        "Default: on",
+    )
+    parser.add_argument(
+        "--profile-smoothing",
+        action="store_true",
+        help=(
+            "with median, bilateral or mean-shift preprocessing, run the stages up to rendering once more without "
+            "them and add the segments they removed and the downstream time they saved to the --profile report"
+        ),
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     input_path: pathlib.Path = args.input_image.resolve()
     palette_path: pathlib.Path = args.palette.resolve()
     output_dir: pathlib.Path = args.dir.resolve()
     output_file: Optional[pathlib.Path] = args.output.resolve() if args.output else None
-    intermediate_dir: Optional[pathlib.Path] = args.intermediate_images.resolve() if args.intermediate_images else None
-    preprocessing_list = args.preprocessing if args.preprocessing else [(PreprocessingEnum.NONE, {})]
-    postprocessing_list = args.postprocessing if args.postprocessing else [(PostprocessingEnum.MERGE, {})]
 
     if not output_dir.is_dir():
         raise NotADirectoryError(f"{output_dir} does not exist or is not a directory")
     if output_file and not output_file.parent.is_dir():
         raise NotADirectoryError(f"{output_file.parent} does not exist or is not a directory")
-    if intermediate_dir and not intermediate_dir.is_dir():
-        raise NotADirectoryError(f"{intermediate_dir} does not exist or is not a directory")
+    if args.profile_stage and not args.profile:
+        raise ValueError("--profile-stage requires --profile")
+    if args.profile_smoothing and not args.profile:
+        raise ValueError("--profile-smoothing requires --profile")
 
-    with Image.open(input_path) as image:
-        pipeline_run = PipelineRun(
-            input_path=input_path,
-            original_image=image.copy(),
-            palette_path=palette_path,
-            preprocessing=[ALGORITHM_MAP[p[0]](**p[1]) for p in preprocessing_list],
-            segmentation=ALGORITHM_MAP[args.segmentation[0]](**args.segmentation[1]),
-            postprocessing=[ALGORITHM_MAP[p[0]](**p[1]) for p in postprocessing_list],
-            assignment=ALGORITHM_MAP[args.assignment[0]](**args.assignment[1]),
-            rendering=ALGORITHM_MAP[args.rendering[0]](**args.rendering[1]),
-            intermediate_dir=intermediate_dir,
-        )
+    profiler = None
+    if args.profile:
+        profiler = PipelineProfiler(trace_memory=args.profile_memory, cprofile_stage=args.profile_stage)
 
-        pbn = PaintByNumber(pipeline_run)
+    # The image is passed on as opened: memory-mapped or decoded on first use, and never copied up front.
+    with open_image(input_path) as image:
+        pipeline_run = build_pipeline_run(args, input_path, image, palette_path)
+        parallel.configure(args.threads)
 
-        result = pbn.process()
+        palette = load_palette(palette_path)
+        if args.target_regions is not None or args.min_region_size is not None:
+            min_regions, max_regions = args.target_regions or (0, None)
+            target = RegionTarget(min_regions, max_regions, args.min_region_size or 0)
+            try:
+                tuned = autotune(pipeline_run, palette, target, args.tune_parameter, args.tune_scale)
+            except ValueError as e:
+                print(f"Auto-tune failed: {e}", file=sys.stderr)
+                raise SystemExit(1)
+            for probe in tuned.probes:
+                print(
+                    f"Auto-tune probe: {tuned.parameter}={probe.value:g} -> ~{probe.regions} regions, "
+                    f"smallest ~{probe.smallest_region:.0f} px ({probe.seconds:.2f}s)"
+                )
+            print(
+                f"Auto-tune: {tuned.parameter}={tuned.value:g} ({'on' if tuned.on_target else 'closest to'} target), "
+                f"{len(tuned.probes)} probes at scale {tuned.scale:.2f} in {tuned.seconds:.2f}s "
+                f"of which {tuned.prepare_seconds:.2f}s preparing"
+            )
+            pipeline_run = replace(pipeline_run, segmentation=tuned.algorithm)
 
-        if isinstance(result, Image.Image):
-            result_image = result
-        else:
-            result_image, color_map = result
+        try:
+            pbn = PaintByNumber(pipeline_run, palette=palette, profiler=profiler)
+        except MemoryBudgetError as e:
+            print(e, file=sys.stderr)
+            raise SystemExit(1)
+        if pbn.palette_selection is not None:
+            entries = load_palette_entries(palette_path)
+            print(f"Selected palette: {', '.join(entries[i][0] for i in pbn.palette_selection)}")
+        if pbn.memory_plan:
+            for estimate in pbn.memory_plan.strategies:
+                print(f"Memory budget: running {estimate.stage} ({estimate.algorithm}) with {estimate.strategy}")
 
         output_path = resolve_output_path(pipeline_run, output_dir) if not output_file else output_file
 
-        result_image.save(output_path, format="PPM")
+        segments_path = output_path.with_suffix(".pbnseg") if args.save_segments else None
+        pbn.save(output_path, segments_path, args.segments_compression)
         print(f"Saved output image to: {output_path}")
+        if segments_path:
+            print(f"Saved segments to: {segments_path}")
+
+        impact = None
+        if profiler and args.profile_smoothing:
+            impact = smoothing_impact(pbn.pipeline_run, pbn.palette, profiler)
+            if impact is None:
+                print("Smoothing: the run has no median, bilateral or mean-shift preprocessing to compare")
+            else:
+                print(
+                    f"Smoothing ({', '.join(impact.algorithms)}, {impact.smoothing_seconds:.2f}s): "
+                    f"{impact.final_without} -> {impact.final_with} segments, downstream "
+                    f"{impact.downstream_seconds_without:.2f}s -> {impact.downstream_seconds_with:.2f}s "
+                    f"({impact.seconds_saved:+.2f}s saved)"
+                )
+
+    if profiler:
+        profile_path = profiler.write_report(
+            args.profile.resolve(),
+            input=input_path,
+            palette=palette_path,
+            output=output_path,
+            width=pipeline_run.original_image.width,
+            height=pipeline_run.original_image.height,
+            memory_plan=pbn.memory_plan.to_dict() if pbn.memory_plan else None,
+            smoothing=impact.to_dict() if impact else None,
+        )
+        print(f"Saved profile report to: {profile_path}")
+
+
+def batch_main(argv: Sequence[str]) -> None:
+    """Run one pipeline over a directory, glob or manifest of images using a process pool."""
+    parser = argparse.ArgumentParser(
+        prog="pbn batch",
+        description=(
+            "Paint by Number batch mode: run the same pipeline over many images. "
+            "The pipeline is built once and the images are spread over a pool of worker processes."
+        ),
+        epilog="Author: Kasper van Maasdam. Date: December 2025. License: GPL v3.0",
+    )
+
+    parser.add_argument(
+        "inputs",
+        help="directory of images, glob pattern (quote it) or manifest file with one image path per line",
+    )
+    parser.add_argument(
+        "palette", type=pathlib.Path, help="path to palette file (R,G,B or hex per line, or a numbered paint library)"
+    )
+    add_pipeline_arguments(parser)
+    parser.add_argument(
+        "--dir",
+        "-d",
+        type=pathlib.Path,
+        default=pathlib.Path.cwd(),
+        help="directory to save the output images. Default: current directory",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes. 1 processes the images in this process. Default: number of CPUs",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="number of images decoded ahead of the running ones. Default: 2",
+    )
+
+    args = parser.parse_args(argv)
+
+    palette_path: pathlib.Path = args.palette.resolve()
+    output_dir: pathlib.Path = args.dir.resolve()
+
+    if not output_dir.is_dir():
+        raise NotADirectoryError(f"{output_dir} does not exist or is not a directory")
+
+    inputs = collect_inputs(args.inputs)
+    if not inputs:
+        raise FileNotFoundError(f"No images found for '{args.inputs}'")
+
+    # The input path and image are filled in per image by the batch runner.
+    template = build_pipeline_run(args, pathlib.Path(), Image.new("RGB", (0, 0)), palette_path)
+
+    start = time.perf_counter()
+    failed = 0
+    for result in run_batch(
+        template, inputs, output_dir, workers=args.workers, prefetch=args.prefetch, threads=args.threads
+    ):
+        if result.ok:
+            print(f"[{result.seconds:.2f}s] {result.input_path} -> {result.output_path}")
+        else:
+            failed += 1
+            print(f"[{result.seconds:.2f}s] FAILED {result.input_path}: {result.error}")
+
+    print(
+        f"Processed {len(inputs) - failed}/{len(inputs)} images in {time.perf_counter() - start:.2f}s, {failed} failed."
+    )
+    if failed:
+        raise SystemExit(1)
+
+
+def variants_main(argv: Sequence[str]) -> None:
+    """Run the pipeline variants of a spec file, computing shared stage prefixes once."""
+    # Imported here because only this subcommand uses the variants module.
+    from pbn.variants import build_graph, load_variants, run_graph
+
+    parser = argparse.ArgumentParser(
+        prog="pbn variants",
+        description=(
+            "Paint by Number variants: run many pipeline variants from a TOML or JSON spec file. Variants with the "
+            "same input and leading algorithms share those stages, which run once, and independent branches run "
+            "in parallel."
+        ),
+        epilog="Author: Kasper van Maasdam. Date: December 2025. License: GPL v3.0",
+    )
+    parser.add_argument("spec", type=pathlib.Path, help="path to the variant spec file (.toml or .json)")
+    parser.add_argument(
+        "--dir",
+        "-d",
+        type=pathlib.Path,
+        help="directory to save the output images. Default: output_dir of the spec, or the spec's directory",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes. 1 runs every stage in this process. Default: number of CPUs",
+    )
+
+    args = parser.parse_args(argv)
+
+    output_dir: Optional[pathlib.Path] = args.dir.resolve() if args.dir else None
+    if output_dir and not output_dir.is_dir():
+        raise NotADirectoryError(f"{output_dir} does not exist or is not a directory")
+
+    variants = load_variants(args.spec, output_dir)
+    graph = build_graph(variants)
+    print(
+        f"Running {len(variants)} variants as {len(graph.nodes)} stages "
+        f"({graph.shared_count} of {graph.stage_count} shared)."
+    )
+
+    start = time.perf_counter()
+    failed = 0
+    for _, result in run_graph(graph, workers=args.workers):
+        if result.ok:
+            print(f"[{result.seconds:.2f}s] {result.output_path}")
+        else:
+            failed += 1
+            print(f"[{result.seconds:.2f}s] FAILED {result.output_path}: {result.error}")
+
+    print(
+        f"Saved {len(variants) - failed}/{len(variants)} variants in {time.perf_counter() - start:.2f}s, "
+        f"{failed} failed."
+    )
+    if failed:
+        raise SystemExit(1)
+
+
+def serve_main(argv: Sequence[str]) -> None:
+    """Run a local HTTP service that renders uploaded images with warm worker processes."""
+    # Imported here because only this subcommand uses the service and asyncio.
+    import asyncio
+    from pbn.serve import PaintByNumberService, serve
+
+    parser = argparse.ArgumentParser(
+        prog="pbn serve",
+        description=(
+            "Paint by Number service: POST image bytes to /render with the pipeline in the query string, e.g. "
+            "/render?palette=palette1&segmentation=watershed&format=png. "
+            "GET /metrics returns request counts and latencies."
+        ),
+        epilog="Author: Kasper van Maasdam. Date: December 2025. License: GPL v3.0",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on. Default: 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8470, help="port to listen on. Default: 8470")
+    parser.add_argument("--unix-socket", type=pathlib.Path, help="listen on this Unix socket instead of a port")
+    parser.add_argument("--palette", type=pathlib.Path, help="palette used by requests that do not name a palette")
+    parser.add_argument(
+        "--palette-dir",
+        type=pathlib.Path,
+        help=(
+            "directory of the palettes requests can name, e.g. palette=palette1 for palette1.txt. "
+            "Without it, requests can only use --palette"
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of warm worker processes. Default: number of CPUs",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="maximum number of requests processed at once. Default: number of workers",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=16,
+        help="maximum number of requests waiting for a worker. Further requests get status 503. Default: 16",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="seconds after which a request gets status 504. Default: 60",
+    )
+    parser.add_argument(
+        "--max-body", type=parse_size, default=64 << 20, help="maximum upload size, e.g. 64M. Default: 64M"
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        help="memory budget of every request, e.g. 2G. Requests that do not fit get status 413",
+    )
+    parser.add_argument(
+        "--preload",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="import all built-in algorithms when a worker starts. Default: on",
+    )
+
+    args = parser.parse_args(argv)
+    if args.palette_dir and not args.palette_dir.is_dir():
+        raise NotADirectoryError(f"{args.palette_dir} does not exist or is not a directory")
+
+    service = PaintByNumberService(
+        workers=args.workers,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        timeout=args.timeout,
+        max_body=args.max_body,
+        default_palette=args.palette.resolve() if args.palette else None,
+        max_memory=args.max_memory,
+        preload=args.preload,
+        palette_dir=args.palette_dir.resolve() if args.palette_dir else None,
+    )
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
-from typing import Optional, Dict, Tuple, List
+from dataclasses import replace
+from typing import Optional, Dict, Tuple, List, Iterator
 from PIL import Image
 import pathlib
+import time
 import numpy as np
-import skimage
 
 from pbn.algorithms import (
     ImageProcessingAlgorithm,
@@ -13,11 +14,63 @@ from pbn.algorithms import (
     PreprocessingEnum,
     PostprocessingEnum,
 )
-from pbn.algorithms.assignment import AverageNearestColorAssignment
-from pbn.algorithms.rendering import ColoredRendering
-from pbn.output import resolve_intermediate_path
-from pbn.palette import load_palette
-from pbn.datatypes import Color, Palette, PipelineRun, PipelineStageEnum, BaseSegmentedImage, ColoredSegmentedImage
+from pbn.algorithms.segmentation import WarmStartSegmentation
+from pbn.backends import use_backend
+from pbn.cache import StageCache, StageKeys, stage_keys
+from pbn.intermediate import IntermediateWriter
+from pbn.memory import MemoryPlan, plan_memory
+from pbn.palette import load_run_palette
+from pbn.palette_selection import select_palette
+from pbn.pbnseg import CompressionEnum, run_metadata, write_pbnseg
+from pbn.profiling import PipelineProfiler
+from pbn.writer import BAND_WRITERS, INDEXED_FORMATS, format_from_path, save_image, write_bands
+from pbn.datatypes import (
+    Color,
+    Palette,
+    PipelineRun,
+    PipelineStageEnum,
+    ColoredSegmentedImage,
+    OutputFormatEnum,
+    ProgressiveResult,
+)
+
+
+def load_preview(pipeline_run: PipelineRun, scale: float) -> Image.Image:
+    """A copy of the input image at scale times its resolution. When the input file is a JPEG of the same size,
+    it is decoded at a reduced size with draft(), which skips most of the decoding work."""
+    original = pipeline_run.original_image
+    size = (max(1, round(original.width * scale)), max(1, round(original.height * scale)))
+    if pipeline_run.input_path is None:
+        return original.resize(size, Image.Resampling.BOX)
+    try:
+        with Image.open(pipeline_run.input_path) as image:
+            if image.format == "JPEG" and image.size == original.size:
+                image.draft("RGB", size)
+                return image.convert(original.mode).resize(size, Image.Resampling.BOX)
+    except OSError:
+        pass
+    return original.resize(size, Image.Resampling.BOX)
+
+
+def write_rendered_bands(
+    rendering: SegmentRenderingAlgorithm,
+    colored_segments: ColoredSegmentedImage,
+    palette: Palette,
+    output_path: pathlib.Path,
+    band_height: int,
+    output_format: OutputFormatEnum,
+    indexed: bool,
+) -> pathlib.Path:
+    """Render the segments in bands while writing them, as index bands with a palette when indexed and the
+    rendering algorithm supports it."""
+    index_bands = rendering.render_indexed_bands(colored_segments, palette, band_height) if indexed else None
+    if index_bands is not None:
+        colors, bands = index_bands
+        return write_bands(
+            output_path, colored_segments.width, colored_segments.height, bands, output_format, colors
+        )
+    bands = rendering.render_bands(colored_segments, band_height)
+    return write_bands(output_path, colored_segments.width, colored_segments.height, bands, output_format)
 
 
 class PaintByNumber:
@@ -25,124 +78,294 @@ class PaintByNumber:
 
     pipeline_run: PipelineRun
     palette: Palette
+    palette_selection: Optional[List[int]]
     preprocessing: List[ImageProcessingAlgorithm]
     segmentation: ImageSegmentationAlgorithm
     postprocessing: List[SegmentsProcessingAlgorithm]
     assignment: ColorAssignmentAlgorithm
     rendering: SegmentRenderingAlgorithm
     intermediate_dir: Optional[pathlib.Path]
+    cache: Optional[StageCache]
+    profiler: PipelineProfiler
+    memory_plan: Optional[MemoryPlan]
+
+    def __init__(
+        self,
+        pipeline_run: PipelineRun,
+        palette: Optional[Palette] = None,
+        profiler: Optional[PipelineProfiler] = None,
+    ):
+        """Initialize the pipeline with palette and optional algorithms.
+        An already loaded palette can be passed to skip reading pipeline_run.palette_path.
+        With pipeline_run.palette_size, the palette is reduced to the colors that fit the input image best, and
+        palette_selection holds their indices in the full palette.
+        A profiler collects per-stage metrics and reports them to its hooks.
+        With pipeline_run.max_memory, cheaper strategies are picked for the stages that would not fit, and
+        MemoryBudgetError is raised right away when no strategy fits."""
+        palette = palette if palette is not None else load_run_palette(pipeline_run)
+        self.memory_plan = None
+        if pipeline_run.max_memory is not None:
+            palette_size = min(len(palette), pipeline_run.palette_size or len(palette))
+            with use_backend(pipeline_run.backend):
+                self.memory_plan = plan_memory(pipeline_run, palette_size=palette_size)
+            pipeline_run = self.memory_plan.pipeline_run
 
-    def __init__(self, pipeline_run: PipelineRun):
-        """Initialize the pipeline with palette and optional algorithms."""
         self.pipeline_run = pipeline_run
-        self.palette = load_palette(pipeline_run.palette_path)
+        self.profiler = profiler or PipelineProfiler.disabled()
+        self.palette = palette
+        self.palette_selection = None
+        if pipeline_run.palette_size is not None:
+            with self.profiler.stage(PipelineStageEnum.PALETTE_SELECTION, "greedy-swap") as recorder:
+                recorder.input(pipeline_run.original_image)
+                self.palette_selection = select_palette(
+                    pipeline_run.original_image, self.palette, pipeline_run.palette_size
+                )
+                self.palette = [self.palette[i] for i in self.palette_selection]
         self.preprocessing = pipeline_run.preprocessing
         self.segmentation = pipeline_run.segmentation
         self.postprocessing = pipeline_run.postprocessing
         self.assignment = pipeline_run.assignment
         self.rendering = pipeline_run.rendering
         self.intermediate_dir = pipeline_run.intermediate_dir
+        self.cache = None
+        if pipeline_run.cache_dir:
+            self.cache = StageCache(pipeline_run.cache_dir, pipeline_run.cache_max_bytes)
 
     def process(self) -> Image.Image | Tuple[Image.Image, Dict[int, Color]]:
         """Run the full pipeline on the input image and return the processed image."""
-        image = self.pipeline_run.original_image.copy()
+        return self._render(self.process_segments())
 
-        preprocessed_image = image.copy()
+    def _render(self, processed_segments: ColoredSegmentedImage) -> Image.Image | Tuple[Image.Image, Dict[int, Color]]:
+        with use_backend(self.pipeline_run.backend), self.profiler.stage(
+            PipelineStageEnum.RENDERING, self.rendering.name
+        ) as recorder:
+            recorder.input(processed_segments)
+            rendering_output = self.rendering.render(processed_segments)
+            recorder.output(rendering_output)
+        return rendering_output
 
-        for step, preprocessing_algo in enumerate(self.preprocessing):
-            preprocessed_image = preprocessing_algo.process(preprocessed_image, self.palette)
+    def process_image(self, output_format: OutputFormatEnum) -> Image.Image:
+        """Run the full pipeline and return the image to save in output_format: palette-indexed (mode "P") when the
+        format has a palette and the rendering algorithm supports it, unless pipeline_run.indexed is off."""
+        return self.output_image(self.process_segments(), output_format)
 
-            if self.intermediate_dir and preprocessing_algo.name != PreprocessingEnum.NONE:
-                output_path = resolve_intermediate_path(self.pipeline_run, PipelineStageEnum.PREPROCESSING, step)
-                preprocessed_image.save(output_path)
-                print(f"Saved intermediate image to: {output_path}")
+    def output_image(
+        self, processed_segments: ColoredSegmentedImage, output_format: Optional[OutputFormatEnum] = None
+    ) -> Image.Image:
+        """Render final colored segments to the image to save in output_format, or to an RGB image without one."""
+        if self.pipeline_run.indexed and output_format in INDEXED_FORMATS:
+            indexed_image = self._render_indexed(processed_segments)
+            if indexed_image is not None:
+                return indexed_image
+        result = self._render(processed_segments)
+        return result if isinstance(result, Image.Image) else result[0]
+
+    def _render_indexed(self, processed_segments: ColoredSegmentedImage) -> Optional[Image.Image]:
+        with use_backend(self.pipeline_run.backend), self.profiler.stage(
+            PipelineStageEnum.RENDERING, self.rendering.name
+        ) as recorder:
+            recorder.input(processed_segments)
+            rendering_output = self.rendering.render_indexed(processed_segments, self.palette)
+            if rendering_output is None:
+                recorder.discard()
+            recorder.output(rendering_output)
+        return rendering_output
 
-        segments = self.segmentation.segment(preprocessed_image)
+    def process_progressive(self, preview_scale: float = 0.25) -> Iterator[ProgressiveResult]:
+        """Yield a quick result of the pipeline on the input at preview_scale times its resolution, then the
+        full-resolution result. The full-resolution segmentation is warm-started from the preview's where the
+        algorithm supports it (kmeans centers, voronoi seeds, watershed markers)."""
+        if not 0 < preview_scale < 1:
+            raise ValueError("preview_scale must be in (0, 1)")
 
-        if self.intermediate_dir:
-            self._save_intermediate_segments(
-                PipelineStageEnum.SEGMENTATION, self.segmentation.name, image, preprocessed_image, segments
-            )
+        start = time.perf_counter()
+        segmentation = WarmStartSegmentation(self.segmentation)
+        # The run is already fitted to the memory budget, and the preview is smaller still.
+        run = replace(self.pipeline_run, segmentation=segmentation, max_memory=None)
+
+        preview_run = replace(
+            run,
+            original_image=load_preview(self.pipeline_run, preview_scale),
+            intermediate_dir=None,
+            band_height=None,
+            cache_dir=None,
+        )
+        preview = PaintByNumber(preview_run, palette=self.palette).process()
+        yield ProgressiveResult(preview, preview_scale, False, time.perf_counter() - start)
+
+        result = PaintByNumber(run, palette=self.palette, profiler=self.profiler).process()
+        yield ProgressiveResult(result, 1.0, True, time.perf_counter() - start)
+
+    def process_bands(self, band_height: int) -> Tuple[int, int, Iterator[np.ndarray]]:
+        """Run the pipeline and return the output size with an iterator over rendered RGB row bands.
+        Rendering happens lazily while the bands are consumed, e.g. by pbn.writer.write_bands."""
+        processed_segments = self.process_segments()
+        bands = self.rendering.render_bands(processed_segments, band_height)
+        return processed_segments.width, processed_segments.height, bands
+
+    def save(
+        self,
+        output_path: pathlib.Path,
+        segments_path: Optional[pathlib.Path] = None,
+        segments_compression: CompressionEnum = CompressionEnum.ZLIB,
+    ) -> pathlib.Path:
+        """Run the pipeline and save the result, streamed in bands when the run has a band height and the format has
+        a band writer. The format is pipeline_run.output_format, or follows the extension of output_path with PPM
+        for unknown ones. PNG and TIFF images are palette-indexed unless pipeline_run.indexed is off.
+        With segments_path, the final colored segments are also saved there in the .pbnseg format."""
+        processed_segments = self.process_segments()
+        if segments_path is not None:
+            with self.profiler.stage("output", "pbnseg"):
+                write_pbnseg(
+                    segments_path,
+                    processed_segments,
+                    self.palette,
+                    run_metadata(self.pipeline_run),
+                    segments_compression,
+                )
+
+        output_format = self.pipeline_run.output_format or format_from_path(output_path)
+        # Formats that cannot be streamed, such as JPEG, are rendered in one piece even with a band height.
+        if self.pipeline_run.band_height and output_format in BAND_WRITERS:
+            # Bands are rendered while they are written, so both are measured together.
+            with self.profiler.stage(PipelineStageEnum.RENDERING, self.rendering.name):
+                return write_rendered_bands(
+                    self.rendering,
+                    processed_segments,
+                    self.palette,
+                    output_path,
+                    self.pipeline_run.band_height,
+                    output_format,
+                    self.pipeline_run.indexed and output_format in INDEXED_FORMATS,
+                )
 
-        colored_segments = self.assignment.assign_colors(preprocessed_image, segments, self.palette)
+        result_image = self.output_image(processed_segments, output_format)
+        with self.profiler.stage("output", output_format):
+            save_image(output_path, result_image, output_format)
+        return output_path
+
+    def process_segments(self) -> ColoredSegmentedImage:
+        """Run every stage up to, but not including, rendering and return the final colored segments.
+        With a cache, the run resumes from the deepest cached stage output."""
+        with use_backend(self.pipeline_run.backend):
+            if not self.intermediate_dir:
+                return self._process_segments(None)
+
+            with IntermediateWriter(self.pipeline_run) as intermediate:
+                return self._process_segments(intermediate)
+
+    def _process_segments(self, intermediate: Optional[IntermediateWriter]) -> ColoredSegmentedImage:
+        # Stages never modify their input image in place, so the original is shared rather than copied.
+        # Algorithms that write to an image convert it to a new one first, and PIL copies read-only
+        # (memory-mapped) images before writing to them.
+        image = self.pipeline_run.original_image
+        if intermediate:
+            # Lazily opened images decode on first use, which is not safe from several threads at once.
+            image.load()
+        preprocessing = [p for p in self.preprocessing if p.name != PreprocessingEnum.NONE]
+        keys = (
+            stage_keys(image, self.palette, preprocessing, self.segmentation, self.assignment) if self.cache else None
+        )
+
+        colored_segments = None
+        if self.cache and keys:
+            with self.profiler.stage(PipelineStageEnum.COLOR_ASSINGMENT, self.assignment.name) as recorder:
+                colored_segments = self.cache.load_colored_segments(keys.assignment)
+                if colored_segments is None:
+                    recorder.discard()
+                recorder.output(colored_segments, cached=True)
+
+        if colored_segments is None or intermediate:
+            preprocessed_image = self._preprocess(image, keys, intermediate)
+
+            with self.profiler.stage(PipelineStageEnum.SEGMENTATION, self.segmentation.name) as recorder:
+                segments = self.cache.load_segments(keys.segmentation) if self.cache and keys else None
+                recorder.output(segments, cached=True)
+                if segments is None:
+                    segments = self.segmentation.segment(preprocessed_image)
+                    recorder.output(segments)
+                    if self.cache and keys:
+                        self.cache.store_segments(keys.segmentation, segments)
+
+            if intermediate:
+                intermediate.save_segments(
+                    PipelineStageEnum.SEGMENTATION,
+                    0,
+                    image,
+                    self._intermediate_preprocessed(preprocessed_image),
+                    segments,
+                )
+
+            if colored_segments is None:
+                with self.profiler.stage(PipelineStageEnum.COLOR_ASSINGMENT, self.assignment.name) as recorder:
+                    recorder.input(segments)
+                    colored_segments = self.assignment.assign_colors(preprocessed_image, segments, self.palette)
+                    recorder.output(colored_segments)
+                    if self.cache and keys:
+                        self.cache.store_colored_segments(keys.assignment, colored_segments)
+        else:
+            preprocessed_image = image
 
         processed_segments = colored_segments.copy()
 
         for step, postprocessing_algo in enumerate(self.postprocessing):
-            processed_segments = postprocessing_algo.process(processed_segments, self.palette)
+            with self.profiler.stage(PipelineStageEnum.POSTPROCESSING, postprocessing_algo.name, step) as recorder:
+                recorder.input(processed_segments)
+                processed_segments = postprocessing_algo.process(processed_segments, self.palette)
+                recorder.output(processed_segments)
 
-            if self.intermediate_dir and postprocessing_algo.name != PostprocessingEnum.NONE:
-                self._save_intermediate_segments(
+            if intermediate and postprocessing_algo.name != PostprocessingEnum.NONE:
+                intermediate.save_segments(
                     PipelineStageEnum.POSTPROCESSING,
-                    postprocessing_algo.name,
+                    step,
                     image,
-                    preprocessed_image,
+                    self._intermediate_preprocessed(preprocessed_image),
                     processed_segments,
-                    step,
                 )
 
-        rendering_output = self.rendering.render(processed_segments)
-        return rendering_output
+        return processed_segments
 
-    def _save_intermediate_segments(
-        self,
-        stage: PipelineStageEnum,
-        algorithm_name: str,
-        base_image: Image.Image,
-        preprocessed_image: Image.Image,
-        segments: BaseSegmentedImage,
-        step: int = 0,
-    ) -> None:
-        output_path = resolve_intermediate_path(self.pipeline_run, stage, step, "boundary-mask")
-        boundary_mask = self._create_boundary_mask(segments)
-        boundary_mask.save(output_path)
-        print(f"Saved intermediate image to: {output_path}")
-
-        output_path = resolve_intermediate_path(self.pipeline_run, stage, step, "boundary-overlay-original")
-        self._overlay_boundaries(base_image, boundary_mask).save(output_path)
-        print(f"Saved intermediate image to: {output_path}")
-
-        output_path = resolve_intermediate_path(self.pipeline_run, stage, step, "segments-average-original")
-        self._segements_average_color_image(base_image, segments).save(output_path)
-        print(f"Saved intermediate image to: {output_path}")
-
-        if self.preprocessing and not all([p.name == PreprocessingEnum.NONE for p in self.preprocessing]):
-            output_path = resolve_intermediate_path(self.pipeline_run, stage, step, "boundary-overlay-preprocessed")
-            self._overlay_boundaries(preprocessed_image, boundary_mask).save(output_path)
-            print(f"Saved intermediate image to: {output_path}")
-
-            output_path = resolve_intermediate_path(self.pipeline_run, stage, step, "segments-average-preprocessed")
-            self._segements_average_color_image(preprocessed_image, segments).save(output_path)
-            print(f"Saved intermediate image to: {output_path}")
-
-    def _create_boundary_mask(self, segments: BaseSegmentedImage) -> Image.Image:
-        """Create a black-and-white mask of segment boundaries."""
-        labels = np.array(segments.labels)
-        boundaries = skimage.segmentation.find_boundaries(labels, mode="outer")
-        mask_array = np.zeros(labels.shape, dtype=np.uint8)
-        mask_array[boundaries] = 255
-        return Image.fromarray(mask_array, mode="L")
-
-    def _overlay_boundaries(self, base_image: Image.Image, boundary_mask: Image.Image) -> Image.Image:
-        """Overlay segment boundaries on a base image using a mask."""
-        white = Image.new("RGB", base_image.size, (255, 255, 255))
-        blended = Image.blend(base_image, white, alpha=0.5)
-        return Image.composite(blended, base_image, boundary_mask.convert("L"))
-
-    def _segements_average_color(self, base_image: Image.Image, segments: BaseSegmentedImage) -> ColoredSegmentedImage:
-        base_image = base_image.convert("RGB")
-        src_pixels = base_image.load()
-        if src_pixels is None:
-            raise ValueError("Failed to load image pixels.")
-
-        color_map: Dict[int, Color] = {}
-
-        for segment in segments.segments:
-            color_map[segment.id] = AverageNearestColorAssignment.average_color(segment, src_pixels)
-
-        return ColoredSegmentedImage.from_segments(segments, base_image.width, base_image.height, color_map)
-
-    def _segements_average_color_image(self, base_image: Image.Image, segments: BaseSegmentedImage) -> Image.Image:
-        colored_segments = self._segements_average_color(base_image, segments)
-
-        return ColoredRendering().render(colored_segments)
+    def _preprocess(
+        self, image: Image.Image, keys: Optional[StageKeys], intermediate: Optional[IntermediateWriter]
+    ) -> Image.Image:
+        """Run the preprocessing chain, starting after the deepest step whose output is cached."""
+        steps = [(step, p) for step, p in enumerate(self.preprocessing) if p.name != PreprocessingEnum.NONE]
+        preprocessed_image = image
+        start = 0
+
+        if self.cache and keys:
+            for i in reversed(range(len(steps))):
+                step, preprocessing_algo = steps[i]
+                with self.profiler.stage(PipelineStageEnum.PREPROCESSING, preprocessing_algo.name, step) as recorder:
+                    cached_image = self.cache.load_image(keys.preprocessing[i])
+                    if cached_image is None:
+                        recorder.discard()
+                    recorder.output(cached_image, cached=True)
+                if cached_image is not None:
+                    preprocessed_image, start = cached_image, i + 1
+                    break
+
+            if intermediate:
+                for i in range(start):
+                    step_image = preprocessed_image if i == start - 1 else self.cache.load_image(keys.preprocessing[i])
+                    if step_image is not None:
+                        intermediate.save_image(PipelineStageEnum.PREPROCESSING, steps[i][0], step_image)
+
+        for i in range(start, len(steps)):
+            step, preprocessing_algo = steps[i]
+            with self.profiler.stage(PipelineStageEnum.PREPROCESSING, preprocessing_algo.name, step) as recorder:
+                preprocessed_image = preprocessing_algo.process(preprocessed_image, self.palette)
+                recorder.output(preprocessed_image)
+
+                if self.cache and keys:
+                    self.cache.store_image(keys.preprocessing[i], preprocessed_image)
+            if intermediate:
+                intermediate.save_image(PipelineStageEnum.PREPROCESSING, step, preprocessed_image)
+
+        return preprocessed_image
+
+    def _intermediate_preprocessed(self, preprocessed_image: Image.Image) -> Optional[Image.Image]:
+        """The preprocessed image for intermediate snapshots, or None when preprocessing does nothing."""
+        if all(p.name == PreprocessingEnum.NONE for p in self.preprocessing):
+            return None
+        return preprocessed_image
@@ -6,6 +6,8 @@ from PIL import Image
 from abc import ABC, abstractmethod
 import pathlib
 
+from pbn.backends import BackendEnum
+
 if TYPE_CHECKING:
     from pbn.algorithms import (
         ImageProcessingAlgorithm,
@@ -21,6 +23,7 @@ Palette = List[Color]
 
 
 class PipelineStageEnum(StrEnum):
+    PALETTE_SELECTION = "palette-selection"
     PREPROCESSING = "preprocessing"
     SEGMENTATION = "segmentation"
     COLOR_ASSINGMENT = "color-assignment"
@@ -28,13 +31,23 @@ class PipelineStageEnum(StrEnum):
     RENDERING = "rendering"
 
 
+class OutputFormatEnum(StrEnum):
+    PPM = "ppm"
+    PNG = "png"
+    JPG = "jpg"
+    NPY = "npy"
+    TIFF = "tiff"
+
+
 @dataclass
 class PipelineRun:
     """Encapsulates all metadata and objects for a single PaintByNumber pipeline execution."""
 
-    input_path: pathlib.Path
+    # The files the image and palette were read from, which name the outputs. None for an image or palette that was
+    # given in memory, in which case the palette is passed to PaintByNumber.
+    input_path: Optional[pathlib.Path]
     original_image: Image.Image
-    palette_path: pathlib.Path
+    palette_path: Optional[pathlib.Path]
 
     preprocessing: List[ImageProcessingAlgorithm]
     segmentation: ImageSegmentationAlgorithm
@@ -43,6 +56,30 @@ class PipelineRun:
     rendering: SegmentRenderingAlgorithm
 
     intermediate_dir: Optional[pathlib.Path] = None
+    intermediate_format: OutputFormatEnum = OutputFormatEnum.PPM
+    intermediate_scale: float = 1.0
+    band_height: Optional[int] = None
+    cache_dir: Optional[pathlib.Path] = None
+    cache_max_bytes: Optional[int] = None
+    max_memory: Optional[int] = None
+    palette_size: Optional[int] = None
+    # The format of the output; None follows the output path's extension.
+    output_format: Optional[OutputFormatEnum] = None
+    # Save palette-indexed images where the format has a palette (PNG, TIFF) and at most 256 colors are used.
+    indexed: bool = True
+    # The implementation of the algorithms that have several; all of them give the same result.
+    backend: BackendEnum = BackendEnum.FAST
+
+
+@dataclass
+class ProgressiveResult:
+    """One result of a progressive run: the rendering output at scale times the input resolution.
+    seconds is the time from the start of the run until the result was ready."""
+
+    output: Image.Image | Tuple[Image.Image, Dict[int, Color]]
+    scale: float
+    final: bool
+    seconds: float
 
 
 @dataclass
@@ -0,0 +1,93 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Callable, Tuple
+from PIL import Image
+
+import numpy as np
+
+from pbn.profiling import record
+
+
+# Taking the histogram of an image with mostly distinct colors costs more than it saves. The compression is
+# estimated on a sample of about this many pixels first.
+SAMPLE_PIXELS = 1 << 16
+MIN_COMPRESSION = 2.0
+
+
+def pack_rgb(pixels: np.ndarray) -> np.ndarray:
+    """Pack the RGB values of an array of shape (..., 3) into one uint32 per color."""
+    pixels = pixels.astype(np.uint32, copy=False)
+    packed: np.ndarray = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    return packed
+
+
+def unpack_rgb(packed: np.ndarray) -> np.ndarray:
+    """Unpack uint32 colors into an array of shape (..., 3) of uint8 RGB values."""
+    return np.stack([packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF], axis=-1).astype(np.uint8)
+
+
+@dataclass
+class ColorHistogram:
+    """The distinct colors of an image or color array, with their counts and the index of every pixel's color.
+
+    Pointwise color computations can be done once per distinct color and scattered back to the pixels, which gives
+    the same result for a fraction of the work: photos have far fewer distinct colors than pixels, and dithered
+    images only a handful."""
+
+    colors: np.ndarray
+    counts: np.ndarray
+    inverse: np.ndarray
+    shape: Tuple[int, ...]
+
+    @classmethod
+    def from_array(cls, pixels: np.ndarray) -> ColorHistogram:
+        """Take the histogram of an array of shape (..., 3) with RGB values in [0, 255]."""
+        keys, inverse, counts = np.unique(pack_rgb(pixels).ravel(), return_inverse=True, return_counts=True)
+        return cls(unpack_rgb(keys), counts, inverse.ravel(), pixels.shape[:-1])
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> ColorHistogram:
+        return cls.from_array(np.asarray(image.convert("RGB")))
+
+    @property
+    def size(self) -> int:
+        return int(self.inverse.size)
+
+    @property
+    def compression_ratio(self) -> float:
+        """The number of pixels per distinct color."""
+        return self.size / max(len(self.colors), 1)
+
+    def scatter(self, values: np.ndarray) -> np.ndarray:
+        """Map per-color values (one row per distinct color) back to the pixels, in the shape of the input."""
+        scattered: np.ndarray = values[self.inverse].reshape(self.shape + values.shape[1:])
+        return scattered
+
+    def record(self) -> None:
+        """Add the number of distinct colors and the compression ratio to the stats of the profiled stage."""
+        record("distinct_colors", len(self.colors))
+        record("color_compression", round(self.compression_ratio, 2))
+
+
+def estimate_compression(pixels: np.ndarray) -> float:
+    """Estimate the pixels per distinct color of an array of shape (..., 3) from a regular sample of its pixels.
+    Small samples have relatively more distinct colors, so this tends to underestimate."""
+    flat = pixels.reshape(-1, 3)
+    sample = pack_rgb(flat[:: max(1, len(flat) // SAMPLE_PIXELS)])
+    return len(sample) / max(len(np.unique(sample)), 1)
+
+
+def map_colors(fn: Callable[[np.ndarray], np.ndarray], pixels: np.ndarray) -> np.ndarray:
+    """Apply a pointwise function of an (n, 3) array of RGB colors, returning one row per color, to every pixel of
+    an array of shape (..., 3). It is applied once per distinct color when the pixels compress well enough, and to
+    all pixels otherwise. Both give the same result."""
+    estimate = estimate_compression(pixels)
+    if estimate < MIN_COMPRESSION:
+        record("color_compression", round(estimate, 2))
+        result = fn(pixels.reshape(-1, 3))
+        mapped: np.ndarray = result.reshape(pixels.shape[:-1] + result.shape[1:])
+        return mapped
+
+    histogram = ColorHistogram.from_array(pixels)
+    histogram.record()
+    return histogram.scatter(fn(histogram.colors))
@@ -0,0 +1,78 @@
+from typing import BinaryIO, List, Tuple
+from PIL import Image
+import pathlib
+
+import numpy as np
+
+
+# Magic numbers of the binary Netpbm formats: a short text header followed by the raw samples.
+NETPBM_CHANNELS = {b"P5": 1, b"P6": 3}
+
+# Image modes PIL stores with the same layout as a uint8 array, so they can use its memory without a copy.
+MAPPABLE_MODES = {1: "L", 4: "RGBA"}
+
+
+def read_netpbm_header(f: BinaryIO) -> Tuple[int, int, int, int, int]:
+    """Parse the header of a binary PGM or PPM file. Returns (channels, width, height, maxval, data offset)."""
+    magic = f.read(2)
+    if magic not in NETPBM_CHANNELS:
+        raise ValueError("Not a binary PGM or PPM file")
+
+    fields: List[int] = []
+    token = b""
+    while len(fields) < 3:
+        char = f.read(1)
+        if not char:
+            raise ValueError("Truncated PGM or PPM header")
+        if char == b"#":
+            f.readline()
+        elif char.isspace():
+            if token:
+                fields.append(int(token))
+                token = b""
+        else:
+            token += char
+
+    width, height, maxval = fields
+    # Exactly one whitespace character separates the header from the samples.
+    return NETPBM_CHANNELS[magic], width, height, maxval, f.tell()
+
+
+def image_from_array(array: np.ndarray) -> Image.Image:
+    """Wrap a uint8 array of shape (height, width) or (height, width, channels) in an image.
+
+    Grayscale and RGBA arrays are used directly as a read-only image without a copy. PIL keeps RGB images with 4 bytes
+    per pixel, so RGB arrays are converted once. PIL copies a read-only image before anything writes to it."""
+    if array.dtype != np.uint8:
+        raise ValueError(f"Expected an array of uint8 samples, got {array.dtype}")
+    channels = 1 if array.ndim == 2 else array.shape[2] if array.ndim == 3 else 0
+    if channels not in (1, 3, 4):
+        raise ValueError(f"Expected an array of shape (height, width) or (height, width, 3 or 4), got {array.shape}")
+
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    if channels in MAPPABLE_MODES:
+        mode = MAPPABLE_MODES[channels]
+        return Image.frombuffer(mode, (width, height), array, "raw", mode, 0, 1)
+    return Image.frombuffer("RGB", (width, height), array, "raw", "RGB", 0, 1)
+
+
+def open_image(path: pathlib.Path) -> Image.Image:
+    """Open an input image without holding more copies of it in memory than the pipeline needs.
+
+    .npy arrays and binary PGM and PPM files with samples up to 255 are memory-mapped, so their pages are read by the
+    operating system as the pixels are used instead of being read into memory up front. Other formats are opened
+    lazily with PIL and decoded on first use."""
+    if path.suffix.lower() == ".npy":
+        return image_from_array(np.load(path, mmap_mode="r"))
+
+    with path.open("rb") as f:
+        if f.read(2) in NETPBM_CHANNELS:
+            f.seek(0)
+            channels, width, height, maxval, offset = read_netpbm_header(f)
+            # Other maximum values need their samples scaled to 0..255, which PIL does.
+            if maxval == 255:
+                shape = (height, width) if channels == 1 else (height, width, channels)
+                return image_from_array(np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=shape))
+
+    return Image.open(path)
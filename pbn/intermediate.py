@@ -0,0 +1,236 @@
+from __future__ import annotations
+from types import TracebackType
+from typing import Callable, List, Optional, Tuple, Type
+from PIL import Image
+import pathlib
+import queue
+import threading
+
+import numpy as np
+import skimage
+
+from pbn.datatypes import BaseSegmentedImage, PipelineRun, PipelineStageEnum
+from pbn.output import resolve_intermediate_path
+from pbn.parallel import concatenate_rows, label_sums, map_rows
+from pbn.writer import (
+    BAND_WRITERS,
+    INDEXED_FORMATS,
+    MAX_INDEXED_COLORS,
+    indexed_image,
+    save_array,
+    save_image,
+    write_bands,
+)
+
+
+def label_array(segments: BaseSegmentedImage) -> np.ndarray:
+    """Return the label map of the segments as an integer array."""
+    return np.array(segments.labels, dtype=np.int64).reshape(segments.height, segments.width)
+
+
+def boundary_mask(labels: np.ndarray) -> np.ndarray:
+    """Return a boolean mask of the pixels just outside each segment boundary.
+
+    The mask only depends on the 3x3 neighborhood of every pixel, so it is computed in row bands on the shared thread
+    pool, each with one extra row of context above and below."""
+    height, width = labels.shape
+
+    def band(y0: int, y1: int) -> np.ndarray:
+        top, bottom = max(y0 - 1, 0), min(y1 + 1, height)
+        mask = skimage.segmentation.find_boundaries(labels[top:bottom], mode="outer")
+        return np.asarray(mask[y0 - top : y1 - top], dtype=bool)
+
+    return concatenate_rows(band, height, width)
+
+
+def overlay_boundaries(base: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Blend the masked pixels of an RGB array halfway to white."""
+    overlay = base.copy()
+
+    def band(y0: int, y1: int) -> None:
+        rows = overlay[y0:y1]
+        rows[mask[y0:y1]] = (base[y0:y1][mask[y0:y1]].astype(np.uint16) + 255) // 2
+
+    map_rows(band, *mask.shape)
+    return overlay
+
+
+def segment_average_lookup(base: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Compute the average color of every label at once.
+
+    Returns a table indexed by (label - offset) and the offset. Like AverageNearestColorAssignment.assign_colors,
+    the averages are rounded down. Unlabeled pixels (-1) map to black."""
+    sums, counts, offset = label_sums(base, labels)
+
+    lookup = np.zeros((len(counts), 3), dtype=np.uint8)
+    present = counts > 0
+    lookup[present] = sums[present] // counts[present, None]
+    lookup[-1 - offset] = 0
+    return lookup, offset
+
+
+def apply_lookup(lookup: np.ndarray, labels: np.ndarray, offset: int) -> np.ndarray:
+    """Map every label to its row of the lookup table, in row bands."""
+    return concatenate_rows(lambda y0, y1: lookup[labels[y0:y1] - offset], *labels.shape)
+
+
+def downscale(base: np.ndarray, labels: np.ndarray, scale: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Downscale an RGB array by box filtering and its label map by nearest-neighbor sampling."""
+    height, width = labels.shape
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    small_base = np.asarray(Image.fromarray(base).resize((new_width, new_height), Image.Resampling.BOX))
+    ys = np.minimum(((np.arange(new_height) + 0.5) * height / new_height).astype(np.int64), height - 1)
+    xs = np.minimum(((np.arange(new_width) + 0.5) * width / new_width).astype(np.int64), width - 1)
+    return small_base, labels[np.ix_(ys, xs)]
+
+
+class IntermediateWriter:
+    """Produces and saves intermediate images on background threads.
+
+    Snapshots are queued in a bounded queue, so the pipeline only waits when the writers fall behind.
+    Errors raised while writing are re-raised by close()."""
+
+    pipeline_run: PipelineRun
+
+    def __init__(self, pipeline_run: PipelineRun, workers: int = 1, max_queue: int = 4):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if not 0 < pipeline_run.intermediate_scale <= 1:
+            raise ValueError("intermediate_scale must be in (0, 1]")
+        self.pipeline_run = pipeline_run
+        self.jobs: queue.Queue[Optional[Callable[[], None]]] = queue.Queue(max_queue)
+        self.errors: List[BaseException] = []
+        self.threads = [
+            threading.Thread(target=self._work, name=f"pbn-intermediate-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def save_image(self, stage: PipelineStageEnum, step: int, image: Image.Image) -> None:
+        """Queue an image, e.g. a preprocessing result, to be saved as is."""
+        self._submit(lambda: self._write_image(stage, step, image))
+
+    def save_segments(
+        self,
+        stage: PipelineStageEnum,
+        step: int,
+        base_image: Image.Image,
+        preprocessed_image: Optional[Image.Image],
+        segments: BaseSegmentedImage,
+    ) -> None:
+        """Queue the boundary mask, boundary overlays and segment average images of a segmentation snapshot.
+        The preprocessed variants are only written when a preprocessed image is given."""
+        self._submit(lambda: self._write_segments(stage, step, base_image, preprocessed_image, segments))
+
+    def close(self) -> None:
+        """Wait for all queued snapshots to be written and stop the threads."""
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self) -> IntermediateWriter:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # The pipeline failed: drop what has not been written yet.
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _submit(self, job: Callable[[], None]) -> None:
+        if self.errors:
+            raise self.errors[0]
+        self.jobs.put(job)
+
+    def _work(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except BaseException as e:
+                self.errors.append(e)
+
+    def _write_image(self, stage: PipelineStageEnum, step: int, image: Image.Image) -> None:
+        pixels = np.asarray(image.convert("RGB"))
+        scale = self.pipeline_run.intermediate_scale
+        if scale < 1:
+            new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            pixels = np.asarray(Image.fromarray(pixels).resize(new_size, Image.Resampling.BOX))
+        # Preprocessed images, e.g. dithered ones, often use a few palette colors only.
+        self._save(resolve_intermediate_path(self.pipeline_run, stage, step), pixels, indexed=True)
+
+    def _write_segments(
+        self,
+        stage: PipelineStageEnum,
+        step: int,
+        base_image: Image.Image,
+        preprocessed_image: Optional[Image.Image],
+        segments: BaseSegmentedImage,
+    ) -> None:
+        full_labels = label_array(segments)
+        variants = [("original", base_image)]
+        if preprocessed_image is not None:
+            variants.append(("preprocessed", preprocessed_image))
+
+        mask: Optional[np.ndarray] = None
+        for name, image in variants:
+            base = np.asarray(image.convert("RGB"))
+            labels = full_labels
+            if self.pipeline_run.intermediate_scale < 1:
+                base, labels = downscale(base, full_labels, self.pipeline_run.intermediate_scale)
+
+            if mask is None:
+                mask = boundary_mask(labels)
+                path = resolve_intermediate_path(self.pipeline_run, stage, step, "boundary-mask")
+                self._save(path, mask.astype(np.uint8) * 255)
+
+            path = resolve_intermediate_path(self.pipeline_run, stage, step, f"boundary-overlay-{name}")
+            self._save(path, overlay_boundaries(base, mask))
+
+            lookup, offset = segment_average_lookup(base, labels)
+            path = resolve_intermediate_path(self.pipeline_run, stage, step, f"segments-average-{name}")
+            self._save_lookup(path, lookup, labels, offset)
+
+    def _save_lookup(self, path: pathlib.Path, lookup: np.ndarray, labels: np.ndarray, offset: int) -> None:
+        """Save the image of the lookup table rows of the labels, in bands when the run has a band height.
+        When the table has few enough distinct colors, the image is palette-indexed straight from the labels."""
+        output_format = self.pipeline_run.intermediate_format
+        colors: Optional[np.ndarray] = None
+        if self.pipeline_run.indexed and output_format in INDEXED_FORMATS:
+            distinct, inverse = np.unique(lookup, axis=0, return_inverse=True)
+            if len(distinct) <= MAX_INDEXED_COLORS:
+                colors, lookup = distinct, inverse.reshape(-1).astype(np.uint8)
+
+        band_height = self.pipeline_run.band_height
+        if band_height and output_format in BAND_WRITERS:
+            height, width = labels.shape
+            bands = (lookup[labels[y0 : y0 + band_height] - offset] for y0 in range(0, height, band_height))
+            write_bands(path, width, height, bands, output_format, colors)
+        elif colors is not None:
+            save_image(path, indexed_image(apply_lookup(lookup, labels, offset), colors), output_format)
+        else:
+            save_array(path, apply_lookup(lookup, labels, offset), output_format)
+        print(f"Saved intermediate image to: {path}")
+
+    def _save(self, path: pathlib.Path, pixels: np.ndarray, indexed: bool = False) -> None:
+        save_array(path, pixels, self.pipeline_run.intermediate_format, indexed and self.pipeline_run.indexed)
+        print(f"Saved intermediate image to: {path}")
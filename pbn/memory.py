@@ -0,0 +1,317 @@
+from __future__ import annotations
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import copy
+import inspect
+
+from pbn.datatypes import PipelineRun, PipelineStageEnum
+
+
+# PIL keeps RGB images as 4 bytes per pixel.
+IMAGE_BYTES_PER_PIXEL = 4
+# Per-pixel bytes of the label list and the references that a colored copy of the segments adds.
+LABEL_BYTES_PER_PIXEL = 16
+# CPython shares the integer objects up to 256; every larger integer in a list is an object of its own.
+SMALL_INTS = 257
+INT_BYTES = 32
+# A pixel tuple of the segment representation and its reference in the over-allocated pixel list.
+PIXEL_TUPLE_BYTES = 64 + 9
+# What pbn.backends.group_pixels holds next to the segments it builds: the sort order of the pixels and the
+# references of their x and y coordinate lists.
+GROUP_BYTES_PER_PIXEL = 32
+# The float64 [x, y, r, g, b] features of a pixel, and the peak of building them: the float image, both
+# coordinate grids and the scaled colors are alive while they are stacked.
+FEATURE_BYTES_PER_PIXEL = 5 * 8
+FEATURE_BUILD_BYTES_PER_PIXEL = (3 + 2 + 3 + 5) * 8
+
+CHUNK_PIXELS = [1 << 20, 1 << 18, 1 << 16, 1 << 14, 1 << 12, 1 << 10]
+FIT_SAMPLES = [1 << 18, 1 << 16, 1 << 14]
+DOWNSCALES = [0.5, 0.25, 0.125]
+BAND_HEIGHTS = [256, 64, 16]
+CHUNK_BYTES = [1 << 20, 1 << 18, 1 << 16]
+
+
+def _large_int_share(count: int) -> float:
+    """The share of the integers 0..count-1 that are objects of their own."""
+    return max(0, count - SMALL_INTS) / count if count > 0 else 0.0
+
+
+def label_list_bytes(width: int, height: int, num_labels: int = 0) -> int:
+    """Bytes of a label map converted to nested lists: a reference per pixel and, assuming the labels are used
+    about evenly, an integer object for every pixel whose label is not shared."""
+    return int(width * height * (8 + INT_BYTES * _large_int_share(num_labels)))
+
+
+def held_segments_bytes(width: int, height: int) -> int:
+    """Bytes of the Python segment representation of an image: a pixel tuple per pixel, whose coordinates beyond
+    the shared integers are objects of their own."""
+    return int(
+        width * height * (PIXEL_TUPLE_BYTES + INT_BYTES * (_large_int_share(width) + _large_int_share(height)))
+    )
+
+
+def segments_bytes(width: int, height: int, num_labels: int = 0) -> int:
+    """Peak bytes of building the Python segment representation of an image from a label map of num_labels
+    labels: the nested label list and the segments."""
+    return label_list_bytes(width, height, num_labels) + held_segments_bytes(width, height)
+
+
+def grouped_segments_bytes(width: int, height: int) -> int:
+    """Peak bytes of building the Python segment representation of an image with pbn.backends.group_pixels."""
+    return width * height * GROUP_BYTES_PER_PIXEL + held_segments_bytes(width, height)
+
+
+def format_size(num_bytes: float) -> str:
+    if abs(num_bytes) < 1024:
+        return f"{num_bytes:.0f} B"
+    for unit in ("KiB", "MiB"):
+        num_bytes /= 1024
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+    return f"{num_bytes / 1024:.1f} GiB"
+
+
+@dataclass
+class StageEstimate:
+    """Estimated peak memory of one algorithm of one pipeline stage: what is still held from earlier stages plus
+    what the algorithm allocates."""
+
+    stage: str
+    algorithm: str
+    step: int
+    strategy: str
+    resident_bytes: int
+    working_bytes: int
+
+    @property
+    def peak_bytes(self) -> int:
+        return self.resident_bytes + self.working_bytes
+
+
+@dataclass
+class MemoryPlan:
+    """The pipeline run adapted to a memory budget, with the estimates it was chosen by."""
+
+    pipeline_run: PipelineRun
+    max_bytes: int
+    estimates: List[StageEstimate]
+
+    @property
+    def peak_bytes(self) -> int:
+        return max(e.peak_bytes for e in self.estimates)
+
+    @property
+    def strategies(self) -> List[StageEstimate]:
+        """The stages that run with a cheaper strategy than configured."""
+        return [e for e in self.estimates if e.strategy != "default"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "max_bytes": self.max_bytes,
+            "peak_bytes": self.peak_bytes,
+            "stages": [{**asdict(e), "peak_bytes": e.peak_bytes} for e in self.estimates],
+        }
+
+
+class MemoryBudgetError(MemoryError):
+    """Raised before a run starts when no strategy keeps its estimated peak memory within the budget."""
+
+    def __init__(self, width: int, height: int, max_bytes: int, estimates: List[StageEstimate], tried: List[str]):
+        self.max_bytes = max_bytes
+        self.estimates = estimates
+        lines = [
+            f"The estimated memory use of a {width}x{height} image exceeds the budget of {format_size(max_bytes)}.",
+            "Estimates with the last strategies tried:",
+        ]
+        for e in estimates:
+            marker = "  <-- over budget" if e.peak_bytes > max_bytes else ""
+            lines.append(
+                f"  {e.stage:<18} {e.algorithm:<18} {e.strategy:<28} "
+                f"{format_size(e.peak_bytes):>10} ({format_size(e.resident_bytes)} held + "
+                f"{format_size(e.working_bytes)} working){marker}"
+            )
+        lines.append(f"Tried strategies: {', '.join(tried)}.")
+        super().__init__("\n".join(lines))
+
+
+def segmentation_strategies(pipeline_run: PipelineRun) -> Iterator[Tuple[str, Any]]:
+    """Yield (strategy, segmentation algorithm) from the configured algorithm to the cheapest alternative.
+
+    Algorithms with a chunk_pixels attribute compute their distances in chunks, which gives identical results.
+    Algorithms with a fit_samples parameter can fit their model on a sample of the pixels. As a last resort,
+    the segmentation runs on a downscaled image and the labels are scaled back up."""
+    from pbn.algorithms.segmentation.downscaled import DownscaledSegmentation
+
+    cheapest = pipeline_run.segmentation
+    yield "default", cheapest
+
+    if hasattr(cheapest, "chunk_pixels"):
+        base = cheapest
+        for chunk_pixels in CHUNK_PIXELS:
+            cheapest = copy.copy(base)
+            cheapest.chunk_pixels = chunk_pixels
+            yield f"chunk_pixels={chunk_pixels}", cheapest
+
+    if "fit_samples" in inspect.signature(type(cheapest)).parameters:
+        base = cheapest
+        for fit_samples in FIT_SAMPLES:
+            cheapest = type(base)(**{**base.params, "fit_samples": fit_samples})
+            yield f"fit_samples={fit_samples}", cheapest
+
+    for scale in DOWNSCALES:
+        yield f"downscale={scale}", DownscaledSegmentation(cheapest, scale)
+
+
+def assignment_strategies(pipeline_run: PipelineRun) -> Iterator[Tuple[str, Any]]:
+    """Yield (strategy, assignment algorithm) from the configured algorithm to the cheapest alternative.
+    Algorithms with a chunk_bytes attribute look up the nearest palette colors in chunks, which gives identical
+    results for any chunk size."""
+    assignment = pipeline_run.assignment
+    yield "default", assignment
+
+    if hasattr(assignment, "chunk_bytes"):
+        for chunk_bytes in CHUNK_BYTES:
+            if chunk_bytes < assignment.chunk_bytes:
+                cheaper = copy.copy(assignment)
+                cheaper.chunk_bytes = chunk_bytes
+                yield f"chunk_bytes={chunk_bytes}", cheaper
+
+
+def estimate_pipeline(
+    pipeline_run: PipelineRun,
+    strategy: str = "default",
+    rendering_strategy: str = "default",
+    palette_size: int = 0,
+    assignment_strategy: str = "default",
+) -> List[StageEstimate]:
+    """Estimate the peak memory of every configured stage from the image size, the algorithm parameters and the
+    number of palette colors."""
+    from pbn.algorithms.enums import PreprocessingEnum
+
+    width, height = pipeline_run.original_image.size
+    pixels = width * height
+    segments = held_segments_bytes(width, height)
+    estimates = []
+
+    # The original image and, when preprocessing creates one, the preprocessed image. Memory-mapped inputs are
+    # counted as well, as their pages are resident while the stages read them.
+    resident = pixels * IMAGE_BYTES_PER_PIXEL
+    for step, preprocessing in enumerate(pipeline_run.preprocessing):
+        estimates.append(
+            StageEstimate(
+                PipelineStageEnum.PREPROCESSING,
+                preprocessing.name,
+                step,
+                "default",
+                resident,
+                preprocessing.estimate_memory(width, height),
+            )
+        )
+    if any(p.name != PreprocessingEnum.NONE for p in pipeline_run.preprocessing):
+        resident += pixels * IMAGE_BYTES_PER_PIXEL
+
+    segmentation = pipeline_run.segmentation
+    estimates.append(
+        StageEstimate(
+            PipelineStageEnum.SEGMENTATION,
+            segmentation.name,
+            0,
+            strategy,
+            resident,
+            segmentation.estimate_memory(width, height),
+        )
+    )
+    resident += segments
+
+    assignment = pipeline_run.assignment
+    estimates.append(
+        StageEstimate(
+            PipelineStageEnum.COLOR_ASSINGMENT,
+            assignment.name,
+            0,
+            assignment_strategy,
+            resident,
+            assignment.estimate_memory(width, height, palette_size),
+        )
+    )
+    # The colored segments and the copy that postprocessing starts from share the pixels of the segments.
+    resident += 2 * pixels * LABEL_BYTES_PER_PIXEL
+
+    for step, postprocessing in enumerate(pipeline_run.postprocessing):
+        estimates.append(
+            StageEstimate(
+                PipelineStageEnum.POSTPROCESSING,
+                postprocessing.name,
+                step,
+                "default",
+                resident + (segments if step > 0 else 0),
+                postprocessing.estimate_memory(width, height),
+            )
+        )
+    if pipeline_run.postprocessing:
+        resident += segments
+
+    rendering = pipeline_run.rendering
+    band_height = pipeline_run.band_height
+    estimates.append(
+        StageEstimate(
+            PipelineStageEnum.RENDERING,
+            rendering.name,
+            0,
+            rendering_strategy,
+            resident,
+            rendering.estimate_memory(width, height, band_height),
+        )
+    )
+    return estimates
+
+
+def plan_memory(pipeline_run: PipelineRun, max_bytes: Optional[int] = None, palette_size: int = 0) -> MemoryPlan:
+    """Adapt the run so that every stage stays within the memory budget, by default pipeline_run.max_memory, when
+    assigning colors from a palette of palette_size colors.
+
+    The segmentation strategies are tried in order until the segmentation fits, then the assignment strategies
+    until the assignment fits and, when rendering does not fit, the output is rendered in bands. Raises
+    MemoryBudgetError, without running anything, when a stage does not fit with any of them."""
+    max_bytes = pipeline_run.max_memory if max_bytes is None else max_bytes
+    if max_bytes is None:
+        raise ValueError("No memory budget given")
+
+    def assignment_estimate(estimates: List[StageEstimate]) -> StageEstimate:
+        return next(e for e in estimates if e.stage == PipelineStageEnum.COLOR_ASSINGMENT)
+
+    tried = []
+    run, estimates = pipeline_run, []
+    for strategy, segmentation in segmentation_strategies(pipeline_run):
+        tried.append(strategy)
+        run = replace(pipeline_run, segmentation=segmentation)
+        estimates = estimate_pipeline(run, strategy, palette_size=palette_size)
+        if next(e for e in estimates if e.stage == PipelineStageEnum.SEGMENTATION).peak_bytes <= max_bytes:
+            break
+
+    segmentation_strategy, assignment_strategy = tried[-1], "default"
+    if assignment_estimate(estimates).peak_bytes > max_bytes:
+        segmented = run
+        for assignment_strategy, assignment in assignment_strategies(segmented):
+            if assignment_strategy != "default":
+                tried.append(assignment_strategy)
+            run = replace(segmented, assignment=assignment)
+            estimates = estimate_pipeline(run, segmentation_strategy, "default", palette_size, assignment_strategy)
+            if assignment_estimate(estimates).peak_bytes <= max_bytes:
+                break
+
+    if estimates[-1].peak_bytes > max_bytes and not run.band_height:
+        for band_height in BAND_HEIGHTS:
+            banded = replace(run, band_height=band_height)
+            banded_estimates = estimate_pipeline(
+                banded, segmentation_strategy, f"band_height={band_height}", palette_size, assignment_strategy
+            )
+            if banded_estimates[-1].peak_bytes <= max_bytes:
+                run, estimates = banded, banded_estimates
+                break
+
+    if any(e.peak_bytes > max_bytes for e in estimates):
+        width, height = pipeline_run.original_image.size
+        raise MemoryBudgetError(width, height, max_bytes, estimates, tried)
+
+    return MemoryPlan(run, max_bytes, estimates)
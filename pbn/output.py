@@ -1,7 +1,7 @@
 from typing import Dict, Any
 import pathlib
 
-from pbn.datatypes import PipelineRun, PipelineStageEnum
+from pbn.datatypes import OutputFormatEnum, PipelineRun, PipelineStageEnum
 
 
 def serialize_params(params: Dict[str, Any]) -> str:
@@ -16,9 +16,25 @@ def serialize_params(params: Dict[str, Any]) -> str:
     return "_".join(parts)
 
 
-def make_intermediate_filename(pipeline_run: PipelineRun, stage: PipelineStageEnum, step: int, notes: str) -> str:
+def input_part(pipeline_run: PipelineRun) -> str:
+    """The input name, or "image" for an image given in memory."""
+    return pipeline_run.input_path.stem if pipeline_run.input_path is not None else "image"
+
+
+def palette_part(pipeline_run: PipelineRun) -> str:
+    """The palette name, with the number of selected colors when a subset of the palette is selected. A palette
+    given in memory is named "palette"."""
+    name = pipeline_run.palette_path.stem if pipeline_run.palette_path is not None else "palette"
+    if pipeline_run.palette_size is None:
+        return name
+    return f"{name}-{pipeline_run.palette_size}"
+
+
+def make_intermediate_filename(
+    pipeline_run: PipelineRun, stage: PipelineStageEnum, step: int, notes: str, extension: str = "ppm"
+) -> str:
     """Generate a descriptive filename for an intermediate stage."""
-    parts = [pipeline_run.input_path.stem, pipeline_run.palette_path.stem, stage]
+    parts = [input_part(pipeline_run), palette_part(pipeline_run), stage]
 
     if notes:
         parts.append(notes)
@@ -46,7 +62,7 @@ def make_intermediate_filename(pipeline_run: PipelineRun, stage: PipelineStageEn
     if stage in (PipelineStageEnum.COLOR_ASSINGMENT, PipelineStageEnum.RENDERING):
         raise ValueError("Unsupported stage.")
 
-    return "_".join(parts) + ".ppm"
+    return "_".join(parts) + f".{extension}"
 
 
 def resolve_intermediate_path(pipeline_run: PipelineRun, stage: PipelineStageEnum, step: int = 0, notes: str = "") -> pathlib.Path:
@@ -54,12 +70,14 @@ def resolve_intermediate_path(pipeline_run: PipelineRun, stage: PipelineStageEnu
     if not pipeline_run.intermediate_dir:
         raise RuntimeError("An intermediate image path cannot be created without a provided directory.")
 
-    return pipeline_run.intermediate_dir / make_intermediate_filename(pipeline_run, stage, step, notes)
+    return pipeline_run.intermediate_dir / make_intermediate_filename(
+        pipeline_run, stage, step, notes, pipeline_run.intermediate_format
+    )
 
 
 def make_output_filename(pipeline_run: PipelineRun) -> str:
     """Create a descriptive output filename based on input, palette, algorithms, and parameters."""
-    parts = [pipeline_run.input_path.stem, pipeline_run.palette_path.stem]
+    parts = [input_part(pipeline_run), palette_part(pipeline_run)]
 
     for preprocessing_algo in pipeline_run.preprocessing:
         parts.append(preprocessing_algo.name)
@@ -79,7 +97,7 @@ def make_output_filename(pipeline_run: PipelineRun) -> str:
     if pipeline_run.assignment.params:
         parts.append(serialize_params(pipeline_run.assignment.params))
 
-    filename = "_".join(parts) + ".ppm"
+    filename = "_".join(parts) + f".{pipeline_run.output_format or OutputFormatEnum.PPM}"
     return filename
 
 
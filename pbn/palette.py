@@ -1,38 +1,71 @@
+from typing import Iterable, List, Tuple
 import pathlib
 import re
 
-from pbn.datatypes import Palette
+from pbn.datatypes import Color, Palette, PipelineRun
 
 
 HEX_RE = re.compile(r"^#[0-9a-fA-F]{6}$")
+# A numbered paint of a library, e.g. "101 White (RGB): #f5f7fb".
+LIBRARY_RE = re.compile(r"^(?P<label>\d+\s+.*?)\s*\(RGB\):\s*(?P<hex>#[0-9a-fA-F]{6})$")
 
 
-def load_palette(path: pathlib.Path) -> Palette:
-    """Load a color palette from RGB or hex color lines."""
-    palette: Palette = []
+def parse_hex(token: str) -> Color:
+    return (int(token[1:3], 16), int(token[3:5], 16), int(token[5:7], 16))
+
+
+def parse_palette_entries(lines: Iterable[str]) -> List[Tuple[str, Color]]:
+    """Parse the lines of a palette file with a label per color: the number and name of library paints, otherwise
+    the color as written in the file."""
+    entries: List[Tuple[str, Color]] = []
+    for raw_line in lines:
+        line = raw_line.strip()
+        if not line:
+            continue
+
+        library_match = LIBRARY_RE.match(line)
+        if library_match:
+            entries.append((library_match["label"], parse_hex(library_match["hex"])))
+            continue
+
+        token = line.split(maxsplit=1)[0]
+
+        if HEX_RE.match(token):
+            entries.append((token, parse_hex(token)))
+            continue
+
+        if token.startswith("#"):
+            continue
+
+        parts = token.split(",")
+        if len(parts) != 3:
+            raise ValueError(f"Invalid color line: '{raw_line.rstrip()}'")
+
+        r, g, b = map(int, parts)
+        entries.append((token, (r, g, b)))
+
+    return entries
+
+
+def load_palette_entries(path: pathlib.Path) -> List[Tuple[str, Color]]:
+    """Load a color palette with a label per color (see parse_palette_entries)."""
     with path.open() as f:
-        for raw_line in f:
-            line = raw_line.strip()
-            if not line:
-                continue
+        return parse_palette_entries(f)
 
-            token = line.split(maxsplit=1)[0]
 
-            if HEX_RE.match(token):
-                r = int(token[1:3], 16)
-                g = int(token[3:5], 16)
-                b = int(token[5:7], 16)
-                palette.append((r, g, b))
-                continue
+def parse_palette(text: str) -> Palette:
+    """Parse a color palette from the contents of a palette file."""
+    return [color for _, color in parse_palette_entries(text.splitlines())]
 
-            if token.startswith("#"):
-                continue
 
-            parts = token.split(",")
-            if len(parts) != 3:
-                raise ValueError(f"Invalid color line: '{raw_line.rstrip()}'")
+def load_palette(path: pathlib.Path) -> Palette:
+    """Load a color palette from RGB or hex color lines, or from a paint library with lines like
+    '101 White (RGB): #f5f7fb'."""
+    return [color for _, color in load_palette_entries(path)]
 
-            r, g, b = map(int, parts)
-            palette.append((r, g, b))
 
-    return palette
+def load_run_palette(pipeline_run: PipelineRun) -> Palette:
+    """Load the palette file of a run. Runs with an in-memory palette have none and need the palette passed."""
+    if pipeline_run.palette_path is None:
+        raise ValueError("The pipeline run has no palette file, so its palette has to be passed")
+    return load_palette(pipeline_run.palette_path)
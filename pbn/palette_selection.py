@@ -0,0 +1,105 @@
+from typing import List, Sequence, Tuple
+from PIL import Image
+import math
+
+import numpy as np
+
+from pbn.datatypes import Color
+from pbn.histogram import pack_rgb, unpack_rgb
+from pbn.profiling import record
+
+
+# Images with more pixels are sampled on a regular grid before the histogram is taken.
+MAX_HISTOGRAM_PIXELS = 1 << 20
+# Histograms with more distinct colors are merged into bins of fewer bits per channel until they fit.
+MAX_HISTOGRAM_COLORS = 1 << 12
+MAX_SWAPS = 100
+
+
+def color_histogram(image: Image.Image) -> Tuple[np.ndarray, np.ndarray]:
+    """The distinct colors of an image as float RGB rows with their pixel counts.
+
+    When there are too many distinct colors, they are merged into coarser bins represented by their mean color.
+    Under squared distances, the error of assigning a palette color to the pixels of a bin equals the error of its
+    mean times its count plus a constant, so the selection sees (nearly) the same errors as on the pixels."""
+    pixels = np.asarray(image.convert("RGB"))
+    step = max(1, math.ceil(math.sqrt(pixels.shape[0] * pixels.shape[1] / MAX_HISTOGRAM_PIXELS)))
+    flat = pixels[::step, ::step].reshape(-1, 3).astype(np.uint32)
+
+    keys, counts = np.unique(pack_rgb(flat), return_counts=True)
+    if len(keys) <= MAX_HISTOGRAM_COLORS:
+        return unpack_rgb(keys).astype(np.float64), counts.astype(np.float64)
+
+    for bits in range(7, 3, -1):
+        shift = 8 - bits
+        bins = ((flat[:, 0] >> shift) << (2 * bits)) | ((flat[:, 1] >> shift) << bits) | (flat[:, 2] >> shift)
+        bin_counts = np.bincount(bins, minlength=1 << (3 * bits))
+        present = bin_counts > 0
+        if np.count_nonzero(present) <= MAX_HISTOGRAM_COLORS:
+            break
+    sums = np.stack([np.bincount(bins, weights=flat[:, c], minlength=len(bin_counts)) for c in range(3)], axis=1)
+    return sums[present] / bin_counts[present, None], bin_counts[present].astype(np.float64)
+
+
+def _nearest_two(distances: np.ndarray, selected: List[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """For every color: the position in selected of its nearest selected palette color, its distance and the
+    distance to the second nearest (infinite with a single selected color)."""
+    columns = distances[:, selected]
+    nearest = np.argmin(columns, axis=1)
+    d1 = columns[np.arange(len(columns)), nearest]
+    if len(selected) == 1:
+        return nearest, d1, np.full_like(d1, np.inf)
+    d2 = np.partition(columns, 1, axis=1)[:, 1]
+    return nearest, d1, d2
+
+
+def select_palette(image: Image.Image, palette: Sequence[Color], size: int) -> List[int]:
+    """Pick the size palette colors that minimize the total squared RGB distance of the image's pixels to their
+    nearest picked color, the error of average-nearest assignment at pixel level. Returns their indices in palette
+    order.
+
+    Colors are picked greedily, each time the one that reduces the error most, and then single swaps of a picked and
+    an unpicked color are made while they reduce the error. The error change of every possible swap is computed at
+    once from the distances of each histogram color to its nearest and second nearest picked color."""
+    if size < 1:
+        raise ValueError("palette size must be at least 1")
+    if size >= len(palette):
+        return list(range(len(palette)))
+
+    colors, weights = color_histogram(image)
+    palette_array = np.array(palette, dtype=np.float64)
+    distances = ((colors[:, None, :] - palette_array[None, :, :]) ** 2).sum(axis=2)
+    record("histogram_colors", len(colors))
+
+    selected: List[int] = []
+    best = np.full(len(colors), np.inf)
+    for _ in range(size):
+        errors = weights @ np.minimum(distances, best[:, None])
+        errors[selected] = np.inf
+        choice = int(np.argmin(errors))
+        selected.append(choice)
+        best = np.minimum(best, distances[:, choice])
+
+    swaps = 0
+    nearest, d1, d2 = _nearest_two(distances, selected)
+    while swaps < MAX_SWAPS:
+        # Adding candidate c while keeping every picked color changes each color's distance to min(D[:, c], d1).
+        closer = np.minimum(distances, d1[:, None])
+        gains = weights @ (closer - d1[:, None])
+        # Colors whose nearest picked color is removed fall back to min(D[:, c], d2) instead.
+        fallback = weights[:, None] * (np.minimum(distances, d2[:, None]) - closer)
+        owners = np.zeros((size, len(colors)))
+        owners[nearest, np.arange(len(colors))] = 1
+        deltas = gains[None, :] + owners @ fallback
+        deltas[:, selected] = np.inf
+
+        position, candidate = np.unravel_index(int(np.argmin(deltas)), deltas.shape)
+        if deltas[position, candidate] >= -1e-9 * max(float(weights @ d1), 1.0):
+            break
+        selected[position] = int(candidate)
+        nearest, d1, d2 = _nearest_two(distances, selected)
+        swaps += 1
+
+    record("swaps", swaps)
+    record("error", float(weights @ d1 / weights.sum()))
+    return sorted(selected)
@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple, TypeVar
+import os
+import threading
+
+import numpy as np
+
+from pbn.datatypes import Palette
+
+
+T = TypeVar("T")
+
+# Ranges are not split below these sizes, as the work would not outweigh the cost of a task.
+MIN_BAND_PIXELS = 1 << 16
+MIN_BATCH_ITEMS = 1 << 12
+# Nearest palette colors are looked up this many distance bytes (24 per color and palette color pair) at a time.
+NEAREST_CHUNK_BYTES = 4 << 20
+# Bytes held per color and palette color pair while a chunk is looked up: the differences and their row sums.
+NEAREST_PAIR_BYTES = 3 * 8 + 8
+
+_threads = 1
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def configure(threads: Optional[int]) -> None:
+    """Set the number of threads that pointwise and per-region work is split over. None uses the number of CPUs
+    and 1 runs everything in the calling thread. Results do not depend on the number of threads."""
+    global _threads, _executor
+    threads = threads if threads is not None else os.cpu_count() or 1
+    if threads < 1:
+        raise ValueError("threads must be at least 1")
+    with _lock:
+        if threads != _threads and _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _threads = threads
+
+
+def get_threads() -> int:
+    return _threads
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(_threads, thread_name_prefix="pbn-parallel")
+        return _executor
+
+
+def split(length: int, parts: int, min_size: int = 1) -> List[Tuple[int, int]]:
+    """Split range(length) into at most parts contiguous (start, stop) ranges of nearly equal size, none smaller
+    than min_size unless length is. Always returns at least one range."""
+    parts = max(1, min(parts, length // max(min_size, 1)))
+    bounds = [length * i // parts for i in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def map_ranges(fn: Callable[[int, int], T], length: int, min_size: int = MIN_BATCH_ITEMS) -> List[T]:
+    """Call fn(start, stop) for contiguous ranges covering range(length) on the thread pool and return the results
+    in range order. fn must only read shared data, which NumPy does without holding the GIL."""
+    ranges = split(length, _threads, min_size)
+    if len(ranges) == 1:
+        return [fn(*ranges[0])]
+    return list(_pool().map(lambda r: fn(*r), ranges))
+
+
+def map_chunks(fn: Callable[[int, int], T], length: int, chunk: int) -> List[T]:
+    """Call fn(start, stop) for consecutive ranges of chunk items covering range(length), spread over the thread
+    pool, and return the results in range order. Unlike map_ranges the ranges do not depend on the number of
+    threads, so neither does the memory each call allocates."""
+    chunk = max(1, chunk)
+    ranges = [(start, min(start + chunk, length)) for start in range(0, length, chunk)] or [(0, 0)]
+    if len(ranges) == 1 or _threads == 1:
+        return [fn(*r) for r in ranges]
+    return list(_pool().map(lambda r: fn(*r), ranges))
+
+
+def map_rows(fn: Callable[[int, int], T], height: int, width: int) -> List[T]:
+    """Call fn(y0, y1) for row bands covering an image of this size and return the results in band order."""
+    return map_ranges(fn, height, max(1, MIN_BAND_PIXELS // max(width, 1)))
+
+
+def concatenate_rows(fn: Callable[[int, int], np.ndarray], height: int, width: int) -> np.ndarray:
+    """Compute an array row band by row band and join the bands."""
+    bands = map_rows(fn, height, width)
+    return bands[0] if len(bands) == 1 else np.concatenate(bands)
+
+
+def label_sums(pixels: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Sum the RGB pixels and count the pixels of every label, per row band.
+
+    Returns (sums, counts, offset), indexed by label - offset, where offset is at most -1 so that unlabeled pixels
+    (-1) have an entry. The sums are exact integers, so they do not depend on how the rows were split."""
+    height, width = labels.shape
+    offset = min(int(labels.min()), -1) if labels.size else -1
+    size = int(labels.max()) - offset + 1 if labels.size else 1
+
+    def band(y0: int, y1: int) -> Tuple[np.ndarray, np.ndarray]:
+        index = (labels[y0:y1] - offset).ravel()
+        counts = np.bincount(index, minlength=size)
+        sums = np.stack(
+            [np.bincount(index, weights=pixels[y0:y1, :, c].ravel(), minlength=size) for c in range(3)], axis=1
+        )
+        return sums.astype(np.int64), counts
+
+    parts = map_rows(band, height, width)
+    sums = parts[0][0]
+    counts = parts[0][1]
+    for band_sums, band_counts in parts[1:]:
+        sums = sums + band_sums
+        counts = counts + band_counts
+    return sums, counts, offset
+
+
+def nearest_chunk_colors(palette_size: int, chunk_bytes: int = NEAREST_CHUNK_BYTES) -> int:
+    """The number of colors nearest_palette_indices compares with a palette of this size at a time."""
+    return max(1, chunk_bytes // (max(palette_size, 1) * 3 * 8))
+
+
+def nearest_working_bytes(count: int, palette_size: int, chunk_bytes: int = NEAREST_CHUNK_BYTES) -> int:
+    """Estimate the peak bytes nearest_palette_indices allocates for count colors, including the indices."""
+    chunk = nearest_chunk_colors(palette_size, chunk_bytes)
+    running = min(_threads, -(-count // chunk)) if count else 0
+    return running * min(chunk, count) * max(palette_size, 1) * NEAREST_PAIR_BYTES + count * (3 * 8 + 2 * 8)
+
+
+def nearest_palette_indices(
+    colors: np.ndarray,
+    palette: Palette | Sequence[Sequence[int]] | np.ndarray,
+    chunk_bytes: int = NEAREST_CHUNK_BYTES,
+) -> np.ndarray:
+    """The index of the palette color with the smallest Euclidean distance to every color, in chunks of colors
+    whose distances to the palette take about chunk_bytes. Distances are compared exactly as squared integers and
+    ties go to the first palette color."""
+    palette_array = np.array(palette, dtype=np.int64).reshape(-1, 3)
+    colors = colors.astype(np.int64)
+
+    def batch(start: int, stop: int) -> np.ndarray:
+        diff = colors[start:stop, None, :] - palette_array[None, :, :]
+        np.multiply(diff, diff, out=diff)
+        indices: np.ndarray = np.argmin(diff.sum(axis=2), axis=1)
+        return indices
+
+    batches = map_chunks(batch, len(colors), nearest_chunk_colors(len(palette_array), chunk_bytes))
+    return batches[0] if len(batches) == 1 else np.concatenate(batches)
@@ -0,0 +1,51 @@
+from enum import StrEnum
+from typing import Any, Callable, Dict, Tuple, Type
+import argparse
+
+from pbn.algorithms import ALGORITHM_MAP
+
+
+def parse_enum_with_params(enum_cls: Type[StrEnum]) -> Callable[[str], Tuple[str, Dict[str, Any]]]:
+    """The argparse type that parses an algorithm with parameters, e.g. voronoi,num_seeds=50. The command line,
+    the Python API, the service and variant specs all use this syntax.
+    Besides the values of enum_cls, the names of plugin algorithms of the same stage are accepted."""
+
+    def parser(value: str) -> Tuple[str, Dict[str, Any]]:
+        parts = value.split(",")
+        name = parts[0]
+
+        enum_value: str
+        try:
+            enum_value = enum_cls(name)
+        except ValueError:
+            valid_names = ALGORITHM_MAP.names(enum_cls)
+            if name not in valid_names:
+                raise argparse.ArgumentTypeError(f"Invalid value '{name}'. Choose from: {', '.join(valid_names)}")
+            enum_value = name
+
+        params: Dict[str, Any] = {}
+        for part in parts[1:]:
+            if "=" not in part:
+                raise argparse.ArgumentTypeError(f"Invalid parameter '{part}'. Expected key=value.")
+            val: str | int | float | bool | None
+            key, val = part.split("=", 1)
+
+            if val == "None":
+                val = None
+            elif val.lower() == "true":
+                val = True
+            elif val.lower() == "false":
+                val = False
+            elif val.isdigit():
+                val = int(val)
+            else:
+                try:
+                    val = float(val)
+                except ValueError:
+                    pass
+
+            params[key] = val
+
+        return enum_value, params
+
+    return parser
@@ -0,0 +1,204 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import Any, Dict, List, Optional, Sequence
+import json
+import pathlib
+import struct
+import zlib
+
+import numpy as np
+
+from pbn.datatypes import Color, ColoredSegmentedImage, Palette, PipelineRun, SegmentedImage
+from pbn.cache import describe_algorithm
+
+
+# A .pbnseg file holds a colored segmentation. All values are little-endian, in this order:
+# - the header (HEADER_FORMAT), starting with MAGIC and the format version
+# - the palette: palette_size rows of 3 uint8 RGB values
+# - the segment table: segment_count records of SEGMENT_DTYPE, sorted by id
+# - the metadata: a UTF-8 JSON object
+# - the label map: height x width int32 segment ids (-1 for unlabeled pixels), raw or zlib-compressed. It starts at
+#   a multiple of 8 bytes, so raw label maps can be memory-mapped.
+MAGIC = b"PBNSEG\x00\x00"
+VERSION = 1
+# magic, version, compression, width, height, segment count, palette size, metadata bytes, label offset,
+# label bytes
+HEADER_FORMAT = "<8sHHIIIIQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SEGMENT_DTYPE = np.dtype(
+    [
+        ("id", "<i4"),
+        ("color", "u1", (3,)),
+        ("palette_index", "<i2"),
+        ("area", "<u4"),
+        # x0, y0, x1, y1 with exclusive ends
+        ("bbox", "<u4", (4,)),
+    ]
+)
+
+LABEL_DTYPE = np.dtype("<i4")
+
+
+class CompressionEnum(StrEnum):
+    NONE = "none"
+    ZLIB = "zlib"
+
+
+COMPRESSION_CODES = {CompressionEnum.NONE: 0, CompressionEnum.ZLIB: 1}
+
+
+def run_metadata(pipeline_run: PipelineRun) -> Dict[str, Any]:
+    """Describe the input, palette and algorithms of a run for the metadata of a .pbnseg file."""
+    return {
+        "input": str(pipeline_run.input_path) if pipeline_run.input_path is not None else None,
+        "palette": str(pipeline_run.palette_path) if pipeline_run.palette_path is not None else None,
+        "palette_size": pipeline_run.palette_size,
+        "preprocessing": [describe_algorithm(p) for p in pipeline_run.preprocessing],
+        "segmentation": describe_algorithm(pipeline_run.segmentation),
+        "assignment": describe_algorithm(pipeline_run.assignment),
+        "postprocessing": [describe_algorithm(p) for p in pipeline_run.postprocessing],
+    }
+
+
+def segment_table(labels: np.ndarray, segments: ColoredSegmentedImage, palette: Sequence[Color]) -> np.ndarray:
+    """Build the segment table of a label map: id, color, index of the color in the palette (-1 if it is not in
+    it), pixel count and bounding box of every segment, sorted by id."""
+    # Imported here because pbn.core imports this module, and scipy would slow down every start of the CLI.
+    from scipy import ndimage
+
+    by_id = sorted(segments.segments, key=lambda segment: segment.id)
+    table = np.zeros(len(by_id), dtype=SEGMENT_DTYPE)
+    if not by_id:
+        return table
+    table["id"] = [segment.id for segment in by_id]
+    table["color"] = [segment.color for segment in by_id]
+    palette_indices: Dict[Color, int] = {}
+    for palette_index, color in enumerate(palette):
+        palette_indices.setdefault(color, palette_index)
+    table["palette_index"] = [palette_indices.get(segment.color, -1) for segment in by_id]
+
+    # Number the segments 1..n in id order, so ndimage can measure them; unlabeled pixels become 0.
+    index = np.searchsorted(table["id"], labels)
+    index = np.minimum(index, len(table) - 1)
+    index = np.where(table["id"][index] == labels, index + 1, 0)
+    table["area"] = np.bincount(index.ravel(), minlength=len(table) + 1)[1:]
+    for i, slices in enumerate(ndimage.find_objects(index, max_label=len(table))):
+        if slices is not None:
+            rows, columns = slices
+            table["bbox"][i] = (columns.start, rows.start, columns.stop, rows.stop)
+    return table
+
+
+def write_pbnseg(
+    path: pathlib.Path,
+    segments: ColoredSegmentedImage,
+    palette: Sequence[Color] = (),
+    metadata: Optional[Dict[str, Any]] = None,
+    compression: CompressionEnum = CompressionEnum.ZLIB,
+) -> pathlib.Path:
+    """Write colored segments to a .pbnseg file. The metadata of the segments is stored under "segmentation" and
+    the given metadata, e.g. run_metadata(pipeline_run), under "run". Uncompressed label maps can be memory-mapped
+    when read back."""
+    labels = np.array(segments.labels, dtype=LABEL_DTYPE).reshape(segments.height, segments.width)
+    table = segment_table(labels, segments, palette)
+    palette_bytes = np.array(palette, dtype=np.uint8).reshape(-1, 3).tobytes()
+    metadata_bytes = json.dumps({"segmentation": segments.metadata, "run": metadata or {}}, default=str).encode()
+
+    label_bytes = labels.tobytes()
+    if compression == CompressionEnum.ZLIB:
+        label_bytes = zlib.compress(label_bytes, 6)
+
+    label_offset = HEADER_SIZE + len(palette_bytes) + table.nbytes + len(metadata_bytes)
+    padding = -label_offset % 8
+    header = struct.pack(
+        HEADER_FORMAT,
+        MAGIC,
+        VERSION,
+        COMPRESSION_CODES[compression],
+        segments.width,
+        segments.height,
+        len(table),
+        len(palette_bytes) // 3,
+        len(metadata_bytes),
+        label_offset + padding,
+        len(label_bytes),
+    )
+    with path.open("wb") as f:
+        f.write(header)
+        f.write(palette_bytes)
+        f.write(table.tobytes())
+        f.write(metadata_bytes)
+        f.write(b"\x00" * padding)
+        f.write(label_bytes)
+    return path
+
+
+@dataclass
+class SegmentationFile:
+    """A .pbnseg file whose header, palette, segment table and metadata are read. The label map is only read
+    when it is first used: memory-mapped when stored uncompressed, decompressed otherwise."""
+
+    path: pathlib.Path
+    version: int
+    compression: CompressionEnum
+    width: int
+    height: int
+    palette: Palette
+    segments: np.ndarray
+    metadata: Dict[str, Any]
+    label_offset: int
+    label_size: int
+    _labels: Optional[np.ndarray] = field(default=None, repr=False)
+
+    @property
+    def labels(self) -> np.ndarray:
+        """The (height, width) int32 label map."""
+        if self._labels is None:
+            shape = (self.height, self.width)
+            if self.compression == CompressionEnum.NONE:
+                self._labels = np.memmap(
+                    self.path, dtype=LABEL_DTYPE, mode="r", offset=self.label_offset, shape=shape
+                )
+            else:
+                with self.path.open("rb") as f:
+                    f.seek(self.label_offset)
+                    data = zlib.decompress(f.read(self.label_size))
+                self._labels = np.frombuffer(data, dtype=LABEL_DTYPE).reshape(shape)
+        return self._labels
+
+    def to_colored_segments(self) -> ColoredSegmentedImage:
+        """Rebuild the colored segments, e.g. to postprocess or render them again."""
+        color_map: Dict[int, Color] = {
+            int(segment_id): (int(r), int(g), int(b)) for segment_id, (r, g, b) in self.segments[["id", "color"]]
+        }
+        segments = [s for s in SegmentedImage.from_labels(self.labels.tolist()).segments if s.id in color_map]
+        colored = ColoredSegmentedImage.from_segments(segments, self.width, self.height, color_map)
+        colored.metadata.update(self.metadata.get("segmentation", {}))
+        return colored
+
+
+def read_pbnseg(path: pathlib.Path) -> SegmentationFile:
+    """Read the header, palette, segment table and metadata of a .pbnseg file."""
+    with path.open("rb") as f:
+        header = f.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+            raise ValueError(f"{path} is not a .pbnseg file")
+        fields = struct.unpack(HEADER_FORMAT, header)
+        version, compression_code, width, height, segment_count, palette_size = fields[1:7]
+        metadata_size, label_offset, label_size = fields[7:]
+        if version > VERSION:
+            raise ValueError(f"{path} has .pbnseg version {version}, but only up to {VERSION} is supported")
+        compression = {code: c for c, code in COMPRESSION_CODES.items()}.get(compression_code)
+        if compression is None:
+            raise ValueError(f"{path} uses an unknown label compression ({compression_code})")
+
+        palette_array = np.frombuffer(f.read(palette_size * 3), dtype=np.uint8).reshape(-1, 3)
+        table = np.frombuffer(f.read(segment_count * SEGMENT_DTYPE.itemsize), dtype=SEGMENT_DTYPE)
+        metadata = json.loads(f.read(metadata_size).decode())
+
+    palette: List[Color] = [(int(r), int(g), int(b)) for r, g, b in palette_array]
+    return SegmentationFile(
+        path, version, compression, width, height, palette, table, metadata, label_offset, label_size
+    )
@@ -0,0 +1,201 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+from PIL import Image
+import cProfile
+import json
+import pathlib
+import time
+import tracemalloc
+
+import numpy as np
+
+from pbn.datatypes import BaseSegmentedImage
+
+
+# Rough per-pixel cost of the Python segment representation: a label list entry and a pixel tuple.
+SEGMENT_BYTES_PER_PIXEL = 8 + 72
+
+
+@dataclass
+class StageMetrics:
+    """Measurements of one algorithm of one pipeline stage."""
+
+    stage: str
+    algorithm: str
+    step: int
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_memory_bytes: Optional[int] = None
+    # What the stage left allocated: its output and anything it keeps, such as caches. Traced like the peak.
+    retained_memory_bytes: Optional[int] = None
+    segments_in: Optional[int] = None
+    segments_out: Optional[int] = None
+    # The estimated size of the output (see estimate_bytes), which stands in for the bytes a stage copies; nothing
+    # counts the copies themselves.
+    output_bytes: int = 0
+    cached: bool = False
+    stats: Dict[str, Any] = field(default_factory=dict)
+
+
+StageHook = Callable[[StageMetrics], None]
+
+_current_stats: ContextVar[Optional[Dict[str, Any]]] = ContextVar("pbn_stage_stats", default=None)
+
+
+def record(key: str, value: Any) -> None:
+    """Attach a statistic to the stage that is currently being profiled. Does nothing outside a profiled stage."""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats[key] = value
+
+
+def count_segments(value: Any) -> Optional[int]:
+    if isinstance(value, BaseSegmentedImage):
+        return len(value.segments)
+    return None
+
+
+def estimate_bytes(value: Any) -> int:
+    """Estimate the size of a stage input or output: pixel buffers, arrays or segment representations."""
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, BaseSegmentedImage):
+        return value.width * value.height * SEGMENT_BYTES_PER_PIXEL
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_bytes(v) for v in value)
+    return 0
+
+
+class StageRecorder:
+    """Handed to the code inside a profiled stage to describe what went in and out."""
+
+    def __init__(self, metrics: StageMetrics):
+        self.metrics = metrics
+        self.discarded = False
+
+    def input(self, value: Any) -> None:
+        self.metrics.segments_in = count_segments(value)
+
+    def output(self, value: Any, cached: bool = False) -> None:
+        self.metrics.segments_out = count_segments(value)
+        self.metrics.output_bytes = estimate_bytes(value)
+        self.metrics.cached = cached
+
+    def discard(self) -> None:
+        """Do not report this stage, e.g. because it turned out to be a cache miss that is measured later."""
+        self.discarded = True
+
+
+class PipelineProfiler:
+    """Collects per-stage metrics of a PaintByNumber run and passes each of them to the hooks.
+
+    Peak and retained memory are measured with tracemalloc when trace_memory is set. When cprofile_stage names a stage
+    (e.g. "segmentation") or an algorithm (e.g. "merge"), that stage also runs under cProfile."""
+
+    enabled: bool
+    hooks: List[StageHook]
+    trace_memory: bool
+    cprofile_stage: Optional[str]
+    metrics: List[StageMetrics]
+    cprofile: Optional[cProfile.Profile]
+
+    def __init__(
+        self,
+        hooks: Sequence[StageHook] = (),
+        trace_memory: bool = True,
+        cprofile_stage: Optional[str] = None,
+        enabled: bool = True,
+    ):
+        self.enabled = enabled
+        self.hooks = list(hooks)
+        self.trace_memory = trace_memory
+        self.cprofile_stage = cprofile_stage
+        self.metrics = []
+        self.cprofile = None
+        self.started = time.perf_counter()
+
+    @classmethod
+    def disabled(cls) -> PipelineProfiler:
+        """A profiler that measures nothing, used when a run is not profiled."""
+        return cls(trace_memory=False, enabled=False)
+
+    @contextmanager
+    def stage(self, stage: str, algorithm: str, step: int = 0) -> Iterator[StageRecorder]:
+        """Measure the code in the with-block as one algorithm of a stage."""
+        metrics = StageMetrics(stage=str(stage), algorithm=str(algorithm), step=step)
+        recorder = StageRecorder(metrics)
+        if not self.enabled:
+            yield recorder
+            return
+
+        stats_token = _current_stats.set(metrics.stats)
+        profile = None
+        if self.cprofile_stage in (metrics.stage, metrics.algorithm):
+            profile = self.cprofile = self.cprofile or cProfile.Profile()
+
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            yield recorder
+        finally:
+            if profile:
+                profile.disable()
+            metrics.wall_seconds = time.perf_counter() - wall_start
+            metrics.cpu_seconds = time.process_time() - cpu_start
+            if self.trace_memory:
+                memory_after, memory_peak = tracemalloc.get_traced_memory()
+                metrics.peak_memory_bytes = max(0, memory_peak - memory_before)
+                metrics.retained_memory_bytes = max(0, memory_after - memory_before)
+                if started_tracing:
+                    tracemalloc.stop()
+            _current_stats.reset(stats_token)
+
+        if recorder.discarded:
+            return
+        self.metrics.append(metrics)
+        for hook in self.hooks:
+            hook(metrics)
+
+    def report(self) -> Dict[str, Any]:
+        """Summarize the collected metrics, per algorithm and per stage."""
+        stages: Dict[str, Dict[str, Any]] = {}
+        for m in self.metrics:
+            summary = stages.setdefault(
+                m.stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_memory_bytes": None}
+            )
+            summary["wall_seconds"] += m.wall_seconds
+            summary["cpu_seconds"] += m.cpu_seconds
+            if m.peak_memory_bytes is not None:
+                summary["peak_memory_bytes"] = max(summary["peak_memory_bytes"] or 0, m.peak_memory_bytes)
+
+        return {
+            "total_wall_seconds": time.perf_counter() - self.started,
+            "stages": stages,
+            "algorithms": [asdict(m) for m in self.metrics],
+        }
+
+    def write_report(self, path: pathlib.Path, **extra: Any) -> pathlib.Path:
+        """Write the report as JSON. The cProfile capture, if any, is saved next to it as a .prof file."""
+        report = {**extra, **self.report()}
+        if self.cprofile and self.cprofile_stage:
+            cprofile_path = path.with_name(f"{path.stem}.{self.cprofile_stage}.prof")
+            self.cprofile.dump_stats(cprofile_path)
+            report["cprofile"] = str(cprofile_path)
+
+        with path.open("w") as f:
+            json.dump(report, f, indent=2, default=str)
+        return path
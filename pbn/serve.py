@@ -0,0 +1,501 @@
+from __future__ import annotations
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import Any, Deque, Dict, List, Optional, Tuple, Type
+from urllib.parse import parse_qs, urlsplit
+from PIL import Image, UnidentifiedImageError
+import argparse
+import asyncio
+import io
+import json
+import os
+import pathlib
+import signal
+import time
+
+import numpy as np
+
+from pbn.algorithms import (
+    ALGORITHM_MAP,
+    PreprocessingEnum,
+    SegmentationEnum,
+    PostprocessingEnum,
+    AssignmentEnum,
+    RenderingEnum,
+)
+from pbn.api import decode_image
+from pbn.core import PaintByNumber
+from pbn.datatypes import OutputFormatEnum, Palette, PipelineRun
+from pbn.memory import MemoryBudgetError
+from pbn.palette import load_palette
+from pbn.params import parse_enum_with_params
+from pbn.writer import FORMAT_ALIASES, save_image
+
+
+AlgorithmSpec = Tuple[Type[StrEnum], str, Dict[str, Any]]
+
+CONTENT_TYPES = {
+    OutputFormatEnum.PPM: "image/x-portable-pixmap",
+    OutputFormatEnum.PNG: "image/png",
+    OutputFormatEnum.JPG: "image/jpeg",
+    OutputFormatEnum.NPY: "application/octet-stream",
+    OutputFormatEnum.TIFF: "image/tiff",
+}
+
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+# Number of recent requests the latency percentiles are computed over.
+LATENCY_WINDOW = 1000
+# Palettes and algorithm instances kept per worker.
+WORKER_CACHE_SIZE = 64
+
+
+@dataclass
+class RenderRequest:
+    """A pipeline spec parsed from the query string of a render request."""
+
+    palette_path: pathlib.Path
+    preprocessing: List[AlgorithmSpec]
+    segmentation: AlgorithmSpec
+    postprocessing: List[AlgorithmSpec]
+    assignment: AlgorithmSpec
+    rendering: AlgorithmSpec
+    output_format: OutputFormatEnum
+    max_memory: Optional[int]
+
+
+class RequestError(Exception):
+    """A request that is answered with an error status instead of a rendered image."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class InvalidInput(Exception):
+    """Raised in a worker when the uploaded image or the algorithm parameters of a request are invalid. Its message
+    only describes the request, so it can be returned to the client."""
+
+
+class HTTPRequest:
+    """The parts of an HTTP/1.1 request the service uses."""
+
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.headers = headers
+        self.body = body
+
+
+@dataclass
+class ServiceMetrics:
+    """Request counters and latency percentiles over a window of recent requests."""
+
+    started: float = field(default_factory=time.perf_counter)
+    requests: int = 0
+    in_flight: int = 0
+    queued: int = 0
+    statuses: Counter[int] = field(default_factory=Counter)
+    total_seconds: Deque[float] = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    queue_seconds: Deque[float] = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    processing_seconds: Deque[float] = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def to_dict(self, workers: int, max_concurrency: int, max_queue: int) -> Dict[str, Any]:
+        return {
+            "uptime_seconds": time.perf_counter() - self.started,
+            "workers": workers,
+            "max_concurrency": max_concurrency,
+            "max_queue": max_queue,
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "responses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "latency_seconds": {
+                "total": summarize(self.total_seconds),
+                "queue": summarize(self.queue_seconds),
+                "processing": summarize(self.processing_seconds),
+            },
+        }
+
+
+def summarize(values: Deque[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p90": None, "p99": None, "max": None}
+    array = np.fromiter(values, dtype=float)
+    p50, p90, p99 = np.percentile(array, [50, 90, 99])
+    return {
+        "count": len(array),
+        "mean": float(array.mean()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(array.max()),
+    }
+
+
+def resolve_palette(
+    name: Optional[str], default_palette: Optional[pathlib.Path], palette_dir: Optional[pathlib.Path]
+) -> pathlib.Path:
+    """The palette file of a request: the default palette without a name, or the named file in palette_dir. Names
+    are file names, with or without the .txt extension; paths are rejected, so that a client cannot make the
+    server read any other file."""
+    if name is None:
+        if default_palette is None:
+            raise RequestError(400, "A palette is required")
+        return default_palette
+    if palette_dir is None:
+        raise RequestError(400, "This server only uses its default palette")
+
+    directory = palette_dir.resolve()
+    if name in ("", ".", "..") or "/" in name or "\\" in name or "\0" in name:
+        raise RequestError(400, "Palettes are given by name")
+    for candidate in (directory / name, directory / f"{name}.txt"):
+        # Symbolic links must not lead out of the directory either.
+        resolved = candidate.resolve()
+        if resolved.parent == directory and resolved.is_file():
+            return resolved
+    raise RequestError(400, f"Unknown palette '{name}'")
+
+
+def parse_render_request(
+    query: Dict[str, List[str]],
+    default_palette: Optional[pathlib.Path],
+    max_memory: Optional[int],
+    palette_dir: Optional[pathlib.Path] = None,
+) -> RenderRequest:
+    """Parse the pipeline spec of a render request. Algorithms use the CLI syntax, e.g. segmentation=voronoi,num_seeds=50.
+    preprocessing and postprocessing may be repeated to chain algorithms. palette names a file in palette_dir and
+    defaults to default_palette."""
+
+    def parse(stage: Type[StrEnum], value: str) -> AlgorithmSpec:
+        try:
+            name, params = parse_enum_with_params(stage)(value)
+        except argparse.ArgumentTypeError as e:
+            raise RequestError(400, f"{stage.__name__.removesuffix('Enum').lower()}: {e}")
+        return stage, name, params
+
+    def single(key: str, stage: Type[StrEnum], default: str) -> AlgorithmSpec:
+        values = query.get(key, [default])
+        if len(values) != 1:
+            raise RequestError(400, f"{key} can only be given once")
+        return parse(stage, values[0])
+
+    palette = query.get("palette", [])
+    if len(palette) > 1:
+        raise RequestError(400, "palette can only be given once")
+    palette_path = resolve_palette(palette[0] if palette else None, default_palette, palette_dir)
+
+    output_format_name = query.get("format", [OutputFormatEnum.PNG])[0].lower()
+    try:
+        output_format = FORMAT_ALIASES.get(output_format_name) or OutputFormatEnum(output_format_name)
+    except ValueError:
+        raise RequestError(400, f"Invalid format '{output_format_name}'. Choose from: {', '.join(OutputFormatEnum)}")
+
+    return RenderRequest(
+        palette_path=palette_path,
+        preprocessing=[parse(PreprocessingEnum, v) for v in query.get("preprocessing", [PreprocessingEnum.NONE])],
+        segmentation=single("segmentation", SegmentationEnum, "grid,cell_size=1"),
+        postprocessing=[parse(PostprocessingEnum, v) for v in query.get("postprocessing", [PostprocessingEnum.MERGE])],
+        assignment=single("assignment", AssignmentEnum, AssignmentEnum.AVERAGE_NEAREST),
+        rendering=single("rendering", RenderingEnum, RenderingEnum.COLORED),
+        output_format=output_format,
+        max_memory=max_memory,
+    )
+
+
+_palettes: OrderedDict[Tuple[pathlib.Path, int], Palette] = OrderedDict()
+_algorithms: OrderedDict[Tuple[Type[StrEnum], str, str], Any] = OrderedDict()
+
+
+def _init_worker(preload: bool) -> None:
+    """Import the built-in algorithms up front, so that no request pays for importing their dependencies."""
+    if preload:
+        for stage in (PreprocessingEnum, SegmentationEnum, PostprocessingEnum, AssignmentEnum, RenderingEnum):
+            for name in stage:
+                ALGORITHM_MAP.load(stage, name)
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _cached_palette(path: pathlib.Path) -> Palette:
+    """Load a palette once per worker. Editing the palette file invalidates it."""
+    key = (path, path.stat().st_mtime_ns)
+    if key not in _palettes:
+        _palettes[key] = load_palette(path)
+        while len(_palettes) > WORKER_CACHE_SIZE:
+            _palettes.popitem(last=False)
+    _palettes.move_to_end(key)
+    return _palettes[key]
+
+
+def _cached_algorithm(spec: AlgorithmSpec) -> Any:
+    """Instantiate an algorithm once per worker and parameters."""
+    stage, name, params = spec
+    key = (stage, str(name), json.dumps(params, sort_keys=True, default=str))
+    if key not in _algorithms:
+        _algorithms[key] = ALGORITHM_MAP.load(stage, name)(**params)
+        while len(_algorithms) > WORKER_CACHE_SIZE:
+            _algorithms.popitem(last=False)
+    _algorithms.move_to_end(key)
+    return _algorithms[key]
+
+
+def _render(request: RenderRequest, image_bytes: bytes) -> Tuple[bytes, float]:
+    """Run the pipeline of a request on the uploaded image and return the encoded result."""
+    start = time.perf_counter()
+    try:
+        image = decode_image(image_bytes)
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        raise InvalidInput("The request body is not a supported image")
+    try:
+        preprocessing = [_cached_algorithm(spec) for spec in request.preprocessing]
+        segmentation = _cached_algorithm(request.segmentation)
+        postprocessing = [_cached_algorithm(spec) for spec in request.postprocessing]
+        assignment = _cached_algorithm(request.assignment)
+        rendering = _cached_algorithm(request.rendering)
+    except (TypeError, ValueError) as e:
+        raise InvalidInput(f"Invalid algorithm parameters: {e}")
+
+    pipeline_run = PipelineRun(
+        input_path=None,
+        original_image=image,
+        palette_path=request.palette_path,
+        preprocessing=preprocessing,
+        segmentation=segmentation,
+        postprocessing=postprocessing,
+        assignment=assignment,
+        rendering=rendering,
+        max_memory=request.max_memory,
+    )
+    pbn = PaintByNumber(pipeline_run, palette=_cached_palette(request.palette_path))
+    result_image = pbn.process_image(request.output_format)
+
+    output = io.BytesIO()
+    save_image(output, result_image, request.output_format)
+    return output.getvalue(), time.perf_counter() - start
+
+
+class PaintByNumberService:
+    """Serves render requests over HTTP from a pool of warm worker processes.
+
+    At most max_concurrency requests run at once; up to max_queue more wait for a free slot and the rest are
+    rejected with 503. A request that takes longer than timeout seconds is answered with 504, but its slot stays
+    taken until the worker finishes, so a slow pipeline cannot overcommit the workers."""
+
+    def __init__(
+        self,
+        workers: int,
+        max_concurrency: Optional[int] = None,
+        max_queue: int = 16,
+        timeout: Optional[float] = 60.0,
+        max_body: int = 64 << 20,
+        default_palette: Optional[pathlib.Path] = None,
+        max_memory: Optional[int] = None,
+        preload: bool = True,
+        palette_dir: Optional[pathlib.Path] = None,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self.max_concurrency = max_concurrency or workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_body = max_body
+        self.default_palette = default_palette
+        self.palette_dir = palette_dir
+        self.max_memory = max_memory
+        self.preload = preload
+        self.metrics = ServiceMetrics()
+        self.slots = asyncio.Semaphore(self.max_concurrency)
+        self.pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.preload,))
+
+    async def warm_up(self) -> None:
+        """Start every worker process, so that the first requests do not pay for starting them and importing."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _ready) for _ in range(self.workers)))
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        start = time.perf_counter()
+        try:
+            try:
+                request = await self._read_request(reader)
+                status, content_type, body, headers = await self._dispatch(request, start)
+            except RequestError as e:
+                status, content_type, body, headers = e.status, "text/plain; charset=utf-8", str(e).encode(), {}
+            except Exception:
+                # Internal errors, such as a palette file that does not parse, are not described to the client.
+                status, content_type, body, headers = 500, "text/plain; charset=utf-8", b"Internal server error", {}
+
+            self.metrics.statuses[status] += 1
+            await self._write_response(writer, status, content_type, body, headers)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(
+        self, request: HTTPRequest, start: float
+    ) -> Tuple[int, str, bytes, Dict[str, str]]:
+        if request.path == "/health":
+            return 200, "text/plain; charset=utf-8", b"ok\n", {}
+        if request.path == "/metrics":
+            metrics = self.metrics.to_dict(self.workers, self.max_concurrency, self.max_queue)
+            return 200, "application/json", json.dumps(metrics, indent=2).encode(), {}
+        if request.path != "/render":
+            raise RequestError(404, f"Unknown path '{request.path}'. Use /render, /metrics or /health")
+        if request.method != "POST":
+            raise RequestError(405, "Post the image bytes to /render")
+
+        self.metrics.requests += 1
+        render_request = parse_render_request(
+            request.query, self.default_palette, self.max_memory, self.palette_dir
+        )
+        if not request.body:
+            raise RequestError(400, "The request body must contain the image")
+
+        image_bytes, seconds = await self._run(render_request, request.body, start)
+        self.metrics.total_seconds.append(time.perf_counter() - start)
+        headers = {"X-PBN-Processing-Seconds": f"{seconds:.6f}"}
+        return 200, CONTENT_TYPES[render_request.output_format], image_bytes, headers
+
+    async def _run(self, render_request: RenderRequest, image_bytes: bytes, start: float) -> Tuple[bytes, float]:
+        if self.slots.locked() and self.metrics.queued >= self.max_queue:
+            raise RequestError(503, "Too many queued requests, try again later")
+
+        # The timeout covers the time spent waiting for a slot as well.
+        deadline = None if self.timeout is None else start + self.timeout
+        self.metrics.queued += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self._remaining(deadline))
+        except asyncio.TimeoutError:
+            raise RequestError(504, f"No worker became available within {self.timeout} seconds")
+        finally:
+            self.metrics.queued -= 1
+        self.metrics.queue_seconds.append(time.perf_counter() - start)
+
+        self.metrics.in_flight += 1
+        pool = self.pool
+        future = asyncio.get_running_loop().run_in_executor(pool, _render, render_request, image_bytes)
+
+        def release(done: asyncio.Future[Tuple[bytes, float]]) -> None:
+            self.metrics.in_flight -= 1
+            self.slots.release()
+            if not done.cancelled() and done.exception() is None:
+                self.metrics.processing_seconds.append(done.result()[1])
+
+        future.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self._remaining(deadline))
+        except asyncio.TimeoutError:
+            raise RequestError(504, f"The pipeline did not finish within {self.timeout} seconds")
+        except MemoryBudgetError as e:
+            raise RequestError(413, str(e))
+        except InvalidInput as e:
+            raise RequestError(400, str(e))
+        except BrokenProcessPool:
+            if self.pool is pool:
+                self.pool = self._new_pool()
+            raise RequestError(500, "A worker process died; the worker pool was restarted")
+
+    @staticmethod
+    def _remaining(deadline: Optional[float]) -> Optional[float]:
+        return None if deadline is None else max(0.0, deadline - time.perf_counter())
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> HTTPRequest:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed before the request was complete")
+        except asyncio.LimitOverrunError:
+            raise RequestError(400, "Request headers too large")
+
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise RequestError(400, "Malformed request line")
+
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+        content_length = headers.get("content-length", "0") or "0"
+        if not (content_length.isascii() and content_length.isdigit()):
+            raise RequestError(400, "Invalid Content-Length")
+        length = int(content_length)
+        if length > self.max_body:
+            raise RequestError(413, f"The image exceeds the maximum of {self.max_body} bytes")
+        body = await reader.readexactly(length) if length else b""
+        return HTTPRequest(method.upper(), target, headers, body)
+
+    async def _write_response(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        content_type: str,
+        body: bytes,
+        headers: Dict[str, str],
+    ) -> None:
+        lines = [
+            f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+            *(f"{key}: {value}" for key, value in headers.items()),
+        ]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+async def serve(
+    service: PaintByNumberService,
+    host: str = "127.0.0.1",
+    port: int = 8470,
+    unix_socket: Optional[pathlib.Path] = None,
+) -> None:
+    """Serve until cancelled, on a Unix socket when one is given and on host:port otherwise."""
+    await service.warm_up()
+    server: asyncio.AbstractServer
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(service.handle_connection, path=str(unix_socket))
+        print(f"Serving on unix socket {unix_socket}", flush=True)
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port}", flush=True)
+
+    # Stop cleanly on SIGTERM as well as on Ctrl+C, so that the workers and the socket are cleaned up.
+    serving = asyncio.ensure_future(server.serve_forever())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+    try:
+        async with server:
+            await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        service.close()
+        if unix_socket is not None and unix_socket.exists():
+            os.unlink(unix_socket)
@@ -0,0 +1,178 @@
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass, fields, replace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from PIL import Image
+
+from pbn.algorithms import PreprocessingEnum
+from pbn.backends import use_backend
+from pbn.cache import describe_algorithm, hash_image, hash_palette, make_key
+from pbn.datatypes import Color, ColoredSegmentedImage, Palette, PipelineRun, PipelineStageEnum
+from pbn.palette import load_run_palette
+from pbn.palette_selection import select_palette
+from pbn.profiling import PipelineProfiler, estimate_bytes
+
+
+@dataclass
+class StageResult:
+    """A stage output kept by an editing session and its estimated size."""
+
+    value: Any
+    size: int
+
+
+class EditingSession:
+    """Runs a pipeline repeatedly while its settings are edited, rerunning only the stages a change affects.
+
+    The output of every stage is kept in memory under a key that covers everything it depends on: the input image,
+    the palette from the first stage that uses it, and the algorithms and parameters of the stage and all stages
+    before it. After update(), process() reuses the outputs whose key did not change. A new palette, for example,
+    only reruns assignment, postprocessing and rendering, unless a preprocessing step such as dithering uses it.
+    With max_bytes, the least recently used outputs are evicted when the kept outputs grow beyond it.
+
+    Intermediate images, the on-disk cache, banded rendering and the memory budget of the run are not used."""
+
+    pipeline_run: PipelineRun
+    palette: Palette
+    max_bytes: Optional[int]
+    profiler: PipelineProfiler
+    results: OrderedDict[str, StageResult]
+    recomputed: List[Tuple[str, str]]
+
+    def __init__(
+        self,
+        pipeline_run: PipelineRun,
+        palette: Optional[Palette] = None,
+        max_bytes: Optional[int] = None,
+        profiler: Optional[PipelineProfiler] = None,
+    ):
+        """An already loaded palette can be passed to skip reading pipeline_run.palette_path.
+        A profiler collects the metrics of the stages that run, not of the reused ones."""
+        if max_bytes is not None and max_bytes < 0:
+            raise ValueError("max_bytes must be non-negative")
+        self.max_bytes = max_bytes
+        self.profiler = profiler or PipelineProfiler.disabled()
+        self.results = OrderedDict()
+        self.recomputed = []
+        self.pipeline_run = pipeline_run
+        self.palette = palette if palette is not None else load_run_palette(pipeline_run)
+        self._image_key = hash_image(pipeline_run.original_image)
+
+    @property
+    def size(self) -> int:
+        """The estimated bytes of the kept stage outputs."""
+        return sum(result.size for result in self.results.values())
+
+    def update(self, palette: Optional[Palette] = None, **changes: Any) -> None:
+        """Change fields of the pipeline run, e.g. segmentation=... or postprocessing=[...], and/or the palette.
+        A new palette_path is loaded unless the palette is given as well. Nothing runs until process()."""
+        names = {f.name for f in fields(PipelineRun)}
+        unknown = set(changes) - names
+        if unknown:
+            raise TypeError(f"Unknown pipeline settings: {', '.join(sorted(unknown))}")
+
+        self.pipeline_run = replace(self.pipeline_run, **changes)
+        if palette is not None:
+            self.palette = palette
+        elif "palette_path" in changes:
+            self.palette = load_run_palette(self.pipeline_run)
+        if "original_image" in changes:
+            self._image_key = hash_image(self.pipeline_run.original_image)
+
+    def process(self) -> Image.Image:
+        """Run the pipeline, reusing every kept stage output that the changes since the last run did not affect.
+        The stages that ran are listed in recomputed."""
+        run = self.pipeline_run
+        self.recomputed = []
+        parts = [self._image_key, hash_palette(self.palette)]
+
+        palette = self.palette
+        if run.palette_size is not None:
+            size = run.palette_size
+            palette = self._stage(
+                parts,
+                (PipelineStageEnum.PALETTE_SELECTION, f"greedy-swap:size-{size}"),
+                lambda: [self.palette[i] for i in select_palette(run.original_image, self.palette, size)],
+            )
+        # The image-only stages do not depend on the palette unless a preprocessing step uses it.
+        parts = [self._image_key]
+
+        image = run.original_image
+        preprocessing = [(step, p) for step, p in enumerate(run.preprocessing) if p.name != PreprocessingEnum.NONE]
+        if preprocessing:
+            parts.append(hash_palette(palette))
+        for step, preprocessing_algo in preprocessing:
+            image = self._stage(
+                parts,
+                (PipelineStageEnum.PREPROCESSING, describe_algorithm(preprocessing_algo)),
+                lambda: preprocessing_algo.process(image, palette),
+                step,
+            )
+
+        segments = self._stage(
+            parts,
+            (PipelineStageEnum.SEGMENTATION, describe_algorithm(run.segmentation)),
+            lambda: run.segmentation.segment(image),
+        )
+
+        if not preprocessing:
+            parts.append(hash_palette(palette))
+        colored: ColoredSegmentedImage = self._stage(
+            parts,
+            (PipelineStageEnum.COLOR_ASSINGMENT, describe_algorithm(run.assignment)),
+            lambda: run.assignment.assign_colors(image, segments, palette),
+        )
+
+        for step, postprocessing_algo in enumerate(run.postprocessing):
+            # Postprocessing may change the segments it is given, and the kept input must stay as it is.
+            colored = self._stage(
+                parts,
+                (PipelineStageEnum.POSTPROCESSING, describe_algorithm(postprocessing_algo)),
+                lambda: postprocessing_algo.process(colored.copy(), palette),
+                step,
+            )
+
+        output: Image.Image | Tuple[Image.Image, Dict[int, Color]] = self._stage(
+            parts,
+            (PipelineStageEnum.RENDERING, describe_algorithm(run.rendering)),
+            lambda: run.rendering.render(colored),
+        )
+        # Renderings may return a color map next to the image; like PaintByNumber.output_image, only the image is
+        # returned, as a copy so that changes to it do not reach the kept output.
+        image = output if isinstance(output, Image.Image) else output[0]
+        return image.copy()
+
+    def clear(self) -> None:
+        """Drop all kept stage outputs."""
+        self.results.clear()
+
+    def _stage(self, parts: List[str], stage: Tuple[str, str], compute: Callable[[], Any], step: int = 0) -> Any:
+        """Return the kept output of a stage with the key of parts plus this stage, or compute and keep it.
+        parts is extended with the stage, so it becomes the prefix of the next stage."""
+        parts.append(f"{stage[0]}={stage[1]}")
+        key = make_key(*parts)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key].value
+
+        algorithm = stage[1].split(":", 1)[0]
+        with use_backend(self.pipeline_run.backend), self.profiler.stage(stage[0], algorithm, step) as recorder:
+            value = compute()
+            recorder.output(value)
+        self.recomputed.append((str(stage[0]), algorithm))
+
+        self.results[key] = StageResult(value, estimate_bytes(value))
+        self._evict(keep=key)
+        return value
+
+    def _evict(self, keep: str) -> None:
+        """Remove the least recently used outputs, other than keep, until the kept outputs fit in max_bytes."""
+        if self.max_bytes is None:
+            return
+        total = self.size
+        for key in list(self.results):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.results.pop(key).size
@@ -0,0 +1,103 @@
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Dict, List, Optional, Sequence
+
+from pbn.algorithms import PreprocessingEnum
+from pbn.core import PaintByNumber
+from pbn.datatypes import Palette, PipelineRun, PipelineStageEnum
+from pbn.profiling import PipelineProfiler, StageMetrics
+
+# The edge-preserving smoothing algorithms, which are there to remove the noise that makes tiny segments.
+SMOOTHING_ALGORITHMS = (PreprocessingEnum.MEDIAN, PreprocessingEnum.BILATERAL, PreprocessingEnum.MEAN_SHIFT)
+# The stages whose work depends on the number of segments smoothing leaves.
+DOWNSTREAM_STAGES = (
+    PipelineStageEnum.SEGMENTATION,
+    PipelineStageEnum.COLOR_ASSINGMENT,
+    PipelineStageEnum.POSTPROCESSING,
+)
+
+
+@dataclass
+class SmoothingImpact:
+    """What the smoothing steps of a run changed downstream, compared to the same run without them: the segments
+    out of segmentation and out of the last stage before rendering, and the wall time of the downstream stages."""
+
+    algorithms: List[str]
+    smoothing_seconds: float
+    segmented_with: Optional[int]
+    segmented_without: Optional[int]
+    final_with: Optional[int]
+    final_without: Optional[int]
+    downstream_seconds_with: float
+    downstream_seconds_without: float
+
+    @property
+    def segments_removed(self) -> Optional[int]:
+        if self.final_with is None or self.final_without is None:
+            return None
+        return self.final_without - self.final_with
+
+    @property
+    def seconds_saved(self) -> float:
+        """Downstream time saved, not counting the time spent smoothing."""
+        return self.downstream_seconds_without - self.downstream_seconds_with
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            **asdict(self),
+            "segments_removed": self.segments_removed,
+            "seconds_saved": self.seconds_saved,
+            "net_seconds_saved": self.seconds_saved - self.smoothing_seconds,
+        }
+
+
+def _summarize(metrics: Sequence[StageMetrics]) -> Dict[str, Any]:
+    downstream = [m for m in metrics if m.stage in DOWNSTREAM_STAGES]
+    segmented = [m.segments_out for m in downstream if m.stage == PipelineStageEnum.SEGMENTATION]
+    return {
+        "segmented": segmented[-1] if segmented else None,
+        "final": downstream[-1].segments_out if downstream else None,
+        "seconds": sum(m.wall_seconds for m in downstream),
+    }
+
+
+def smoothing_impact(
+    pipeline_run: PipelineRun, palette: Palette, profiler: PipelineProfiler
+) -> Optional[SmoothingImpact]:
+    """Run the stages up to rendering again without the smoothing steps of a run that profiler measured, and
+    compare. pipeline_run and palette are those of the measured PaintByNumber, after memory planning and palette
+    selection. None when the run has no smoothing steps.
+
+    The comparison run skips the intermediate images and the cache, so its downstream stages are always computed;
+    for a fair comparison, the measured run should not have resumed from the cache either."""
+    smoothing = [p for p in pipeline_run.preprocessing if p.name in SMOOTHING_ALGORITHMS]
+    if not smoothing:
+        return None
+
+    without_run = replace(
+        pipeline_run,
+        preprocessing=[p for p in pipeline_run.preprocessing if p.name not in SMOOTHING_ALGORITHMS],
+        intermediate_dir=None,
+        cache_dir=None,
+        max_memory=None,
+        palette_size=None,
+    )
+    # Memory tracing slows the stages down, so both runs trace or neither does.
+    without_profiler = PipelineProfiler(trace_memory=profiler.trace_memory)
+    PaintByNumber(without_run, palette=palette, profiler=without_profiler).process_segments()
+
+    with_summary = _summarize(profiler.metrics)
+    without_summary = _summarize(without_profiler.metrics)
+    return SmoothingImpact(
+        algorithms=[str(p.name) for p in smoothing],
+        smoothing_seconds=sum(
+            m.wall_seconds
+            for m in profiler.metrics
+            if m.stage == PipelineStageEnum.PREPROCESSING and m.algorithm in SMOOTHING_ALGORITHMS
+        ),
+        segmented_with=with_summary["segmented"],
+        segmented_without=without_summary["segmented"],
+        final_with=with_summary["final"],
+        final_without=without_summary["final"],
+        downstream_seconds_with=with_summary["seconds"],
+        downstream_seconds_without=without_summary["seconds"],
+    )
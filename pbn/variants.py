@@ -0,0 +1,456 @@
+from __future__ import annotations
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type, cast
+from PIL import Image
+import json
+import os
+import pathlib
+import time
+import tomllib
+
+import numpy as np
+
+from pbn.algorithms import (
+    ALGORITHM_MAP,
+    ImageProcessingAlgorithm,
+    ImageSegmentationAlgorithm,
+    ColorAssignmentAlgorithm,
+    SegmentsProcessingAlgorithm,
+    SegmentRenderingAlgorithm,
+    PreprocessingEnum,
+    SegmentationEnum,
+    PostprocessingEnum,
+    AssignmentEnum,
+    RenderingEnum,
+)
+from pbn.batch import load_image
+from pbn.cache import describe_algorithm, hash_image, hash_palette, make_key
+from pbn.datatypes import (
+    Color,
+    ColoredSegment,
+    ColoredSegmentedImage,
+    Palette,
+    PipelineRun,
+    PipelineStageEnum,
+    Segment,
+    SegmentedImage,
+)
+from pbn.output import make_output_filename
+from pbn.palette import load_palette
+from pbn.params import parse_enum_with_params
+from pbn.core import write_rendered_bands
+from pbn.writer import INDEXED_FORMATS, format_from_path, save_image
+
+
+SPEC_KEYS = {
+    "input",
+    "palette",
+    "preprocessing",
+    "segmentation",
+    "assignment",
+    "postprocessing",
+    "rendering",
+    "band_height",
+    "output",
+}
+
+SPEC_DEFAULTS: Dict[str, Any] = {
+    "preprocessing": [PreprocessingEnum.NONE],
+    "segmentation": "grid,cell_size=1",
+    "assignment": AssignmentEnum.AVERAGE_NEAREST,
+    "postprocessing": [PostprocessingEnum.MERGE],
+    "rendering": RenderingEnum.COLORED,
+}
+
+
+@dataclass
+class Variant:
+    """One pipeline run of a variant spec and the path its output is saved to."""
+
+    pipeline_run: PipelineRun
+    output_path: pathlib.Path
+
+
+@dataclass
+class VariantResult:
+    """Outcome of one variant. seconds is the time from the start of the run until the output was saved.
+    Failed variants carry the error of the first failing stage instead of an output path."""
+
+    output_path: pathlib.Path
+    seconds: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class NodeRef:
+    """An argument of a stage node that is the output of another node."""
+
+    key: str
+
+
+@dataclass
+class StageNode:
+    """One unique stage computation of a variant graph. Variants with the same prefix share the node."""
+
+    key: str
+    stage: str
+    algorithm: str
+    function: Callable[..., Any]
+    args: Tuple[Any, ...]
+    variants: List[int] = field(default_factory=list)
+
+    @property
+    def inputs(self) -> List[str]:
+        return [arg.key for arg in self.args if isinstance(arg, NodeRef)]
+
+
+@dataclass
+class VariantGraph:
+    """The stage nodes of a set of variants in topological order, with the output node and path of every variant."""
+
+    nodes: Dict[str, StageNode]
+    outputs: List[str]
+    output_paths: List[pathlib.Path]
+    stage_count: int
+
+    @property
+    def shared_count(self) -> int:
+        """The number of stage computations saved by sharing prefixes."""
+        return self.stage_count - len(self.nodes)
+
+
+@dataclass
+class PackedSegments:
+    """Segments as flat arrays, which a process pool pickles far faster than the segment and pixel objects.
+    Unpacking restores the segments with their pixels in the original order."""
+
+    colored: bool
+    width: int
+    height: int
+    ids: List[int]
+    colors: List[Color]
+    offsets: np.ndarray
+    pixels: np.ndarray
+    metadata: Dict[str, Any]
+
+    @classmethod
+    def pack(cls, segments: SegmentedImage | ColoredSegmentedImage) -> PackedSegments:
+        colored = isinstance(segments, ColoredSegmentedImage)
+        pixels = [pixel for seg in segments.segments for pixel in seg.pixels]
+        return cls(
+            colored=colored,
+            width=segments.width,
+            height=segments.height,
+            ids=[seg.id for seg in segments.segments],
+            colors=[seg.color for seg in cast(ColoredSegmentedImage, segments).segments] if colored else [],
+            offsets=np.cumsum([0] + [len(seg.pixels) for seg in segments.segments], dtype=np.int64),
+            pixels=np.array(pixels, dtype=np.int32).reshape(-1, 2),
+            metadata=segments.metadata,
+        )
+
+    def unpack(self) -> SegmentedImage | ColoredSegmentedImage:
+        pixels = list(zip(self.pixels[:, 0].tolist(), self.pixels[:, 1].tolist()))
+        bounds = list(zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist()))
+        if self.colored:
+            colored_segments = [
+                ColoredSegment(id=i, pixels=pixels[start:end], color=color)
+                for i, color, (start, end) in zip(self.ids, self.colors, bounds)
+            ]
+            return ColoredSegmentedImage(self.width, self.height, colored_segments, metadata=self.metadata)
+        segments = [Segment(id=i, pixels=pixels[start:end]) for i, (start, end) in zip(self.ids, bounds)]
+        return SegmentedImage(self.width, self.height, segments, metadata=self.metadata)
+
+
+def _run_packed(function: Callable[..., Any], *args: Any) -> Any:
+    """Run a node in a worker process, with segments packed on the way in and out."""
+    result = function(*(arg.unpack() if isinstance(arg, PackedSegments) else arg for arg in args))
+    return PackedSegments.pack(result) if isinstance(result, (SegmentedImage, ColoredSegmentedImage)) else result
+
+
+def _preprocess(image: Image.Image, algorithm: ImageProcessingAlgorithm, palette: Palette) -> Image.Image:
+    return algorithm.process(image, palette)
+
+
+def _segment(image: Image.Image, algorithm: ImageSegmentationAlgorithm) -> SegmentedImage:
+    return algorithm.segment(image)
+
+
+def _assign(
+    image: Image.Image, segments: SegmentedImage, algorithm: ColorAssignmentAlgorithm, palette: Palette
+) -> ColoredSegmentedImage:
+    return algorithm.assign_colors(image, segments, palette)
+
+
+def _postprocess(
+    segments: ColoredSegmentedImage, algorithm: SegmentsProcessingAlgorithm, palette: Palette
+) -> ColoredSegmentedImage:
+    # The input may be shared with other branches, so it is never modified in place.
+    return algorithm.process(segments.copy(), palette)
+
+
+def _save(
+    segments: ColoredSegmentedImage,
+    algorithm: SegmentRenderingAlgorithm,
+    palette: Palette,
+    output_path: pathlib.Path,
+    band_height: Optional[int],
+) -> pathlib.Path:
+    """Render the segments and save them like PaintByNumber.save, in the format of the output extension."""
+    output_format = format_from_path(output_path)
+    indexed = output_format in INDEXED_FORMATS
+    if band_height:
+        return write_rendered_bands(algorithm, segments, palette, output_path, band_height, output_format, indexed)
+
+    result_image = algorithm.render_indexed(segments, palette) if indexed else None
+    if result_image is None:
+        result = algorithm.render(segments)
+        result_image = result if isinstance(result, Image.Image) else result[0]
+    save_image(output_path, result_image, output_format)
+    return output_path
+
+
+def build_graph(variants: Sequence[Variant], palettes: Optional[Dict[pathlib.Path, Palette]] = None) -> VariantGraph:
+    """Deduplicate the stages of the variants into a graph of unique stage nodes.
+
+    Stages are shared by variants with the same input image and the same algorithms and parameters up to and
+    including that stage. The palette is part of the prefix from the first stage that uses it: the first
+    preprocessing algorithm, or the color assignment when there is no preprocessing. Raises ValueError when two
+    different variants would be saved to the same path."""
+    palettes = {} if palettes is None else palettes
+    nodes: Dict[str, StageNode] = {}
+    outputs: List[str] = []
+    output_paths: List[pathlib.Path] = []
+    output_keys: Dict[pathlib.Path, str] = {}
+    stage_count = 0
+
+    for index, variant in enumerate(variants):
+        run = variant.pipeline_run
+        if run.palette_path is None:
+            raise ValueError(f"Variant {variant.output_path} has no palette file")
+        if run.palette_path not in palettes:
+            palettes[run.palette_path] = load_palette(run.palette_path)
+        palette = palettes[run.palette_path]
+        parts = [hash_image(run.original_image)]
+
+        def add(stage: str, algorithm: Any, function: Callable[..., Any], *args: Any) -> NodeRef:
+            """Add the stage to the prefix of the current variant and return its node, shared when it exists."""
+            nonlocal stage_count
+            stage_count += 1
+            parts.append(f"{stage}={describe_algorithm(algorithm)}")
+            key = make_key(*parts)
+            if key not in nodes:
+                nodes[key] = StageNode(key, stage, algorithm.name, function, args)
+            nodes[key].variants.append(index)
+            return NodeRef(key)
+
+        image: Image.Image | NodeRef = run.original_image
+        preprocessing = [p for p in run.preprocessing if p.name != PreprocessingEnum.NONE]
+        if preprocessing:
+            parts.append(hash_palette(palette))
+        for preprocessing_algo in preprocessing:
+            image = add(
+                PipelineStageEnum.PREPROCESSING, preprocessing_algo, _preprocess, image, preprocessing_algo, palette
+            )
+
+        segments = add(PipelineStageEnum.SEGMENTATION, run.segmentation, _segment, image, run.segmentation)
+
+        if not preprocessing:
+            parts.append(hash_palette(palette))
+        colored = add(
+            PipelineStageEnum.COLOR_ASSINGMENT, run.assignment, _assign, image, segments, run.assignment, palette
+        )
+
+        for postprocessing_algo in run.postprocessing:
+            colored = add(
+                PipelineStageEnum.POSTPROCESSING,
+                postprocessing_algo,
+                _postprocess,
+                colored,
+                postprocessing_algo,
+                palette,
+            )
+
+        output_path = variant.output_path.resolve()
+        parts.append(f"{output_path}:{run.band_height}")
+        output = add(
+            PipelineStageEnum.RENDERING,
+            run.rendering,
+            _save,
+            colored,
+            run.rendering,
+            palette,
+            output_path,
+            run.band_height,
+        )
+        if output_keys.setdefault(output_path, output.key) != output.key:
+            raise ValueError(f"Several different variants would be saved to {output_path}")
+        outputs.append(output.key)
+        output_paths.append(output_path)
+
+    return VariantGraph(nodes, outputs, output_paths, stage_count)
+
+
+def _run_inline(function: Callable[..., Any], *args: Any) -> Future[Any]:
+    """Run a node in the calling process, wrapping the outcome like a pool would."""
+    future: Future[Any] = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def run_graph(graph: VariantGraph, workers: Optional[int] = None) -> Iterator[Tuple[int, VariantResult]]:
+    """Execute every node of the graph once and yield (variant index, result) as the outputs are saved.
+
+    Nodes run as soon as their inputs are ready, so independent branches run in parallel in a process pool.
+    The output of a node is released once every node that needs it has started. A failing node fails all
+    variants that depend on it, without stopping the other branches. With workers <= 1 all nodes run in the
+    calling process."""
+    workers = workers if workers is not None else os.cpu_count() or 1
+    start = time.perf_counter()
+
+    consumers: Dict[str, int] = {key: 0 for key in graph.nodes}
+    for node in graph.nodes.values():
+        for key in node.inputs:
+            consumers[key] += 1
+
+    results: Dict[str, Any] = {}
+    failed: Dict[str, str] = {}
+    waiting = dict(graph.nodes)
+    running: Dict[Future[Any], str] = {}
+    outputs: Dict[str, List[int]] = {}
+    for index, key in enumerate(graph.outputs):
+        outputs.setdefault(key, []).append(index)
+
+    def finish(key: str) -> Iterator[Tuple[int, VariantResult]]:
+        seconds = time.perf_counter() - start
+        for index in outputs.get(key, []):
+            yield index, VariantResult(graph.output_paths[index], seconds, failed.get(key))
+
+    executor: Optional[Executor] = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        while waiting or running:
+            for key, node in list(waiting.items()):
+                error = next((failed[k] for k in node.inputs if k in failed), None)
+                if error is not None:
+                    del waiting[key]
+                    failed[key] = error
+                    yield from finish(key)
+                    continue
+                if any(k not in results for k in node.inputs):
+                    continue
+
+                del waiting[key]
+                args = [results[arg.key] if isinstance(arg, NodeRef) else arg for arg in node.args]
+                for k in node.inputs:
+                    consumers[k] -= 1
+                    if consumers[k] == 0:
+                        del results[k]
+                if executor is None:
+                    running[_run_inline(node.function, *args)] = key
+                else:
+                    running[executor.submit(_run_packed, node.function, *args)] = key
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    node = graph.nodes[key]
+                    failed[key] = f"{node.stage} ({node.algorithm}) failed: {type(e).__name__}: {e}"
+                else:
+                    if consumers[key]:
+                        results[key] = result
+                yield from finish(key)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def run_variants(
+    variants: Sequence[Variant], workers: Optional[int] = None
+) -> Iterator[Tuple[Variant, VariantResult]]:
+    """Run all variants with shared prefixes computed once, yielding every variant with its result as it finishes."""
+    graph = build_graph(variants)
+    for index, result in run_graph(graph, workers):
+        yield variants[index], result
+
+
+def _parse_algorithm(stage: Type[StrEnum], value: Any) -> Any:
+    """Instantiate an algorithm from the CLI syntax, e.g. 'voronoi,num_seeds=50'."""
+    if not isinstance(value, str):
+        raise ValueError(f"Expected an algorithm string such as 'merge' for {stage.__name__}, got {value!r}")
+    name, params = parse_enum_with_params(stage)(value)
+    return ALGORITHM_MAP.load(stage, name)(**params)
+
+
+def _parse_chain(stage: Type[StrEnum], value: Any) -> List[Any]:
+    values = [value] if isinstance(value, str) else value
+    if not isinstance(values, list):
+        raise ValueError(f"Expected an algorithm string or a list of them for {stage.__name__}, got {value!r}")
+    return [_parse_algorithm(stage, v) for v in values]
+
+
+def load_variants(spec_path: pathlib.Path, output_dir: Optional[pathlib.Path] = None) -> List[Variant]:
+    """Load the variants of a TOML or JSON spec file.
+
+    The spec has an optional [defaults] table and a [[variants]] list. Every variant takes the keys input,
+    palette, preprocessing, segmentation, assignment, postprocessing, rendering, band_height and output, falling
+    back to the defaults and then to the command line defaults. Algorithms use the command line syntax and
+    preprocessing and postprocessing may be lists. Paths are relative to the spec file, and outputs to
+    output_dir, the spec's output_dir or the spec file's directory. Variants without an output are named by
+    make_output_filename. Every input image is loaded once."""
+    with spec_path.open("rb") as f:
+        spec = json.load(f) if spec_path.suffix.lower() == ".json" else tomllib.load(f)
+
+    base_dir = spec_path.resolve().parent
+    defaults = {**SPEC_DEFAULTS, **spec.get("defaults", {})}
+    if output_dir is None:
+        output_dir = base_dir / spec.get("output_dir", ".")
+    entries = spec.get("variants") or [{}]
+
+    images: Dict[pathlib.Path, Image.Image] = {}
+    variants = []
+    for i, entry in enumerate(entries):
+        values = {**defaults, **entry}
+        unknown = set(values) - SPEC_KEYS
+        if unknown:
+            raise ValueError(f"Variant {i}: unknown keys {', '.join(sorted(unknown))}")
+        for required in ("input", "palette"):
+            if required not in values:
+                raise ValueError(f"Variant {i}: no {required} given")
+
+        input_path = (base_dir / values["input"]).resolve()
+        if input_path not in images:
+            images[input_path] = load_image(input_path)
+
+        try:
+            pipeline_run = PipelineRun(
+                input_path=input_path,
+                original_image=images[input_path],
+                palette_path=(base_dir / values["palette"]).resolve(),
+                preprocessing=_parse_chain(PreprocessingEnum, values["preprocessing"]),
+                segmentation=_parse_algorithm(SegmentationEnum, values["segmentation"]),
+                postprocessing=_parse_chain(PostprocessingEnum, values["postprocessing"]),
+                assignment=_parse_algorithm(AssignmentEnum, values["assignment"]),
+                rendering=_parse_algorithm(RenderingEnum, values["rendering"]),
+                band_height=values.get("band_height"),
+            )
+        except Exception as e:
+            raise ValueError(f"Variant {i}: {e}") from e
+
+        output_name = values.get("output") or make_output_filename(pipeline_run)
+        variants.append(Variant(pipeline_run, output_dir / output_name))
+
+    return variants
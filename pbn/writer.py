@@ -0,0 +1,288 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from types import TracebackType
+from typing import Any, BinaryIO, Dict, Iterable, Optional, Sequence, Tuple, Type, Union
+import pathlib
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from pbn.datatypes import Color, OutputFormatEnum
+from pbn.histogram import pack_rgb, unpack_rgb
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IDAT_SIZE = 1 << 16
+
+PIL_FORMATS = {
+    OutputFormatEnum.PPM: "PPM",
+    OutputFormatEnum.PNG: "PNG",
+    OutputFormatEnum.JPG: "JPEG",
+    OutputFormatEnum.TIFF: "TIFF",
+}
+
+PIL_OPTIONS: Dict[OutputFormatEnum, Dict[str, Any]] = {OutputFormatEnum.TIFF: {"compression": "tiff_deflate"}}
+
+FORMAT_ALIASES = {"jpeg": OutputFormatEnum.JPG, "pnm": OutputFormatEnum.PPM, "tif": OutputFormatEnum.TIFF}
+
+# Formats that store a palette, so images with few colors are saved with one byte per pixel.
+INDEXED_FORMATS = {OutputFormatEnum.PNG, OutputFormatEnum.TIFF}
+MAX_INDEXED_COLORS = 256
+
+# The colors of an indexed image: RGB tuples or an (n, 3) uint8 array.
+Colors = Union[Sequence[Color], np.ndarray]
+
+
+def format_from_path(path: pathlib.Path, default: OutputFormatEnum = OutputFormatEnum.PPM) -> OutputFormatEnum:
+    """Infer the output format from the file extension, falling back to the default."""
+    suffix = path.suffix.lower().lstrip(".")
+    if suffix in FORMAT_ALIASES:
+        return FORMAT_ALIASES[suffix]
+    try:
+        return OutputFormatEnum(suffix)
+    except ValueError:
+        return default
+
+
+def indexed_image(indices: np.ndarray, colors: Colors) -> Image.Image:
+    """A mode "P" image from a (height, width) uint8 array of indices into colors."""
+    image = Image.fromarray(np.ascontiguousarray(indices, dtype=np.uint8), "P")
+    image.putpalette(np.array(colors, dtype=np.uint8).reshape(-1).tobytes())
+    return image
+
+
+def index_pixels(pixels: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """The uint8 color indices and colors of an (height, width, 3) uint8 array, or None when it has more than
+    MAX_INDEXED_COLORS colors."""
+    keys, inverse = np.unique(pack_rgb(pixels).ravel(), return_inverse=True)
+    if len(keys) > MAX_INDEXED_COLORS:
+        return None
+    return inverse.astype(np.uint8).reshape(pixels.shape[:2]), unpack_rgb(keys)
+
+
+def save_image(
+    target: Union[pathlib.Path, BinaryIO], image: Image.Image, output_format: OutputFormatEnum
+) -> None:
+    """Save an RGB or palette-indexed (mode "P") image. Formats without a palette get the RGB pixels;
+    .npy arrays hold the pixels as they are, so indexed images become (height, width) index arrays."""
+    if output_format == OutputFormatEnum.NPY:
+        pixels = np.asarray(image if image.mode in ("P", "L") else image.convert("RGB"))
+        if isinstance(target, pathlib.Path):
+            with target.open("wb") as f:
+                np.save(f, pixels)
+        else:
+            np.save(target, pixels)
+        return
+    if image.mode == "P" and output_format not in INDEXED_FORMATS:
+        image = image.convert("RGB")
+    image.save(target, format=PIL_FORMATS[output_format], **PIL_OPTIONS.get(output_format, {}))
+
+
+def save_array(
+    path: pathlib.Path, pixels: np.ndarray, output_format: Optional[OutputFormatEnum] = None, indexed: bool = False
+) -> pathlib.Path:
+    """Save an (height, width) or (height, width, 3) uint8 array in the given or inferred format.
+    With indexed, RGB arrays with few enough colors are saved with a palette when the format has one."""
+    output_format = output_format or format_from_path(path)
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    image: Optional[Image.Image] = None
+    if indexed and output_format in INDEXED_FORMATS and pixels.ndim == 3:
+        index = index_pixels(pixels)
+        if index is not None:
+            image = indexed_image(*index)
+    save_image(path, image or Image.fromarray(pixels), output_format)
+    return path
+
+
+class BandWriter(ABC):
+    """Abstract base class for writers that receive an RGB image as consecutive row bands.
+
+    With colors, the bands are (rows, width) uint8 indices into colors instead. Writers of formats with a palette
+    store them as they are; the others store the colors."""
+
+    path: pathlib.Path
+    width: int
+    height: int
+    rows_written: int
+    colors: Optional[np.ndarray]
+    # Whether the format stores index bands with a palette.
+    indexed = False
+
+    def __init__(self, path: pathlib.Path, width: int, height: int, colors: Optional[Colors] = None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.colors = None
+        if colors is not None:
+            if not 0 < len(colors) <= MAX_INDEXED_COLORS:
+                raise ValueError(f"An indexed image needs 1 to {MAX_INDEXED_COLORS} colors, got {len(colors)}")
+            self.colors = np.array(colors, dtype=np.uint8).reshape(-1, 3)
+
+    def write(self, band: np.ndarray) -> None:
+        """Append a band of shape (rows, width, 3), or (rows, width) with colors, with dtype uint8 below the
+        previously written rows."""
+        shape = (self.width,) if self.colors is not None else (self.width, 3)
+        if band.shape[1:] != shape:
+            raise ValueError(f"Expected a band of shape (rows, {', '.join(map(str, shape))}), got {band.shape}")
+        if self.rows_written + band.shape[0] > self.height:
+            raise ValueError("More rows written than the image height")
+        if self.colors is not None and not self.indexed:
+            band = self.colors[band]
+        self._write(np.ascontiguousarray(band, dtype=np.uint8))
+        self.rows_written += band.shape[0]
+
+    def close(self) -> None:
+        """Finish the file. Raises if fewer rows than the image height were written."""
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"Expected {self.height} rows, but {self.rows_written} were written")
+            self._finish()
+        finally:
+            self._release()
+
+    def __enter__(self) -> BandWriter:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._release()
+
+    @abstractmethod
+    def _write(self, band: np.ndarray) -> None:
+        pass
+
+    def _finish(self) -> None:
+        pass
+
+    @abstractmethod
+    def _release(self) -> None:
+        pass
+
+
+class PPMBandWriter(BandWriter):
+    """Writes a binary (P6) PPM file row band by row band."""
+
+    file: BinaryIO
+
+    def __init__(self, path: pathlib.Path, width: int, height: int, colors: Optional[Colors] = None):
+        super().__init__(path, width, height, colors)
+        self.file = path.open("wb")
+        self.file.write(f"P6\n{width} {height}\n255\n".encode("ascii"))
+
+    def _write(self, band: np.ndarray) -> None:
+        self.file.write(band.tobytes())
+
+    def _release(self) -> None:
+        self.file.close()
+
+
+class PNGBandWriter(BandWriter):
+    """Writes an 8-bit RGB or palette-indexed PNG file, deflating each row band as it arrives."""
+
+    file: BinaryIO
+    indexed = True
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        width: int,
+        height: int,
+        colors: Optional[Colors] = None,
+        compression: int = 6,
+    ):
+        super().__init__(path, width, height, colors)
+        self.compressor = zlib.compressobj(compression)
+        self.pending = bytearray()
+        self.file = path.open("wb")
+        self.file.write(PNG_SIGNATURE)
+        # Color type 3 is palette-indexed, 2 is RGB.
+        color_type = 3 if self.colors is not None else 2
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        if self.colors is not None:
+            self._write_chunk(b"PLTE", self.colors.tobytes())
+
+    def _write(self, band: np.ndarray) -> None:
+        # Every scanline is prefixed with filter type 0 (none).
+        rows = band.reshape(band.shape[0], -1)
+        scanlines = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 1:] = rows
+        self.pending += self.compressor.compress(scanlines.tobytes())
+        while len(self.pending) >= PNG_IDAT_SIZE:
+            self._write_chunk(b"IDAT", bytes(self.pending[:PNG_IDAT_SIZE]))
+            del self.pending[:PNG_IDAT_SIZE]
+
+    def _finish(self) -> None:
+        self.pending += self.compressor.flush()
+        if self.pending:
+            self._write_chunk(b"IDAT", bytes(self.pending))
+            self.pending.clear()
+        self._write_chunk(b"IEND", b"")
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    def _release(self) -> None:
+        self.file.close()
+
+
+class NPYBandWriter(BandWriter):
+    """Writes the rows into a memory-mapped (height, width, 3) uint8 .npy array."""
+
+    def __init__(self, path: pathlib.Path, width: int, height: int, colors: Optional[Colors] = None):
+        super().__init__(path, width, height, colors)
+        self.array: Optional[np.memmap] = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.uint8, shape=(height, width, 3)
+        )
+
+    def _write(self, band: np.ndarray) -> None:
+        if self.array is None:
+            raise RuntimeError("Writer is already closed.")
+        self.array[self.rows_written : self.rows_written + band.shape[0]] = band
+
+    def _finish(self) -> None:
+        if self.array is not None:
+            self.array.flush()
+
+    def _release(self) -> None:
+        self.array = None
+
+
+BAND_WRITERS: Dict[OutputFormatEnum, Type[BandWriter]] = {
+    OutputFormatEnum.PPM: PPMBandWriter,
+    OutputFormatEnum.PNG: PNGBandWriter,
+    OutputFormatEnum.NPY: NPYBandWriter,
+}
+
+
+def write_bands(
+    path: pathlib.Path,
+    width: int,
+    height: int,
+    bands: Iterable[np.ndarray],
+    output_format: Optional[OutputFormatEnum] = None,
+    colors: Optional[Colors] = None,
+) -> pathlib.Path:
+    """Stream RGB row bands, or index bands into colors, to a file without holding the full image in memory.
+
+    The format is inferred from the file extension when it is not given explicitly."""
+    output_format = output_format or format_from_path(path)
+    if output_format not in BAND_WRITERS:
+        raise ValueError(f"Streaming is not supported for the {output_format} format.")
+    writer_cls = BAND_WRITERS[output_format]
+    with writer_cls(path, width, height, colors) as writer:
+        for band in bands:
+            writer.write(band)
+    return path